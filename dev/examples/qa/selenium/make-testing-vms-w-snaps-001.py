@@ -43,8 +43,10 @@ from nrvr.distros.ub.rel1404.gnome import Ub1404Gnome
 from nrvr.distros.ub.rel1404.preseed import Ub1404IsoImage, UbPreseedFileContent
 from nrvr.distros.ub.rel1404.preseedtemplates import UbPreseedTemplates
 from nrvr.machine.ports import PortsFile
-from nrvr.process.commandcapture import CommandCapture
-from nrvr.remote.ssh import SshCommand, ScpCommand
+from nrvr.process.chrometrace import ChromeTraceSink
+from nrvr.process.commandcapture import CommandCapture, CommandCaptureHooks
+from nrvr.process.commandmemo import CommandMemo
+from nrvr.remote.ssh import SshCommand, SshConnectionPool, ScpCommand
 from nrvr.util.download import Download
 from nrvr.util.ipaddress import IPAddress
 from nrvr.util.nameserver import Nameserver
@@ -71,6 +73,16 @@ SystemRequirements.commandsRequiredByImplementations([IsoImage, WinUdfImage,
 VMwareHypervisor.localRequired()
 VMwareHypervisor.snapshotsRequired()
 
+# optionally write a timeline of downloads, commands, ssh and scp,
+# to open in Chrome at chrome://tracing or at https://ui.perfetto.dev/
+#CommandCaptureHooks.add(ChromeTraceSink(ScriptUser.loggedIn.userHomeRelative("make-testing-vms-trace.json")))
+
+# optionally memoize results of idempotent commands, e.g. which, across runs
+#CommandMemo.enable()
+
+# optionally reuse one ssh connection per machine and user for many ssh and scp commands
+#SshConnectionPool.enable()
+
 # from https://www.scientificlinux.org/download/
 scientificLinuxDistro32IsoUrl = "http://ftp.scientificlinux.org/linux/scientific/6.5/i386/iso/SL-65-i386-2013-12-16-Install-DVD.iso"
 scientificLinuxDistro64IsoUrl = "http://ftp.scientificlinux.org/linux/scientific/6.5/x86_64/iso/SL-65-x86_64-2014-01-27-Install-DVD.iso"
@@ -0,0 +1,240 @@
+#!/usr/bin/python
+
+"""nrvr.diskimage.clonecache - Cache of clones of .iso disk images
+
+The main class provided by this module is IsoImageCloneCache.
+
+Clones are keyed by identity of the original .iso image, by a canonical serialization
+of the modifications applied, and by the genisoimage options used.
+A clone with the same key is not made again,
+instead a hardlink to the cached clone is made at the requested path.
+
+As implemented works in Linux.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+from collections import namedtuple
+import errno
+import hashlib
+import json
+import os
+import os.path
+import shutil
+
+from nrvr.util.filecopy import FileCopy
+from nrvr.util.times import Timestamp
+
+class IsoImageCloneCacheStats(namedtuple("IsoImageCloneCacheStats",
+                                         ["hits", "misses", "uncacheable", "evictions",
+                                          "entries", "bytes", "maxBytes"])):
+    """Statistics of an IsoImageCloneCache.
+
+    hits, misses, uncacheable, evictions are counted since the IsoImageCloneCache instance has been made.
+
+    entries, bytes are of the cache directory on the host disk at the time of asking."""
+
+    __slots__ = ()
+
+class IsoImageCloneCache(object):
+    """A size-bounded cache of clones of .iso images, evicting least recently used clones first."""
+
+    def __init__(self, cacheDirectory, maxBytes=32 * 1024 * 1024 * 1024):
+        """Create new IsoImageCloneCache.
+
+        cacheDirectory
+            path of directory to keep clones in, made if it doesn't exist yet.
+            Should be on the same filesystem as clones, else copies rather than hardlinks are made.
+
+        maxBytes
+            maximum total size of clones kept."""
+        self._cacheDirectory = cacheDirectory
+        self._maxBytes = maxBytes
+        self._hits = 0
+        self._misses = 0
+        self._uncacheable = 0
+        self._evictions = 0
+        if not os.path.isdir(self._cacheDirectory):
+            os.makedirs(self._cacheDirectory, 0755)
+
+    @property
+    def cacheDirectory(self):
+        """Path of directory to keep clones in."""
+        return self._cacheDirectory
+
+    @property
+    def maxBytes(self):
+        """Maximum total size of clones kept."""
+        return self._maxBytes
+
+    @classmethod
+    def key(cls, isoImagePath, modifications, genisoimageOptions, udf=False, ignoreJoliet=True):
+        """Return a key for a clone, or None if any of the modifications cannot be serialized canonically.
+
+        The label given in genisoimageOptions by -V is not part of the key,
+        because as implemented in this package it is a timestamp unique to each clone."""
+        modificationSerializations = []
+        for modification in modifications:
+            modificationSerialization = modification.canonicalSerialization()
+            if modificationSerialization is None:
+                return None
+            modificationSerializations.append(modificationSerialization)
+        genisoimageOptions = list(genisoimageOptions)
+        for index in range(len(genisoimageOptions) - 1):
+            if genisoimageOptions[index] == "-V":
+                genisoimageOptions[index + 1] = ""
+        isoImageStat = os.stat(isoImagePath)
+        serialization = json.dumps({"isoImage": [os.path.realpath(isoImagePath),
+                                                 isoImageStat.st_size, int(isoImageStat.st_mtime)],
+                                    "modifications": modificationSerializations,
+                                    "genisoimageOptions": genisoimageOptions,
+                                    "udf": udf,
+                                    "ignoreJoliet": ignoreJoliet},
+                                   sort_keys=True)
+        return hashlib.sha256(serialization).hexdigest()
+
+    def _cachedPath(self, key):
+        """Auxiliary method."""
+        return os.path.join(self._cacheDirectory, key + ".iso")
+
+    def _usedPath(self, key):
+        """Auxiliary method, a marker file with time of last use as its modification time.
+
+        Separate from the cached clone, because touching a hardlink would touch all its clones."""
+        return os.path.join(self._cacheDirectory, key + ".used")
+
+    def _touch(self, key):
+        """Auxiliary method."""
+        with open(self._usedPath(key), "a"):
+            pass
+        os.utime(self._usedPath(key), None)
+
+    @classmethod
+    def _link(cls, fromPath, toPath):
+        """Auxiliary method, hardlink, else copy if on different filesystems."""
+        try:
+            os.link(fromPath, toPath)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            FileCopy.copyFile(fromPath, toPath)
+
+    def lookup(self, key, cloneIsoImagePath):
+        """If cached then make cloneIsoImagePath a hardlink to the cached clone.
+
+        return
+            whether cached."""
+        if key is None:
+            self._uncacheable += 1
+            return False
+        cachedPath = self._cachedPath(key)
+        try:
+            self._link(cachedPath, cloneIsoImagePath)
+        except (IOError, OSError) as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            self._misses += 1
+            return False
+        self._touch(key)
+        self._hits += 1
+        return True
+
+    def store(self, key, cloneIsoImagePath):
+        """Keep a hardlink to a newly made clone, then evict least recently used clones as needed."""
+        if key is None:
+            return
+        cachedPath = self._cachedPath(key)
+        temporaryPath = cachedPath + ".tmp" + Timestamp.microsecondTimestamp()
+        try:
+            self._link(cloneIsoImagePath, temporaryPath)
+            # atomic, in case another process has stored the same key meanwhile
+            os.rename(temporaryPath, cachedPath)
+        finally:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+        self._touch(key)
+        self.evict()
+
+    def _entries(self):
+        """Auxiliary method, return a list of (lastUsed, key, size), least recently used first."""
+        entries = []
+        for name in os.listdir(self._cacheDirectory):
+            if not name.endswith(".iso"):
+                continue
+            key = name[:-4]
+            try:
+                size = os.path.getsize(self._cachedPath(key))
+                if os.path.exists(self._usedPath(key)):
+                    lastUsed = os.path.getmtime(self._usedPath(key))
+                else:
+                    lastUsed = os.path.getmtime(self._cachedPath(key))
+            except OSError:
+                # removed meanwhile
+                continue
+            entries.append((lastUsed, key, size))
+        entries.sort()
+        return entries
+
+    def _remove(self, key):
+        """Auxiliary method."""
+        for path in [self._cachedPath(key), self._usedPath(key)]:
+            try:
+                os.remove(path)
+            except OSError as ex:
+                if ex.errno != errno.ENOENT:
+                    raise
+
+    def evict(self, maxBytes=None):
+        """Remove least recently used clones until total size is not more than maxBytes.
+
+        maxBytes
+            if None then as given when making this IsoImageCloneCache."""
+        if maxBytes is None:
+            maxBytes = self._maxBytes
+        entries = self._entries()
+        totalBytes = sum(size for lastUsed, key, size in entries)
+        for lastUsed, key, size in entries:
+            if totalBytes <= maxBytes:
+                break
+            self._remove(key)
+            totalBytes -= size
+            self._evictions += 1
+
+    def clear(self):
+        """Remove all cached clones."""
+        for lastUsed, key, size in self._entries():
+            self._remove(key)
+
+    def stats(self):
+        """Return an IsoImageCloneCacheStats."""
+        entries = self._entries()
+        return IsoImageCloneCacheStats(hits=self._hits,
+                                       misses=self._misses,
+                                       uncacheable=self._uncacheable,
+                                       evictions=self._evictions,
+                                       entries=len(entries),
+                                       bytes=sum(size for lastUsed, key, size in entries),
+                                       maxBytes=self._maxBytes)
+
+if __name__ == "__main__":
+    import tempfile
+    _testDir = os.path.join(tempfile.gettempdir(), Timestamp.microsecondTimestamp())
+    os.mkdir(_testDir, 0755)
+    try:
+        _cache = IsoImageCloneCache(os.path.join(_testDir, "cache"), maxBytes=10)
+        _clonePaths = []
+        for _index in range(3):
+            _clonePath = os.path.join(_testDir, "clone{0}.iso".format(_index))
+            with open(_clonePath, "w") as outputFile:
+                outputFile.write("clone" + str(_index))
+            _cache.store("key" + str(_index), _clonePath)
+        print _cache.stats()
+        print _cache.lookup("key2", os.path.join(_testDir, "again.iso"))
+        print _cache.lookup("key0", os.path.join(_testDir, "evicted.iso"))
+        print _cache.stats()
+    finally:
+        shutil.rmtree(_testDir)
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+
+"""nrvr.diskimage.eltorito - Read the El Torito boot catalog of an .iso disk image in-process
+
+Classes provided by this module include
+* ElToritoBootEntry
+* ElToritoBootCatalog
+
+The main class provided by this module is ElToritoBootCatalog.
+
+Reads the boot record volume descriptor and the boot catalog directly,
+without spawning any isoinfo subprocess.
+
+Understands the initial/default entry and any further section entries,
+e.g. for EFI.
+
+It should work in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+from collections import namedtuple
+import struct
+
+from nrvr.diskimage.iso9660 import Iso9660Reader
+
+class ElToritoBootEntry(namedtuple("ElToritoBootEntry",
+                                   ["platformId", "bootable", "mediaType", "loadSegment",
+                                    "systemType", "sectorCount", "loadRba"])):
+    """An entry in an El Torito boot catalog.
+
+    platformId
+        0 for x86 BIOS, 1 for PowerPC, 2 for Mac, 0xef for EFI.
+
+    bootable
+        whether marked bootable.
+
+    mediaType
+        0 for no emulation, 1 to 3 for floppy emulation, 4 for hard disk emulation.
+
+    loadSegment
+        segment to load into, 0 meaning default 0x7c0.
+
+    systemType
+        partition type of the boot image, for hard disk emulation.
+
+    sectorCount
+        number of 512-byte virtual sectors to load.
+
+    loadRba
+        2048-byte sector where the boot image starts in the .iso image."""
+
+    __slots__ = ()
+
+    _platformNames = {0x00: "x86", 0x01: "PowerPC", 0x02: "Mac", 0xef: "EFI"}
+
+    _floppyByteLengths = {1: 1228800, 2: 1474560, 3: 2949120}
+
+    @property
+    def platformName(self):
+        return ElToritoBootEntry._platformNames.get(self.platformId, "0x{0:02x}".format(self.platformId))
+
+    @property
+    def isEfi(self):
+        return self.platformId == 0xef
+
+    @property
+    def noEmulation(self):
+        return self.mediaType == 0
+
+    @property
+    def byteOffset(self):
+        """Where in the .iso image file the boot image starts."""
+        return self.loadRba * Iso9660Reader.sectorSize
+
+    @property
+    def byteLength(self):
+        """Length of the boot image as far as can be told from the boot catalog.
+
+        For floppy emulation the size of the floppy,
+        else the number of virtual sectors to load, which may be less than the boot image file,
+        e.g. for EFI often 0 or 1.
+        If knowing the file the boot image is in, better use its size."""
+        if self.mediaType in ElToritoBootEntry._floppyByteLengths:
+            return ElToritoBootEntry._floppyByteLengths[self.mediaType]
+        return self.sectorCount * 512
+
+class ElToritoBootCatalog(object):
+    """Reads the El Torito boot catalog of an .iso image."""
+
+    _elToritoIdentifier = "EL TORITO SPECIFICATION"
+
+    # upper limit, as a sanity check
+    _maxCatalogSectors = 16
+
+    def __init__(self, isoImagePath):
+        """Create new ElToritoBootCatalog.
+
+        Reads the boot catalog right away.
+
+        Raises an exception if the .iso image has no El Torito boot catalog.
+
+        isoImagePath
+            path of the .iso image."""
+        self._isoImagePath = isoImagePath
+        self._catalogSector = None
+        self._validationPlatformId = None
+        self._entries = []
+        self._read()
+
+    @property
+    def isoImagePath(self):
+        """Path of the .iso image."""
+        return self._isoImagePath
+
+    @property
+    def catalogSector(self):
+        """2048-byte sector where the boot catalog is in the .iso image."""
+        return self._catalogSector
+
+    @property
+    def entries(self):
+        """List of ElToritoBootEntry, the initial/default entry first."""
+        return list(self._entries)
+
+    @property
+    def defaultEntry(self):
+        """The initial/default ElToritoBootEntry."""
+        return self._entries[0]
+
+    def entriesForPlatform(self, platformId):
+        """Return list of ElToritoBootEntry for a platform, e.g. 0 for x86 BIOS or 0xef for EFI."""
+        return [entry for entry in self._entries if entry.platformId == platformId]
+
+    @property
+    def efiEntry(self):
+        """The first ElToritoBootEntry for EFI, or None if none."""
+        efiEntries = self.entriesForPlatform(0xef)
+        return efiEntries[0] if efiEntries else None
+
+    @classmethod
+    def hasBootCatalog(cls, isoImagePath):
+        """Return whether isoImagePath has an El Torito boot record volume descriptor."""
+        with open(isoImagePath, "rb") as imageFile:
+            return cls._findCatalogSector(imageFile) is not None
+
+    @classmethod
+    def _findCatalogSector(cls, imageFile):
+        """Auxiliary method, return sector of boot catalog or None."""
+        sector = Iso9660Reader.firstVolumeDescriptorSector
+        while True:
+            imageFile.seek(sector * Iso9660Reader.sectorSize)
+            descriptor = imageFile.read(Iso9660Reader.sectorSize)
+            if len(descriptor) < Iso9660Reader.sectorSize or descriptor[1:6] != "CD001":
+                return None
+            descriptorType = ord(descriptor[0])
+            if descriptorType == 255:
+                # terminator
+                return None
+            if descriptorType == 0 and descriptor[7:39].rstrip("\x00") == cls._elToritoIdentifier:
+                return struct.unpack_from("<I", descriptor, 71)[0]
+            sector += 1
+
+    @classmethod
+    def _entryFrom(cls, data, offset, platformId):
+        """Auxiliary method, parse a 32-byte initial/default entry or section entry."""
+        bootIndicator, mediaType, loadSegment, systemType, sectorCount, loadRba = \
+            struct.unpack_from("<BBHBxHI", data, offset)
+        return ElToritoBootEntry(platformId=platformId,
+                                 bootable=bootIndicator == 0x88,
+                                 mediaType=mediaType & 0x0f,
+                                 loadSegment=loadSegment,
+                                 systemType=systemType,
+                                 sectorCount=sectorCount,
+                                 loadRba=loadRba)
+
+    def _read(self):
+        """Auxiliary method, read boot catalog."""
+        with open(self._isoImagePath, "rb") as imageFile:
+            self._catalogSector = self._findCatalogSector(imageFile)
+            if self._catalogSector is None:
+                raise Exception("no El Torito boot record in {0}".format(self._isoImagePath))
+            imageFile.seek(self._catalogSector * Iso9660Reader.sectorSize)
+            data = imageFile.read(ElToritoBootCatalog._maxCatalogSectors * Iso9660Reader.sectorSize)
+        # validation entry
+        if len(data) < 64 or ord(data[0]) != 0x01 or data[30:32] != "\x55\xaa" \
+                or sum(struct.unpack_from("<16H", data, 0)) & 0xffff:
+            raise Exception("invalid El Torito boot catalog in {0}".format(self._isoImagePath))
+        self._validationPlatformId = ord(data[1])
+        # initial/default entry
+        self._entries.append(self._entryFrom(data, 32, self._validationPlatformId))
+        # section headers, each followed by its section entries
+        offset = 64
+        while offset + 32 <= len(data):
+            headerIndicator = ord(data[offset])
+            if headerIndicator not in (0x90, 0x91):
+                break
+            platformId = ord(data[offset + 1])
+            numberOfEntries = struct.unpack_from("<H", data, offset + 2)[0]
+            offset += 32
+            for _ in range(numberOfEntries):
+                if offset + 32 > len(data):
+                    break
+                self._entries.append(self._entryFrom(data, offset, platformId))
+                hasExtensions = ord(data[offset + 1]) & 0x20
+                offset += 32
+                # skip extension entries
+                while hasExtensions and offset + 32 <= len(data) and ord(data[offset]) == 0x44:
+                    hasExtensions = ord(data[offset + 1]) & 0x20
+                    offset += 32
+            if headerIndicator == 0x91:
+                # final
+                break
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        _catalog = ElToritoBootCatalog(sys.argv[1])
+        print "boot catalog in sector {0}".format(_catalog.catalogSector)
+        for _entry in _catalog.entries:
+            print "{0:<8} bootable {1:<5} media type {2} sector count {3:>5} load rba {4}".format(
+                _entry.platformName, _entry.bootable, _entry.mediaType, _entry.sectorCount, _entry.loadRba)
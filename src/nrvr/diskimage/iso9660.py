@@ -0,0 +1,609 @@
+#!/usr/bin/python
+
+"""nrvr.diskimage.iso9660 - Read an ISO 9660 .iso disk image in-process
+
+Classes provided by this module include
+* IsoImageEntry
+* IsoImageFile
+* Iso9660Reader
+
+The main class provided by this module is Iso9660Reader.
+
+Reads the volume descriptors and the directory records of an .iso image
+directly, without spawning any iso-info or iso-read subprocesses.
+
+Understands Rock Ridge names, symbolic links and relocated directories,
+Joliet names, and multi-extent files.
+
+It should work in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+from collections import namedtuple
+import mmap
+import os
+import os.path
+import struct
+
+from nrvr.util.filecopy import FileCopy
+
+class IsoImageEntry(namedtuple("IsoImageEntry",
+                               ["path", "isDirectory", "extents", "size", "symlinkTarget"])):
+    """An entry, i.e. a file or a directory or a symbolic link, in an .iso image.
+
+    path
+        relative path on the .iso image, without leading slash and without trailing slash.
+
+    isDirectory
+        whether a directory.
+
+    extents
+        a list of 2-tuples (byteOffset, byteLength), each locating a contiguous
+        range of bytes of the file's content within the .iso image file.
+        A byteOffset None means byteLength zeros, e.g. for a sparse extent in UDF.
+        Empty list for directories and for empty files.
+
+    size
+        size of the file's content in bytes.
+
+    symlinkTarget
+        if a symbolic link then its target, else None."""
+
+    __slots__ = ()
+
+    @property
+    def firstByteOffset(self):
+        """Where in the .iso image file content starts, or 0 if no content.
+
+        Useful for sorting in order to read front to back."""
+        for byteOffset, byteLength in self.extents:
+            if byteOffset is not None:
+                return byteOffset
+        return 0
+
+def copyExtents(inputFile, extents, outputFile, chunkSize=1048576):
+    """Copy content located by a list of extents from inputFile to outputFile.
+
+    inputFile
+        an open file object, seekable.
+
+    extents
+        a list of 2-tuples (byteOffset, byteLength).
+        A byteOffset None means byteLength zeros.
+
+    outputFile
+        an open file object.
+
+    Copies kernel-side if possible, see nrvr.util.filecopy."""
+    kernelSide = hasattr(inputFile, "fileno") and hasattr(outputFile, "fileno")
+    for byteOffset, byteLength in extents:
+        if byteOffset is None:
+            remainder = byteLength
+            while remainder > 0:
+                chunk = min(remainder, chunkSize)
+                outputFile.write("\x00" * chunk)
+                remainder -= chunk
+            continue
+        if kernelSide:
+            copied = FileCopy.copyFileObjectRange(inputFile, byteOffset, byteLength, outputFile)
+            if copied < byteLength:
+                raise IOError("unexpected end of image file at byte {0}".format(byteOffset + copied))
+            continue
+        inputFile.seek(byteOffset)
+        remainder = byteLength
+        while remainder > 0:
+            chunk = inputFile.read(min(remainder, chunkSize))
+            if not chunk:
+                raise IOError("unexpected end of image file at byte {0}".format(byteOffset + byteLength - remainder))
+            outputFile.write(chunk)
+            remainder -= len(chunk)
+
+class IsoImageFile(object):
+    """A read-only file object for content of a file in an .iso image, backed by mmap.
+
+    Reading doesn't copy more than requested, and doesn't spawn any subprocess.
+    Works for entries from Iso9660Reader and from nrvr.diskimage.udf.UdfReader."""
+
+    def __init__(self, isoImagePath, entry):
+        """Create new IsoImageFile.
+
+        isoImagePath
+            path of the .iso image.
+
+        entry
+            an IsoImageEntry, not a directory."""
+        if entry.isDirectory:
+            raise IOError("cannot open directory {0} in {1}".format(entry.path, isoImagePath))
+        self._entry = entry
+        self._position = 0
+        self._mmap = None
+        # offset in .iso image of start of mmap
+        self._mmapOffset = 0
+        extents = [(byteOffset, byteLength) for byteOffset, byteLength in entry.extents
+                   if byteOffset is not None and byteLength]
+        if extents:
+            # map only what covers the extents rather than the whole .iso image,
+            # e.g. because of limited address space of a 32-bit Python
+            windowStart = min(byteOffset for byteOffset, byteLength in extents)
+            windowStop = max(byteOffset + byteLength for byteOffset, byteLength in extents)
+            self._mmapOffset = windowStart - windowStart % mmap.ALLOCATIONGRANULARITY
+            with open(isoImagePath, "rb") as imageFile:
+                # mmap stays valid after closing the file
+                self._mmap = mmap.mmap(imageFile.fileno(), windowStop - self._mmapOffset,
+                                       access=mmap.ACCESS_READ, offset=self._mmapOffset)
+        self._closed = False
+
+    @property
+    def name(self):
+        """Path on the .iso image."""
+        return self._entry.path
+
+    @property
+    def size(self):
+        """Size in bytes."""
+        return self._entry.size
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+        self._closed = True
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _checkNotClosed(self):
+        """Auxiliary method."""
+        if self._closed:
+            raise ValueError("I/O operation on closed file")
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self._checkNotClosed()
+        if whence == os.SEEK_CUR:
+            offset += self._position
+        elif whence == os.SEEK_END:
+            offset += self._entry.size
+        if offset < 0:
+            raise IOError("invalid seek to {0} in {1}".format(offset, self._entry.path))
+        self._position = offset
+
+    def tell(self):
+        self._checkNotClosed()
+        return self._position
+
+    def read(self, size=-1):
+        self._checkNotClosed()
+        remainder = self._entry.size - self._position
+        if size is not None and size >= 0:
+            remainder = min(remainder, size)
+        if remainder <= 0:
+            return ""
+        parts = []
+        extentStart = 0
+        for byteOffset, byteLength in self._entry.extents:
+            extentStop = extentStart + byteLength
+            if self._position < extentStop:
+                offsetInExtent = self._position - extentStart
+                chunk = min(byteLength - offsetInExtent, remainder)
+                if byteOffset is None:
+                    parts.append("\x00" * chunk)
+                else:
+                    mmapStart = byteOffset - self._mmapOffset + offsetInExtent
+                    parts.append(self._mmap[mmapStart:mmapStart + chunk])
+                self._position += chunk
+                remainder -= chunk
+                if not remainder:
+                    break
+            extentStart = extentStop
+        return "".join(parts)
+
+    def readline(self, size=-1):
+        self._checkNotClosed()
+        parts = []
+        length = 0
+        while size is None or size < 0 or length < size:
+            chunkSize = 4096 if size is None or size < 0 else min(4096, size - length)
+            chunk = self.read(chunkSize)
+            if not chunk:
+                break
+            newline = chunk.find("\n")
+            if newline != -1:
+                # give back what is after the newline
+                self._position -= len(chunk) - newline - 1
+                chunk = chunk[:newline + 1]
+                parts.append(chunk)
+                break
+            parts.append(chunk)
+            length += len(chunk)
+        return "".join(parts)
+
+    def readlines(self):
+        return list(self)
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        line = self.readline()
+        if not line:
+            raise StopIteration
+        return line
+
+class Iso9660Reader(object):
+    """Reads the directory structure of an ISO 9660 .iso image in-process."""
+
+    sectorSize = 2048
+    firstVolumeDescriptorSector = 16
+
+    # volume descriptor types
+    _bootRecordType = 0
+    _primaryVolumeDescriptorType = 1
+    _supplementaryVolumeDescriptorType = 2
+    _volumeDescriptorSetTerminatorType = 255
+
+    # escape sequences in a supplementary volume descriptor that identify Joliet
+    _jolietEscapeSequences = ["%/@", "%/C", "%/E"]
+
+    # directory record file flags
+    _flagHidden = 0x01
+    _flagDirectory = 0x02
+    _flagMultiExtent = 0x80
+
+    def __init__(self, isoImagePath, ignoreJoliet=True):
+        """Create new Iso9660Reader.
+
+        Reads the volume descriptors right away.
+        Reads the directory records when first needed.
+
+        isoImagePath
+            path of the .iso image.
+
+        ignoreJoliet
+            whether to ignore a Joliet directory tree even if there is one.
+            If there is Rock Ridge information then it is used in any case
+            for the primary directory tree."""
+        self._isoImagePath = isoImagePath
+        self._ignoreJoliet = ignoreJoliet
+        self._logicalBlockSize = Iso9660Reader.sectorSize
+        self._volumeIdentifier = None
+        self._volumeSpaceSize = None
+        self._primaryRootRecord = None
+        self._jolietRootRecord = None
+        self._bootRecordSectors = []
+        self._suspSkip = None
+        self._entries = None
+        self._readVolumeDescriptors()
+
+    @property
+    def isoImagePath(self):
+        """Path of the .iso image."""
+        return self._isoImagePath
+
+    @property
+    def volumeIdentifier(self):
+        """Volume identifier, aka label, from the primary volume descriptor."""
+        return self._volumeIdentifier
+
+    @property
+    def volumeSpaceSize(self):
+        """Number of logical blocks in the volume."""
+        return self._volumeSpaceSize
+
+    @property
+    def logicalBlockSize(self):
+        """Logical block size in bytes, normally 2048."""
+        return self._logicalBlockSize
+
+    @property
+    def hasJoliet(self):
+        """Whether there is a Joliet directory tree."""
+        return self._jolietRootRecord is not None
+
+    @property
+    def usesJoliet(self):
+        """Whether the Joliet directory tree is used for names."""
+        return self.hasJoliet and not self._ignoreJoliet
+
+    @property
+    def hasRockRidge(self):
+        """Whether the primary directory tree has Rock Ridge information."""
+        return self._suspSkip is not None
+
+    @property
+    def bootRecordSectors(self):
+        """List of sector numbers of boot record volume descriptors, e.g. for El Torito."""
+        return list(self._bootRecordSectors)
+
+    @classmethod
+    def _bothEndian32(cls, data, offset):
+        """Auxiliary method, little-endian half of a both-byte orders 32-bit number."""
+        return struct.unpack_from("<I", data, offset)[0]
+
+    @classmethod
+    def _bothEndian16(cls, data, offset):
+        """Auxiliary method, little-endian half of a both-byte orders 16-bit number."""
+        return struct.unpack_from("<H", data, offset)[0]
+
+    def _readAt(self, imageFile, byteOffset, byteLength):
+        """Auxiliary method, read exactly, or raise an exception."""
+        imageFile.seek(byteOffset)
+        data = imageFile.read(byteLength)
+        if len(data) != byteLength:
+            raise Exception("unexpected end of {0} reading {1} bytes at byte {2}".format(self._isoImagePath, byteLength, byteOffset))
+        return data
+
+    def _readVolumeDescriptors(self):
+        """Auxiliary method, called by constructor."""
+        with open(self._isoImagePath, "rb") as imageFile:
+            sector = Iso9660Reader.firstVolumeDescriptorSector
+            while True:
+                descriptor = self._readAt(imageFile, sector * Iso9660Reader.sectorSize, Iso9660Reader.sectorSize)
+                descriptorType = ord(descriptor[0])
+                if descriptor[1:6] != "CD001":
+                    raise Exception("not an ISO 9660 volume descriptor in sector {0} of {1}".format(sector, self._isoImagePath))
+                if descriptorType == Iso9660Reader._primaryVolumeDescriptorType:
+                    if self._primaryRootRecord is None:
+                        self._volumeIdentifier = descriptor[40:72].rstrip(" \x00")
+                        self._volumeSpaceSize = self._bothEndian32(descriptor, 80)
+                        self._logicalBlockSize = self._bothEndian16(descriptor, 128)
+                        self._primaryRootRecord = descriptor[156:190]
+                elif descriptorType == Iso9660Reader._supplementaryVolumeDescriptorType:
+                    escapeSequences = descriptor[88:120]
+                    for jolietEscapeSequence in Iso9660Reader._jolietEscapeSequences:
+                        if escapeSequences.startswith(jolietEscapeSequence):
+                            self._jolietRootRecord = descriptor[156:190]
+                            break
+                elif descriptorType == Iso9660Reader._bootRecordType:
+                    self._bootRecordSectors.append(sector)
+                elif descriptorType == Iso9660Reader._volumeDescriptorSetTerminatorType:
+                    break
+                sector += 1
+            if self._primaryRootRecord is None:
+                raise Exception("no primary volume descriptor in {0}".format(self._isoImagePath))
+            # check for SUSP and hence Rock Ridge in the first record of the root directory
+            rootLocation = self._bothEndian32(self._primaryRootRecord, 2)
+            rootFirstSector = self._readAt(imageFile, rootLocation * self._logicalBlockSize, Iso9660Reader.sectorSize)
+            rootSelfRecordLength = ord(rootFirstSector[0])
+            rootSelfSystemUse = rootFirstSector[34:rootSelfRecordLength]
+            if rootSelfSystemUse[0:2] == "SP" and rootSelfSystemUse[4:6] == "\xbe\xef":
+                self._suspSkip = ord(rootSelfSystemUse[6])
+
+    def _directoryRecords(self, imageFile, location, dataLength):
+        """Auxiliary method, yield each directory record of a directory as a string.
+
+        Skips the records for . and .. (self and parent)."""
+        data = self._readAt(imageFile, location * self._logicalBlockSize, dataLength)
+        offset = 0
+        while offset < dataLength:
+            recordLength = ord(data[offset])
+            if recordLength == 0:
+                # records don't cross sector boundaries, skip padding to next sector
+                offset = (offset // Iso9660Reader.sectorSize + 1) * Iso9660Reader.sectorSize
+                continue
+            record = data[offset:offset + recordLength]
+            offset += recordLength
+            nameLength = ord(record[32])
+            if nameLength == 1 and record[33] in ("\x00", "\x01"):
+                # self or parent
+                continue
+            yield record
+
+    def _systemUseEntries(self, imageFile, record):
+        """Auxiliary method, yield each SUSP entry as a 2-tuple (signature, data)."""
+        nameLength = ord(record[32])
+        systemUseStart = 33 + nameLength + (1 if nameLength % 2 == 0 else 0) + self._suspSkip
+        area = record[systemUseStart:]
+        # guard against loops of continuation areas
+        continuations = 0
+        while area:
+            continuation = None
+            offset = 0
+            while offset + 4 <= len(area):
+                signature = area[offset:offset + 2]
+                entryLength = ord(area[offset + 2])
+                if entryLength < 4:
+                    break
+                entryData = area[offset + 4:offset + entryLength]
+                offset += entryLength
+                if signature == "CE":
+                    continuation = (self._bothEndian32(entryData, 0),
+                                    self._bothEndian32(entryData, 8),
+                                    self._bothEndian32(entryData, 16))
+                elif signature == "ST":
+                    break
+                else:
+                    yield signature, entryData
+            area = None
+            if continuation and continuations < 64:
+                continuations += 1
+                continuationLocation, continuationOffset, continuationLength = continuation
+                area = self._readAt(imageFile,
+                                    continuationLocation * self._logicalBlockSize + continuationOffset,
+                                    continuationLength)
+
+    @classmethod
+    def _translatedName(cls, name):
+        """Auxiliary method, translate a plain ISO 9660 name like iso-info does.
+
+        Removes version number ;1 and a trailing dot, and makes lowercase."""
+        semicolon = name.rfind(";")
+        if semicolon != -1:
+            name = name[:semicolon]
+        if name.endswith("."):
+            name = name[:-1]
+        return name.lower()
+
+    @classmethod
+    def _version(cls, name):
+        """Auxiliary method, return version number after ; in a name, 0 if none."""
+        semicolon = name.rfind(";")
+        if semicolon == -1:
+            return 0
+        try:
+            return int(name[semicolon + 1:].replace("\x00", ""))
+        except ValueError:
+            return 0
+
+    @classmethod
+    def _jolietName(cls, name):
+        """Auxiliary method, decode a Joliet name into a UTF-8 string."""
+        name = name.decode("utf-16-be", "replace")
+        semicolon = name.rfind(u";")
+        if semicolon != -1:
+            name = name[:semicolon]
+        return name.encode("utf-8")
+
+    def _walk(self, imageFile, rootRecord, joliet):
+        """Auxiliary method, return a list of IsoImageEntry for a directory tree."""
+        entries = []
+        # by path, for merging multi-extent files, and for keeping only the highest version
+        filesByPath = {}
+        # by path, whether the most recent record has flag multi-extent, i.e. is continued
+        continuedByPath = {}
+        # by path, version number of file kept
+        versionByPath = {}
+        useRockRidge = not joliet and self._suspSkip is not None
+        directoriesToDo = [("", self._bothEndian32(rootRecord, 2), self._bothEndian32(rootRecord, 10))]
+        # guard against loops in a damaged image
+        directoriesSeen = set()
+        while directoriesToDo:
+            directoryPath, directoryLocation, directoryLength = directoriesToDo.pop(0)
+            if directoryLocation in directoriesSeen:
+                continue
+            directoriesSeen.add(directoryLocation)
+            for record in self._directoryRecords(imageFile, directoryLocation, directoryLength):
+                location = self._bothEndian32(record, 2)
+                dataLength = self._bothEndian32(record, 10)
+                flags = ord(record[25])
+                nameLength = ord(record[32])
+                rawName = record[33:33 + nameLength]
+                isDirectory = bool(flags & Iso9660Reader._flagDirectory)
+                name = None
+                symlinkTarget = None
+                relocated = False
+                if useRockRidge:
+                    nameParts = []
+                    symlinkParts = []
+                    symlinkComponent = ""
+                    for signature, entryData in self._systemUseEntries(imageFile, record):
+                        if signature == "NM" and entryData:
+                            nameFlags = ord(entryData[0])
+                            if nameFlags & 0x06:
+                                # current or parent, not expected here
+                                continue
+                            nameParts.append(entryData[1:])
+                        elif signature == "SL" and entryData:
+                            symlinkTarget = ""
+                            offset = 1
+                            while offset + 2 <= len(entryData):
+                                componentFlags = ord(entryData[offset])
+                                componentLength = ord(entryData[offset + 1])
+                                componentContent = entryData[offset + 2:offset + 2 + componentLength]
+                                offset += 2 + componentLength
+                                if componentFlags & 0x02:
+                                    componentContent = "."
+                                elif componentFlags & 0x04:
+                                    componentContent = ".."
+                                elif componentFlags & 0x08:
+                                    # root
+                                    symlinkParts.append("")
+                                    continue
+                                symlinkComponent += componentContent
+                                if not componentFlags & 0x01:
+                                    # component complete
+                                    symlinkParts.append(symlinkComponent)
+                                    symlinkComponent = ""
+                        elif signature == "CL" and entryData:
+                            # child link, a directory relocated elsewhere, e.g. into rr_moved
+                            isDirectory = True
+                            location = self._bothEndian32(entryData, 0)
+                            relocatedSelf = self._readAt(imageFile, location * self._logicalBlockSize, 34)
+                            dataLength = self._bothEndian32(relocatedSelf, 10)
+                        elif signature == "RE":
+                            # this is the relocated directory itself, appears via its child link
+                            relocated = True
+                    if relocated:
+                        continue
+                    if nameParts:
+                        name = "".join(nameParts)
+                    if symlinkParts:
+                        if symlinkParts == [""]:
+                            symlinkTarget = "/"
+                        else:
+                            symlinkTarget = "/".join(symlinkParts)
+                if name is None:
+                    if joliet:
+                        name = self._jolietName(rawName)
+                    else:
+                        name = self._translatedName(rawName)
+                path = directoryPath + "/" + name if directoryPath else name
+                if isDirectory:
+                    entries.append(IsoImageEntry(path=path, isDirectory=True, extents=[], size=0,
+                                                 symlinkTarget=None))
+                    directoriesToDo.append((path, location, dataLength))
+                    continue
+                byteOffset = location * self._logicalBlockSize
+                continued = bool(flags & Iso9660Reader._flagMultiExtent)
+                version = self._version(rawName)
+                if path in filesByPath:
+                    index = filesByPath[path]
+                    if continuedByPath[path] and version == versionByPath[path]:
+                        # continuation of a multi-extent file
+                        previous = entries[index]
+                        extents = previous.extents + ([(byteOffset, dataLength)] if dataLength else [])
+                        entries[index] = previous._replace(extents=extents, size=previous.size + dataLength)
+                        continuedByPath[path] = continued
+                        continue
+                    if version <= versionByPath[path]:
+                        # another version of a file, keep only the highest version, as iso-read does
+                        continuedByPath[path] = False
+                        continue
+                if symlinkTarget is not None:
+                    extents = []
+                    dataLength = 0
+                else:
+                    extents = [(byteOffset, dataLength)] if dataLength else []
+                entry = IsoImageEntry(path=path, isDirectory=False, extents=extents, size=dataLength,
+                                      symlinkTarget=symlinkTarget)
+                if path in filesByPath:
+                    # a higher version replaces a lower version
+                    entries[filesByPath[path]] = entry
+                else:
+                    filesByPath[path] = len(entries)
+                    entries.append(entry)
+                continuedByPath[path] = continued
+                versionByPath[path] = version
+        return entries
+
+    def entries(self):
+        """Return a list of IsoImageEntry, for all directories and files.
+
+        Directories are listed before their contents."""
+        if self._entries is None:
+            with open(self._isoImagePath, "rb") as imageFile:
+                if self.usesJoliet:
+                    self._entries = self._walk(imageFile, self._jolietRootRecord, joliet=True)
+                else:
+                    self._entries = self._walk(imageFile, self._primaryRootRecord, joliet=False)
+        return list(self._entries)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        _reader = Iso9660Reader(sys.argv[1])
+        print "volume identifier " + _reader.volumeIdentifier
+        print "Rock Ridge " + str(_reader.hasRockRidge) + ", Joliet " + str(_reader.hasJoliet)
+        for _entry in _reader.entries():
+            print "{0:>12} {1}{2}".format(_entry.size, _entry.path, "/" if _entry.isDirectory else "")
@@ -9,9 +9,18 @@ Implemented subclasses of IsoImageModification are
 * IsoImageModificationFromPath
 * IsoImageModificationByReplacement
 * IsoImageModificationFromByteRange
+* IsoImageModificationRemoval
+
+Before cloning, modifications are planned by IsoImageModificationPlan,
+which drops writes overwritten by later modifications,
+coalesces modifications of the same file into one read/write pass,
+and validates target paths before any expensive work starts.
 
 As implemented works in Linux.
-As implemented requires mount, umount, iso-info, iso-read, genisoimage commands.
+As implemented requires mount, umount, genisoimage commands.
+Alternatively can write a new .iso image without genisoimage by means of nrvr.diskimage.remaster.
+Reads .iso images in-process by means of nrvr.diskimage.iso9660 and nrvr.diskimage.udf.
+Only the older method copyToDirectoryUsingIsoRead requires iso-info, iso-read commands.
 Nevertheless essential.  To be improved as needed.
 
 Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
@@ -24,12 +33,25 @@ Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
 import codecs
+import errno
+import hashlib
+import marshal
 import os
 import os.path
+import Queue
 import re
 import shutil
+import sys
+import threading
 
+from nrvr.diskimage.clonecache import IsoImageCloneCache
+from nrvr.diskimage.eltorito import ElToritoBootCatalog
+from nrvr.diskimage.iso9660 import IsoImageEntry, IsoImageFile, Iso9660Reader, copyExtents
+from nrvr.diskimage.remaster import IsoRemaster
+from nrvr.diskimage.udf import UdfReader
 from nrvr.process.commandcapture import CommandCapture
+from nrvr.process.commandmemo import CommandMemo
+from nrvr.util.filecopy import FileCopy
 from nrvr.util.requirements import SystemRequirements
 from nrvr.util.times import Timestamp
 
@@ -42,7 +64,6 @@ class IsoImage(object):
         
         This class can be passed to SystemRequirements.commandsRequiredByImplementations()."""
         return ["mount", "umount",
-                "iso-info", "iso-read",
                 (["genisoimage"], ["mkisofs"])]
 
     def __init__(self, isoImagePath):
@@ -93,6 +114,67 @@ class IsoImage(object):
     def copyToDirectory(self, copyDirectory, udf=False, ignoreJoliet=True, tolerance=0.0):
         """Copy all files into a directory.
         
+        Reads the .iso image in-process, in one pass front to back,
+        writing files in the order their content is located in the .iso image.
+        
+        Not using mount command, no need to run as root."""
+        # as of 2013-09-29 given known uses of this package and known bugs of iso-info
+        # it appears better to default to ignoreJoliet=True
+        # see https://savannah.gnu.org/bugs/?40130
+        # see https://savannah.gnu.org/bugs/?40138
+        #
+        # really want abspath and expanduser
+        copyDirectory = os.path.abspath(os.path.expanduser(copyDirectory))
+        # make sure not merging with pre-existing directory or files
+        if os.path.exists(copyDirectory):
+            shutil.rmtree(copyDirectory)
+        # make directory
+        os.mkdir(copyDirectory, 0755)
+        if not udf: # iso9660
+            entries = Iso9660Reader(self._isoImagePath, ignoreJoliet=ignoreJoliet).entries()
+        else: # udf
+            entries = UdfReader(self._isoImagePath).entries()
+        # sorting matters to allow building a tree of directories
+        directories = sorted(entry.path for entry in entries if entry.isDirectory)
+        # make directories
+        for relativePathOnIso in directories:
+            pathOnHost = os.path.join(copyDirectory, relativePathOnIso)
+            os.mkdir(pathOnHost, 0755)
+        # sorting by location in .iso image to read front to back
+        files = sorted((entry for entry in entries if not entry.isDirectory),
+                       key=lambda entry: entry.firstByteOffset)
+        # tolerate some defects
+        readAttemptCount = 0
+        readSuccessCount = 0
+        # copy files
+        with open(self._isoImagePath, "rb") as inputFile:
+            for entry in files:
+                pathOnHost = os.path.join(copyDirectory, entry.path)
+                # copy file
+                try:
+                    readAttemptCount += 1
+                    if entry.symlinkTarget is not None:
+                        os.symlink(entry.symlinkTarget, pathOnHost)
+                    else:
+                        with open(pathOnHost, "wb") as outputFile:
+                            copyExtents(inputFile, entry.extents, outputFile)
+                    readSuccessCount += 1
+                except Exception as ex:
+                    print ex
+        # check tolerance
+        readFailureCount = readAttemptCount - readSuccessCount
+        if readFailureCount > readAttemptCount * tolerance:
+            raise Exception("too many ({0} of {1}) failures reading {2}".format(readFailureCount, readAttemptCount, self._isoImagePath))
+        elif readFailureCount:
+            print "continuing despite some ({0} of {1}) failures reading {2}".format(readFailureCount, readAttemptCount, self._isoImagePath)
+        return copyDirectory
+
+    def copyToDirectoryUsingIsoRead(self, copyDirectory, udf=False, ignoreJoliet=True, tolerance=0.0):
+        """Copy all files into a directory.
+        
+        This is an older implementation which runs one iso-read subprocess per file.
+        It is still here in case a newer implementation doesn't work right.
+        
         Not using mount command, no need to run as root."""
         # as of 2013-09-29 given known uses of this package and known bugs of iso-info
         # it appears better to default to ignoreJoliet=True
@@ -111,14 +193,15 @@ class IsoImage(object):
             isoInfoLArgs = ["iso-info", "-i", self._isoImagePath, "-l"]
             if ignoreJoliet:
                 isoInfoLArgs.insert(1, "--no-joliet")
-            isoInfoL = CommandCapture(isoInfoLArgs, copyToStdio=False)
+            # listings of a given .iso image are memoized if CommandMemo is enabled
+            isoInfoL = CommandMemo.capture(isoInfoLArgs, inputPaths=[self._isoImagePath], copyToStdio=False)
             # directories without leading slash and without trailing slash
             directories = re.findall(r"(?m)^[ \t]*/(.+?)/?[ \t]*:[ \t]*$", isoInfoL.stdout)
             # get files info in a reasonably parsable list
             isoInfoFArgs = ["iso-info", "-i", self._isoImagePath, "-f"]
             if ignoreJoliet:
                 isoInfoFArgs.insert(1, "--no-joliet")
-            isoInfoF = CommandCapture(isoInfoFArgs, copyToStdio=False)
+            isoInfoF = CommandMemo.capture(isoInfoFArgs, inputPaths=[self._isoImagePath], copyToStdio=False)
             # files without leading slash and without trailing slash
             files = re.findall(r"(?m)^[ \t]*[0-9]*[ \t]+/(.+?)/?[ \t]*$", isoInfoF.stdout)
         else: # udf
@@ -130,7 +213,7 @@ class IsoImage(object):
             isoInfoUArgs = ["iso-info", self._isoImagePath, "-U"]
             if ignoreJoliet:
                 isoInfoUArgs.insert(1, "--no-joliet")
-            isoInfoU = CommandCapture(isoInfoUArgs, copyToStdio=False)
+            isoInfoU = CommandMemo.capture(isoInfoUArgs, inputPaths=[self._isoImagePath], copyToStdio=False)
             # list below excluded line 123456 /.
             isoInfoUList = re.search(r"(?s)[ \t]*[0-9]+[ \t]+/\.\s*\n(.*)", isoInfoU.stdout).group(1)
             # directories without leading slash and without trailing slash
@@ -173,8 +256,325 @@ class IsoImage(object):
             print "continuing despite some ({0} of {1}) failures reading {2}".format(readFailureCount, readAttemptCount, self._isoImagePath)
         return copyDirectory
 
+    def persistentExtractionDirectory(self, udf=False, ignoreJoliet=True):
+        """Path of a directory for a persistent extraction of all files.
+        
+        Next to the .iso image, named by identity of the .iso image, i.e. size and modification time,
+        and by how extracted, i.e. udf and ignoreJoliet.
+        
+        The directory may or may not exist yet."""
+        return os.path.join(self._isoImagePath + ".extracted", self._identity(udf=udf, ignoreJoliet=ignoreJoliet))
+
+    def _identity(self, udf=False, ignoreJoliet=True):
+        """Auxiliary method, identity of the .iso image, i.e. size and modification time,
+        and how read, i.e. udf and ignoreJoliet."""
+        isoImageStat = os.stat(self._isoImagePath)
+        if not udf: # iso9660
+            readingKind = "iso9660" if ignoreJoliet else "joliet"
+        else: # udf
+            readingKind = "udf"
+        return "{0}-{1}-{2}".format(isoImageStat.st_size, int(isoImageStat.st_mtime), readingKind)
+
+    def persistentExtraction(self, udf=False, ignoreJoliet=True, usingMount=False):
+        """Return path of a persistent extraction of all files, extracting first if necessary.
+        
+        Once extracted, later clones made with persistentExtraction=True can be assembled
+        by linking to files in the persistent extraction, rather than by extracting again.
+        
+        Any persistent extractions for a previous .iso image at the same path are removed.
+        
+        usingMount
+            whether to extract by mount command, which requires having superuser privileges.
+        
+        return
+            path of directory, which should be treated as read-only."""
+        persistentExtractionDirectory = self.persistentExtractionDirectory(udf=udf, ignoreJoliet=ignoreJoliet)
+        if os.path.isdir(persistentExtractionDirectory):
+            return persistentExtractionDirectory
+        extractionsDirectory = os.path.dirname(persistentExtractionDirectory)
+        if not os.path.exists(extractionsDirectory):
+            os.mkdir(extractionsDirectory, 0755)
+        # remove stale extractions of a previous .iso image at the same path
+        isoImageIdentityPrefix = "-".join(os.path.basename(persistentExtractionDirectory).split("-")[:2]) + "-"
+        for otherName in os.listdir(extractionsDirectory):
+            if not otherName.startswith(isoImageIdentityPrefix) and not ".tmp" in otherName:
+                shutil.rmtree(os.path.join(extractionsDirectory, otherName), ignore_errors=True)
+        # extract into a temporary directory and rename when complete,
+        # so an interrupted extraction or a concurrent process never sees an incomplete one
+        temporaryExtractionDirectory = persistentExtractionDirectory + ".tmp" + Timestamp.microsecondTimestamp()
+        try:
+            print "copying files from {0} for persistent extraction, this may take a few minutes".format(self._isoImagePath)
+            if not usingMount:
+                self.copyToDirectory(temporaryExtractionDirectory, udf=udf, ignoreJoliet=ignoreJoliet)
+            else:
+                temporaryMountDirectory = temporaryExtractionDirectory + ".mnt"
+                os.mkdir(temporaryMountDirectory, 0755)
+                try:
+                    self.mount(temporaryMountDirectory, udf=udf)
+                    FileCopy.copyTree(temporaryMountDirectory, temporaryExtractionDirectory, symlinks=True)
+                finally:
+                    self.unmount()
+                    os.rmdir(temporaryMountDirectory)
+            try:
+                os.rename(temporaryExtractionDirectory, persistentExtractionDirectory)
+            except OSError:
+                if not os.path.isdir(persistentExtractionDirectory):
+                    raise
+                # another process has completed the same extraction first, use that one
+        finally:
+            shutil.rmtree(temporaryExtractionDirectory, ignore_errors=True)
+        return persistentExtractionDirectory
+
+    def removePersistentExtractions(self):
+        """Remove any persistent extractions of this .iso image from the host disk."""
+        shutil.rmtree(self._isoImagePath + ".extracted", ignore_errors=True)
+
+    # in this process, by path and identity, dictionaries of paths to IsoImageEntry
+    _directoryIndexes = {}
+
+    # increment if format of persisted directory index changes
+    _directoryIndexFormat = 1
+
+    def _directoryIndex(self, udf=False, ignoreJoliet=True):
+        """Auxiliary method, return a dictionary with "label" and "entries",
+        the latter being a list of IsoImageEntry, directories before their contents.
+        
+        Cached in this process, and persisted next to the .iso image, keyed by identity of the .iso image.
+        Persisting is skipped if the directory of the .iso image isn't writable."""
+        identity = self._identity(udf=udf, ignoreJoliet=ignoreJoliet)
+        inProcessKey = (os.path.abspath(self._isoImagePath), identity)
+        directoryIndex = IsoImage._directoryIndexes.get(inProcessKey)
+        if directoryIndex is not None:
+            return directoryIndex
+        indexesDirectory = self._isoImagePath + ".index"
+        indexPath = os.path.join(indexesDirectory, "{0}-v{1}".format(identity, IsoImage._directoryIndexFormat))
+        try:
+            with open(indexPath, "rb") as indexFile:
+                persisted = marshal.load(indexFile)
+            directoryIndex = {"label": persisted["label"],
+                              "entries": [IsoImageEntry(*fields) for fields in persisted["entries"]]}
+        except (IOError, OSError, EOFError, ValueError, TypeError, KeyError):
+            directoryIndex = None
+        if directoryIndex is None:
+            if not udf: # iso9660
+                reader = Iso9660Reader(self._isoImagePath, ignoreJoliet=ignoreJoliet)
+                label = reader.volumeIdentifier
+            else: # udf
+                reader = UdfReader(self._isoImagePath)
+                label = reader.logicalVolumeIdentifier
+            directoryIndex = {"label": label, "entries": reader.entries()}
+            try:
+                if not os.path.exists(indexesDirectory):
+                    os.mkdir(indexesDirectory, 0755)
+                # remove stale indexes of a previous .iso image at the same path
+                isoImageIdentityPrefix = "-".join(identity.split("-")[:2]) + "-"
+                for otherName in os.listdir(indexesDirectory):
+                    if not otherName.startswith(isoImageIdentityPrefix):
+                        os.remove(os.path.join(indexesDirectory, otherName))
+                temporaryIndexPath = indexPath + ".tmp" + Timestamp.microsecondTimestamp()
+                with open(temporaryIndexPath, "wb") as indexFile:
+                    marshal.dump({"label": label,
+                                  "entries": [tuple(entry) for entry in directoryIndex["entries"]]},
+                                 indexFile)
+                os.rename(temporaryIndexPath, indexPath)
+            except (IOError, OSError):
+                # e.g. directory not writable, still works, only slower next time
+                pass
+        directoryIndex["entriesByPath"] = dict((entry.path, entry) for entry in directoryIndex["entries"])
+        IsoImage._directoryIndexes[inProcessKey] = directoryIndex
+        return directoryIndex
+
+    def listing(self, udf=False, ignoreJoliet=True):
+        """Return a list of IsoImageEntry, directories before their contents.
+        
+        Read without spawning any subprocess,
+        and after the first time from a directory index persisted next to the .iso image."""
+        return list(self._directoryIndex(udf=udf, ignoreJoliet=ignoreJoliet)["entries"])
+
+    def entry(self, pathOnIso, udf=False, ignoreJoliet=True):
+        """Return IsoImageEntry for pathOnIso, or None if no such file or directory."""
+        # remove any leading and trailing slashes in order to make it relative
+        relativePathOnIso = re.sub(r"^/*(.*?)/*$", r"\g<1>", pathOnIso)
+        return self._directoryIndex(udf=udf, ignoreJoliet=ignoreJoliet)["entriesByPath"].get(relativePathOnIso)
+
+    def open(self, pathOnIso, udf=False, ignoreJoliet=True):
+        """Return a read-only file object for a file in the .iso image.
+        
+        An nrvr.diskimage.iso9660.IsoImageFile, backed by mmap.
+        Follows symbolic links within the .iso image.
+        
+        Raises IOError if no such file."""
+        entry = self.entry(pathOnIso, udf=udf, ignoreJoliet=ignoreJoliet)
+        # follow symbolic links, but not forever
+        for _ in range(40):
+            if entry is None or entry.symlinkTarget is None:
+                break
+            targetPath = os.path.normpath(os.path.join("/" + os.path.dirname(entry.path), entry.symlinkTarget))
+            entry = self.entry(targetPath, udf=udf, ignoreJoliet=ignoreJoliet)
+        if entry is None or entry.symlinkTarget is not None:
+            raise IOError(errno.ENOENT, "no such file {0} in {1}".format(pathOnIso, self._isoImagePath))
+        return IsoImageFile(self._isoImagePath, entry)
+
+    def label(self, udf=False):
+        """Return volume label, i.e. volume identifier, or for udf logical volume identifier."""
+        return self._directoryIndex(udf=udf)["label"]
+
+    def elToritoBootCatalog(self):
+        """Return an nrvr.diskimage.eltorito.ElToritoBootCatalog, which has all boot entries, e.g. for EFI.
+        
+        Raises an exception if the .iso image has no El Torito boot catalog."""
+        return ElToritoBootCatalog(self._isoImagePath)
+
+    @classmethod
+    def _linkFile(cls, fromPath, toPath, reflink=True):
+        """Auxiliary method, make toPath share content with fromPath.
+        
+        Prefers a reflink, i.e. a copy-on-write clone, if the filesystem supports it,
+        else a hardlink, else a copy if on different filesystems.
+        
+        Return whether reflinked, which if False indicates not to bother trying for other files."""
+        if reflink and FileCopy.reflink(fromPath, toPath):
+            return True
+        try:
+            os.link(fromPath, toPath)
+        except OSError as ex:
+            if ex.errno != errno.EXDEV:
+                raise
+            FileCopy.copyFile(fromPath, toPath)
+        return False
+
+    @classmethod
+    def _linkTree(cls, fromDirectory, toDirectory):
+        """Auxiliary method, make a tree of directories with files sharing content with fromDirectory."""
+        os.mkdir(toDirectory, 0755)
+        reflink = True
+        for fromTop, directoryNames, fileNames in os.walk(fromDirectory):
+            toTop = os.path.join(toDirectory, os.path.relpath(fromTop, fromDirectory))
+            for directoryName in directoryNames:
+                fromPath = os.path.join(fromTop, directoryName)
+                toPath = os.path.join(toTop, directoryName)
+                if os.path.islink(fromPath):
+                    os.symlink(os.readlink(fromPath), toPath)
+                else:
+                    os.mkdir(toPath, 0755)
+            for fileName in fileNames:
+                fromPath = os.path.join(fromTop, fileName)
+                toPath = os.path.join(toTop, fileName)
+                if os.path.islink(fromPath):
+                    os.symlink(os.readlink(fromPath), toPath)
+                else:
+                    reflink = cls._linkFile(fromPath, toPath, reflink=reflink)
+
+    @classmethod
+    def _materialize(cls, path):
+        """Auxiliary method, make sure a file, or all files in a directory, are not hardlinks.
+        
+        Then writing into them cannot write into a persistent extraction."""
+        if os.path.islink(path) or not os.path.exists(path):
+            return
+        if os.path.isdir(path):
+            paths = []
+            for top, directoryNames, fileNames in os.walk(path):
+                paths.extend(os.path.join(top, fileName) for fileName in fileNames)
+        else:
+            paths = [path]
+        for path in paths:
+            if os.path.islink(path) or os.stat(path).st_nlink <= 1:
+                continue
+            temporaryPath = path + ".tmp" + Timestamp.microsecondTimestamp()
+            FileCopy.copyFile(path, temporaryPath)
+            os.rename(temporaryPath, path)
+
+    def _assembleFromPersistentExtraction(self, temporaryAssemblyDirectory, modifications,
+                                          udf=False, ignoreJoliet=True, usingMount=False):
+        """Auxiliary method, called by cloneWithModifications and cloneWithModificationsUsingMount."""
+        persistentExtractionDirectory = self.persistentExtraction(udf=udf, ignoreJoliet=ignoreJoliet,
+                                                                  usingMount=usingMount)
+        IsoImage._assembleFromExtraction(persistentExtractionDirectory, temporaryAssemblyDirectory, modifications)
+
+    @classmethod
+    def _assembleFromExtraction(cls, extractionDirectory, temporaryAssemblyDirectory, modifications):
+        """Auxiliary method, link files from an extraction."""
+        print "linking files from {0}".format(extractionDirectory)
+        IsoImage._linkTree(extractionDirectory, temporaryAssemblyDirectory)
+        # only files about to be written become real copies
+        for modification in modifications:
+            IsoImage._materialize(modification.pathInTemporaryAssemblyDirectory(temporaryAssemblyDirectory))
+
+    @classmethod
+    def _materializeFilesWrittenByGenisoimage(cls, temporaryAssemblyDirectory, genisoimageOptions):
+        """Auxiliary method, genisoimage option -boot-info-table writes into the boot image file."""
+        if "-boot-info-table" in genisoimageOptions and "-b" in genisoimageOptions:
+            bootImage = genisoimageOptions[genisoimageOptions.index("-b") + 1]
+            IsoImage._materialize(os.path.join(temporaryAssemblyDirectory, bootImage))
+
+    @classmethod
+    def _makeIsoImageCommandName(cls):
+        """Auxiliary method, genisoimage or mkisofs."""
+        if SystemRequirements.which("genisoimage"):
+            # preferred choice
+            return "genisoimage"
+        elif SystemRequirements.which("mkisofs"):
+            # acceptable choice
+            return "mkisofs"
+        else:
+            # preferred choice for error message
+            return "genisoimage"
+
+    def plannedModifications(self, modifications, udf=False, ignoreJoliet=True):
+        """Return a list of modifications with the same result, but cheaper to apply.
+        
+        See IsoImageModificationPlan.
+        
+        Raises an exception if any modification would fail for sure,
+        e.g. if a file to replace within doesn't exist."""
+        modificationPlan = IsoImageModificationPlan(modifications)
+        modificationPlan.validate(self, udf=udf, ignoreJoliet=ignoreJoliet)
+        plannedModifications = modificationPlan.modifications
+        if len(plannedModifications) < len(modifications):
+            print "planned {0} modifications as {1}".format(len(modifications), len(plannedModifications))
+        return plannedModifications
+
+    def _cloneWithModificationsByRemaster(self, modifications, cloneIsoImagePath, genisoimageOptions,
+                                          ignoreJoliet=True, pause=False, remaster=None):
+        """Auxiliary method, called by cloneWithModifications for engine="remaster".
+        
+        remaster
+            an IsoRemaster for this .iso image, to share entries read once, if None then made."""
+        if remaster is None:
+            remaster = IsoRemaster(self._isoImagePath, ignoreJoliet=ignoreJoliet)
+        temporaryOverlayDirectory = cloneIsoImagePath + ".tmpdir"
+        os.mkdir(temporaryOverlayDirectory, 0755)
+        try:
+            # copy only files to be modified from original .iso image
+            for modification in modifications:
+                remaster.extractInto(temporaryOverlayDirectory, modification.pathOnIso)
+            # give a chance to look
+            if pause:
+                raw_input("you requested to pause before applying modifications, press Enter to continue:")
+            # apply modifications
+            print "applying modifications into {0}".format(temporaryOverlayDirectory)
+            for modification in modifications:
+                modification.writeIntoAssembly(temporaryOverlayDirectory)
+            # give a chance to look
+            if pause:
+                raw_input("you requested to pause after applying modifications, press Enter to continue:")
+            # make new .iso image file
+            print "making new {0} from {1}, this may take a few minutes".format(cloneIsoImagePath, self._isoImagePath)
+            try:
+                remaster.write(cloneIsoImagePath, genisoimageOptions,
+                               overlayDirectory=temporaryOverlayDirectory,
+                               replacedPathsOnIso=[modification.pathOnIso for modification in modifications])
+            except:
+                if os.path.exists(cloneIsoImagePath):
+                    os.remove(cloneIsoImagePath)
+                raise
+        finally:
+            shutil.rmtree(temporaryOverlayDirectory, ignore_errors=True)
+        return IsoImage(cloneIsoImagePath)
+
     def cloneWithModifications(self, modifications=[], cloneIsoImagePath=None, udf=False, ignoreJoliet=True,
-                               pause=False):
+                               pause=False, persistentExtraction=False, engine="genisoimage", cloneCache=None):
         """Clone with any number of instances of IsoImageModification applied.
         
         A temporary assembly directory in the same directory as cloneIsoImagePath needs disk space,
@@ -182,10 +582,34 @@ class IsoImage(object):
         
         modifications
             a list of IsoImageModification instances.
+            Planned first, see method plannedModifications,
+            hence an invalid modification fails before any files are copied.
         
         cloneIsoImagePath
             if not given then in same directory with a timestamp in the filename.
         
+        persistentExtraction
+            whether to keep all files extracted in a persistent extraction next to the .iso image,
+            see method persistentExtraction,
+            and to assemble by linking to those files rather than by extracting again.
+            Only files written by modifications become real copies.
+            Saves most disk writes for every clone after the first one.
+        
+        engine
+            "genisoimage" to assemble all files in a temporary assembly directory
+            and to make the new .iso image by genisoimage command,
+            or "remaster" to write the new .iso image by nrvr.diskimage.remaster,
+            which copies content of unchanged files directly from the original .iso image
+            and needs a temporary directory only for files written by modifications.
+            Falls back to "genisoimage" if given genisoimageOptions not supported by "remaster",
+            notably for udf.
+        
+        cloneCache
+            an nrvr.diskimage.clonecache.IsoImageCloneCache, if given then a clone
+            with the same modifications and options made before is hardlinked to cloneIsoImagePath
+            rather than made again,
+            and a clone newly made is kept in the cache.
+        
         return
             IsoImage(cloneIsoImagePath)."""
         # as of 2013-09-29 given known uses of this package and known bugs of iso-info
@@ -202,12 +626,39 @@ class IsoImage(object):
             cloneIsoImagePath = isoImagePathSplitext[0] + "." + timestamp + isoImagePathSplitext[1]
         if os.path.exists(cloneIsoImagePath):
             raise Exception("won't overwrite already existing {0}".format(cloneIsoImagePath))
+        genisoimageOptions = self.genisoimageOptions(label=timestamp, udf=udf, ignoreJoliet=ignoreJoliet)
+        if cloneCache is not None:
+            cacheKey = cloneCache.key(self._isoImagePath, modifications, genisoimageOptions,
+                                      udf=udf, ignoreJoliet=ignoreJoliet)
+            if cloneCache.lookup(cacheKey, cloneIsoImagePath):
+                print "reusing cached clone of {0} as {1}".format(self._isoImagePath, cloneIsoImagePath)
+                return IsoImage(cloneIsoImagePath)
+            clone = self.cloneWithModifications(modifications=modifications, cloneIsoImagePath=cloneIsoImagePath,
+                                                udf=udf, ignoreJoliet=ignoreJoliet, pause=pause,
+                                                persistentExtraction=persistentExtraction, engine=engine)
+            cloneCache.store(cacheKey, cloneIsoImagePath)
+            return clone
+        # plan, and fail early rather than after extraction
+        modifications = self.plannedModifications(modifications, udf=udf, ignoreJoliet=ignoreJoliet)
+        if engine == "remaster":
+            unsupportedOptions = IsoRemaster.unsupportedOptions(genisoimageOptions)
+            if not unsupportedOptions:
+                return self._cloneWithModificationsByRemaster(modifications, cloneIsoImagePath, genisoimageOptions,
+                                                              ignoreJoliet=ignoreJoliet, pause=pause)
+            print "falling back to genisoimage because of options {0}".format(" ".join(unsupportedOptions))
+        elif engine != "genisoimage":
+            raise Exception("unknown engine {0}".format(engine))
         temporaryAssemblyDirectory = cloneIsoImagePath + ".tmpdir"
         #os.mkdir(temporaryAssemblyDirectory, 0755)
         try:
-            # copy files from original .iso image
-            print "copying files from {0}, this may take a few minutes".format(self._isoImagePath)
-            self.copyToDirectory(temporaryAssemblyDirectory, udf=udf, ignoreJoliet=ignoreJoliet)
+            if not persistentExtraction:
+                # copy files from original .iso image
+                print "copying files from {0}, this may take a few minutes".format(self._isoImagePath)
+                self.copyToDirectory(temporaryAssemblyDirectory, udf=udf, ignoreJoliet=ignoreJoliet)
+            else:
+                # link files from persistent extraction of original .iso image
+                self._assembleFromPersistentExtraction(temporaryAssemblyDirectory, modifications,
+                                                       udf=udf, ignoreJoliet=ignoreJoliet)
             # give a chance to look
             if pause:
                 raw_input("you requested to pause before applying modifications, press Enter to continue:")
@@ -220,16 +671,9 @@ class IsoImage(object):
                 raw_input("you requested to pause after applying modifications, press Enter to continue:")
             # make new .iso image file
             print "making new {0}, this may take a few minutes".format(cloneIsoImagePath)
-            if SystemRequirements.which("genisoimage"):
-                # preferred choice
-                makeIsoImageCommandName = "genisoimage"
-            elif SystemRequirements.which("mkisofs"):
-                # acceptable choice
-                makeIsoImageCommandName = "mkisofs"
-            else:
-                # preferred choice for error message
-                makeIsoImageCommandName = "genisoimage"
-            genisoimageOptions = self.genisoimageOptions(label=timestamp, udf=udf, ignoreJoliet=ignoreJoliet)
+            makeIsoImageCommandName = IsoImage._makeIsoImageCommandName()
+            if persistentExtraction:
+                IsoImage._materializeFilesWrittenByGenisoimage(temporaryAssemblyDirectory, genisoimageOptions)
             CommandCapture([makeIsoImageCommandName] +
                            genisoimageOptions + 
                            ["-o", cloneIsoImagePath,
@@ -241,8 +685,192 @@ class IsoImage(object):
             shutil.rmtree(temporaryAssemblyDirectory, ignore_errors=True)
         return IsoImage(cloneIsoImagePath)
 
+    def _cloneVariantByLinking(self, extractionDirectory, modifications, cloneIsoImagePath, genisoimageOptions,
+                               makeIsoImageCommandName):
+        """Auxiliary method, called by cloneVariantsWithModifications for engine="genisoimage"."""
+        temporaryAssemblyDirectory = cloneIsoImagePath + ".tmpdir"
+        try:
+            IsoImage._assembleFromExtraction(extractionDirectory, temporaryAssemblyDirectory, modifications)
+            # apply modifications
+            print "applying modifications into {0}".format(temporaryAssemblyDirectory)
+            for modification in modifications:
+                modification.writeIntoAssembly(temporaryAssemblyDirectory)
+            # make new .iso image file
+            print "making new {0}, this may take a few minutes".format(cloneIsoImagePath)
+            IsoImage._materializeFilesWrittenByGenisoimage(temporaryAssemblyDirectory, genisoimageOptions)
+            CommandCapture([makeIsoImageCommandName] +
+                           genisoimageOptions + 
+                           ["-o", cloneIsoImagePath,
+                            temporaryAssemblyDirectory],
+                           copyToStdio=False,
+                           exceptionIfAnyStderr=False)
+        finally:
+            shutil.rmtree(temporaryAssemblyDirectory, ignore_errors=True)
+        return IsoImage(cloneIsoImagePath)
+
+    @classmethod
+    def _runConcurrently(cls, functions, maxWorkers):
+        """Auxiliary method, call functions in at most maxWorkers threads.
+        
+        Calls all functions even if some raise an exception.
+        
+        return
+            list of return values, in same order as functions.
+        
+        Raises first exception raised by any of the functions, after all have completed."""
+        results = [None] * len(functions)
+        exceptions = []
+        remaining = Queue.Queue()
+        for index in range(len(functions)):
+            remaining.put(index)
+        def work():
+            while True:
+                try:
+                    index = remaining.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    results[index] = functions[index]()
+                except Exception as ex:
+                    exceptions.append((index, sys.exc_info()))
+        workers = [threading.Thread(target=work) for _ in range(max(1, min(maxWorkers, len(functions))))]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        if exceptions:
+            exceptions.sort(key=lambda indexAndExcInfo: indexAndExcInfo[0])
+            excInfo = exceptions[0][1]
+            raise excInfo[0], excInfo[1], excInfo[2]
+        return results
+
+    def cloneVariantsWithModifications(self, modificationsPerVariant, cloneIsoImagePaths=None, udf=False, ignoreJoliet=True,
+                                       persistentExtraction=False, engine="genisoimage", cloneCache=None, maxWorkers=2):
+        """Clone several variants, each with its own list of instances of IsoImageModification applied,
+        from one extraction.
+        
+        Writes variants concurrently.
+        
+        For engine="remaster" entries of this .iso image are read once,
+        and for each variant only files written by its modifications are extracted into an overlay.
+        
+        For engine="genisoimage" all files are extracted once,
+        and for each variant an assembly directory is made by linking to those files,
+        see method persistentExtraction.
+        If not persistentExtraction then the extraction is removed upon completion.
+        
+        modificationsPerVariant
+            a list of lists of IsoImageModification instances, one list per variant.
+        
+        cloneIsoImagePaths
+            a list of paths, one per variant,
+            if not given then in same directory with a timestamp and an index in the filename.
+        
+        maxWorkers
+            how many variants at most to write at the same time.
+            Writing is mostly limited by disk throughput,
+            hence more than a few are unlikely to help.
+        
+        For other parameters see method cloneWithModifications.
+        
+        return
+            list of IsoImage(cloneIsoImagePath), one per variant."""
+        # timestamp to the microsecond should be good enough
+        timestamp = Timestamp.microsecondTimestamp()
+        # ensure there are cloneIsoImagePaths
+        if not cloneIsoImagePaths:
+            # insert timestamp and index before extension
+            isoImagePathSplitext = os.path.splitext(self._isoImagePath)
+            cloneIsoImagePaths = [isoImagePathSplitext[0] + "." + timestamp + "-" + str(index) + isoImagePathSplitext[1]
+                                  for index in range(len(modificationsPerVariant))]
+        if len(cloneIsoImagePaths) != len(modificationsPerVariant):
+            raise Exception("got {0} cloneIsoImagePaths for {1} variants".format(len(cloneIsoImagePaths), len(modificationsPerVariant)))
+        for cloneIsoImagePath in cloneIsoImagePaths:
+            if os.path.exists(cloneIsoImagePath):
+                raise Exception("won't overwrite already existing {0}".format(cloneIsoImagePath))
+        # labels, unique per variant
+        genisoimageOptionsPerVariant = [self.genisoimageOptions(label=timestamp + "-" + str(index),
+                                                                udf=udf, ignoreJoliet=ignoreJoliet)
+                                        for index in range(len(modificationsPerVariant))]
+        # keys identify variants, whether or not there is a cache
+        cacheKeys = [IsoImageCloneCache.key(self._isoImagePath, modifications, genisoimageOptionsPerVariant[index],
+                                            udf=udf, ignoreJoliet=ignoreJoliet)
+                     for index, modifications in enumerate(modificationsPerVariant)]
+        # variants already cached need not be made
+        clones = [None] * len(modificationsPerVariant)
+        if cloneCache is not None:
+            for index in range(len(modificationsPerVariant)):
+                if cloneCache.lookup(cacheKeys[index], cloneIsoImagePaths[index]):
+                    print "reusing cached clone of {0} as {1}".format(self._isoImagePath, cloneIsoImagePaths[index])
+                    clones[index] = IsoImage(cloneIsoImagePaths[index])
+        # variants same as an earlier variant need not be made twice
+        duplicateOf = {}
+        indexesToMake = []
+        indexByCacheKey = {}
+        for index in range(len(modificationsPerVariant)):
+            if clones[index] is not None:
+                continue
+            if cacheKeys[index] is not None and cacheKeys[index] in indexByCacheKey:
+                duplicateOf[index] = indexByCacheKey[cacheKeys[index]]
+                continue
+            indexByCacheKey[cacheKeys[index]] = index
+            indexesToMake.append(index)
+        if not indexesToMake:
+            return clones
+        # plan, and fail early rather than after extraction
+        modificationsPerVariant = list(modificationsPerVariant)
+        for index in indexesToMake:
+            modificationsPerVariant[index] = self.plannedModifications(modificationsPerVariant[index],
+                                                                       udf=udf, ignoreJoliet=ignoreJoliet)
+        if engine == "remaster":
+            unsupportedOptions = IsoRemaster.unsupportedOptions(genisoimageOptionsPerVariant[0])
+            if unsupportedOptions:
+                print "falling back to genisoimage because of options {0}".format(" ".join(unsupportedOptions))
+                engine = "genisoimage"
+        elif engine != "genisoimage":
+            raise Exception("unknown engine {0}".format(engine))
+        temporaryExtractionDirectory = None
+        try:
+            if engine == "remaster":
+                remaster = IsoRemaster(self._isoImagePath, ignoreJoliet=ignoreJoliet)
+                # read once before concurrently using
+                remaster.originalEntries()
+                def cloneVariant(index):
+                    return lambda: self._cloneWithModificationsByRemaster(modificationsPerVariant[index],
+                                                                          cloneIsoImagePaths[index],
+                                                                          genisoimageOptionsPerVariant[index],
+                                                                          ignoreJoliet=ignoreJoliet,
+                                                                          remaster=remaster)
+            else:
+                if persistentExtraction:
+                    extractionDirectory = self.persistentExtraction(udf=udf, ignoreJoliet=ignoreJoliet)
+                else:
+                    temporaryExtractionDirectory = cloneIsoImagePaths[indexesToMake[0]] + ".extracted.tmpdir"
+                    print "copying files from {0}, this may take a few minutes".format(self._isoImagePath)
+                    self.copyToDirectory(temporaryExtractionDirectory, udf=udf, ignoreJoliet=ignoreJoliet)
+                    extractionDirectory = temporaryExtractionDirectory
+                makeIsoImageCommandName = IsoImage._makeIsoImageCommandName()
+                def cloneVariant(index):
+                    return lambda: self._cloneVariantByLinking(extractionDirectory,
+                                                               modificationsPerVariant[index],
+                                                               cloneIsoImagePaths[index],
+                                                               genisoimageOptionsPerVariant[index],
+                                                               makeIsoImageCommandName)
+            made = IsoImage._runConcurrently([cloneVariant(index) for index in indexesToMake], maxWorkers)
+        finally:
+            if temporaryExtractionDirectory:
+                shutil.rmtree(temporaryExtractionDirectory, ignore_errors=True)
+        for index, clone in zip(indexesToMake, made):
+            clones[index] = clone
+            if cloneCache is not None:
+                cloneCache.store(cacheKeys[index], cloneIsoImagePaths[index])
+        for index, originalIndex in duplicateOf.iteritems():
+            IsoImage._linkFile(cloneIsoImagePaths[originalIndex], cloneIsoImagePaths[index], reflink=False)
+            clones[index] = IsoImage(cloneIsoImagePaths[index])
+        return clones
+
     def cloneWithModificationsUsingMount(self, modifications=[], cloneIsoImagePath=None, udf=False, ignoreJoliet=True,
-                                         pause=False):
+                                         pause=False, persistentExtraction=False):
         """Clone with any number of instances of IsoImageModification applied.
         
         This is an older implementation which regrettably because of the mount command requires
@@ -259,6 +887,11 @@ class IsoImage(object):
         cloneIsoImagePath
             if not given then in same directory with a timestamp in the filename.
         
+        persistentExtraction
+            whether to assemble by linking to files in a persistent extraction,
+            see method cloneWithModifications.
+            If already extracted then no need to mount.
+        
         return
             IsoImage(cloneIsoImagePath)."""
         # timestamp to the microsecond should be good enough
@@ -270,16 +903,23 @@ class IsoImage(object):
             cloneIsoImagePath = isoImagePathSplitext[0] + "." + timestamp + isoImagePathSplitext[1]
         if os.path.exists(cloneIsoImagePath):
             raise Exception("won't overwrite already existing {0}".format(cloneIsoImagePath))
+        # plan, and fail early rather than after mounting
+        modifications = self.plannedModifications(modifications, udf=udf, ignoreJoliet=ignoreJoliet)
         temporaryMountDirectory = cloneIsoImagePath + ".mnt"
         temporaryAssemblyDirectory = cloneIsoImagePath + ".tmpdir"
         os.mkdir(temporaryMountDirectory, 0755)
         #os.mkdir(temporaryAssemblyDirectory, 0755)
         try:
-            # mount
-            self.mount(temporaryMountDirectory, udf=udf)
-            # copy files from original .iso image
-            print "copying files from {0}, this may take a few minutes".format(self._isoImagePath)
-            shutil.copytree(temporaryMountDirectory, temporaryAssemblyDirectory, symlinks=True)
+            if not persistentExtraction:
+                # mount
+                self.mount(temporaryMountDirectory, udf=udf)
+                # copy files from original .iso image
+                print "copying files from {0}, this may take a few minutes".format(self._isoImagePath)
+                shutil.copytree(temporaryMountDirectory, temporaryAssemblyDirectory, symlinks=True)
+            else:
+                # link files from persistent extraction of original .iso image
+                self._assembleFromPersistentExtraction(temporaryAssemblyDirectory, modifications,
+                                                       udf=udf, ignoreJoliet=ignoreJoliet, usingMount=True)
             # give a chance to look
             if pause:
                 raw_input("you requested to pause before applying modifications, press Enter to continue:")
@@ -293,6 +933,8 @@ class IsoImage(object):
             # make new .iso image file
             print "making new {0}, this may take a few minutes".format(cloneIsoImagePath)
             genisoimageOptions = self.genisoimageOptions(label=timestamp, udf=udf, ignoreJoliet=ignoreJoliet)
+            if persistentExtraction:
+                IsoImage._materializeFilesWrittenByGenisoimage(temporaryAssemblyDirectory, genisoimageOptions)
             CommandCapture(["genisoimage"] + 
                            genisoimageOptions + 
                            ["-o", cloneIsoImagePath,
@@ -306,6 +948,45 @@ class IsoImage(object):
             os.rmdir(temporaryMountDirectory)
         return IsoImage(cloneIsoImagePath)
 
+    @classmethod
+    def createWithModifications(cls, isoImagePath, modifications, label=None):
+        """Create a new .iso image containing only files written by modifications.
+        
+        Meant for small .iso images, e.g. with a kickstart or autounattend.xml file.
+        Written in-process by nrvr.diskimage.remaster, hence doesn't need genisoimage,
+        and for a few files takes well under a second.
+        
+        Has Rock Ridge and Joliet names.
+        
+        modifications
+            a list of IsoImageModification instances, e.g. IsoImageModificationFromString.
+        
+        label
+            volume id, max 32 characters, if not given then a timestamp.
+        
+        return
+            IsoImage(isoImagePath)."""
+        if os.path.exists(isoImagePath):
+            raise Exception("won't overwrite already existing {0}".format(isoImagePath))
+        if not label:
+            label = Timestamp.microsecondTimestamp()
+        modifications = IsoImageModificationPlan(modifications).modifications
+        temporaryAssemblyDirectory = isoImagePath + ".tmpdir"
+        os.mkdir(temporaryAssemblyDirectory, 0755)
+        try:
+            for modification in modifications:
+                modification.writeIntoAssembly(temporaryAssemblyDirectory)
+            try:
+                IsoRemaster(None).write(isoImagePath, ["-r", "-J", "-V", label[-32:]],
+                                        overlayDirectory=temporaryAssemblyDirectory)
+            except:
+                if os.path.exists(isoImagePath):
+                    os.remove(isoImagePath)
+                raise
+        finally:
+            shutil.rmtree(temporaryAssemblyDirectory, ignore_errors=True)
+        return IsoImage(isoImagePath)
+
     def genisoimageOptions(self, label=None, udf=False, ignoreJoliet=True):
         """Auxiliary method, called by cloneWithModifications.
         
@@ -339,6 +1020,9 @@ class IsoImage(object):
 
 class IsoImageModification(object):
     """A modification to an .iso image."""
+    # whether writeIntoAssembly replaces any pre-existing file without reading it,
+    # used by IsoImageModificationPlan, False unless known for sure
+    overwrites = False
     def __init__(self, pathOnIso):
         self.pathOnIso = pathOnIso
     def pathInTemporaryAssemblyDirectory(self, temporaryAssemblyDirectory):
@@ -346,11 +1030,60 @@ class IsoImageModification(object):
         # remove any leading slash in order to make it relative
         relativePathOnIso = re.sub(r"^/*(.*?)$", r"\g<1>", self.pathOnIso)
         return os.path.abspath(os.path.join(temporaryAssemblyDirectory, relativePathOnIso))
+    @classmethod
+    def _makeDirectoryFor(cls, pathInTemporaryAssemblyDirectory):
+        """Auxiliary method, if necessary make directory for a file about to be written."""
+        directoryInTemporaryAssemblyDirectory = os.path.dirname(pathInTemporaryAssemblyDirectory)
+        if not os.path.exists(directoryInTemporaryAssemblyDirectory):
+            os.makedirs(directoryInTemporaryAssemblyDirectory)
+    def pathsOnHost(self):
+        """Return a list of paths on the host disk read by writeIntoAssembly.
+        
+        Used by IsoImageModificationPlan to validate before any expensive work starts."""
+        return []
     def writeIntoAssembly(self, temporaryAssemblyDirectory):
         """To be implemented in subclasses."""
         raise NotImplementedError("Method writeIntoAssembly to be implemented in subclasses of IsoImageModification.")
+    def canonicalSerialization(self):
+        """Return a list of strings which is the same for modifications with the same effect,
+        or None if not implemented, which makes a clone not cacheable.
+        
+        Used by nrvr.diskimage.clonecache.
+        Content is represented by hash values, hence content of files on the host disk
+        is read every time."""
+        return None
+    @classmethod
+    def _hashOfPathOnHost(cls, pathOnHost, start=None, stop=None):
+        """Auxiliary method, hash of content of a file, or of a directory with all its content."""
+        hash = hashlib.sha256()
+        if not os.path.isdir(pathOnHost):
+            with open(pathOnHost, "rb") as inputFile:
+                if start:
+                    inputFile.seek(start)
+                current = start or 0
+                while stop is None or current < stop:
+                    chunk = 1048576 if stop is None else min(stop - current, 1048576)
+                    bytes = inputFile.read(chunk)
+                    if not bytes:
+                        break
+                    hash.update(bytes)
+                    current += len(bytes)
+            return hash.hexdigest()
+        for top, directoryNames, fileNames in os.walk(pathOnHost):
+            directoryNames.sort()
+            for name in sorted(directoryNames + fileNames):
+                path = os.path.join(top, name)
+                hash.update(os.path.relpath(path, pathOnHost) + "\x00")
+                if os.path.islink(path):
+                    hash.update("link " + os.readlink(path) + "\x00")
+                elif os.path.isdir(path):
+                    hash.update("directory\x00")
+                else:
+                    hash.update("file " + cls._hashOfPathOnHost(path) + "\x00")
+        return hash.hexdigest()
 class IsoImageModificationFromString(IsoImageModification):
     """A modification to an .iso image, copy from string into file."""
+    overwrites = True
     def __init__(self, pathOnIso, string, encoding="utf-8"):
         super(IsoImageModificationFromString, self).__init__(pathOnIso)
         self.string = string
@@ -361,17 +1094,21 @@ class IsoImageModificationFromString(IsoImageModification):
         if os.path.exists(pathInTemporaryAssemblyDirectory):
             os.remove(pathInTemporaryAssemblyDirectory)
         # if necessary make directory
-        directoryInTemporaryAssemblyDirectory = os.path.dirname(pathInTemporaryAssemblyDirectory)
-        if not os.path.exists(directoryInTemporaryAssemblyDirectory):
-            os.makedirs(directoryInTemporaryAssemblyDirectory)
+        self._makeDirectoryFor(pathInTemporaryAssemblyDirectory)
         # write
         with codecs.open(pathInTemporaryAssemblyDirectory, "w", encoding=self.encoding) as temporaryFile:
             temporaryFile.write(self.string)
+    def canonicalSerialization(self):
+        return ["FromString", self.pathInTemporaryAssemblyDirectory("/"),
+                hashlib.sha256(codecs.encode(self.string, self.encoding)).hexdigest()]
 class IsoImageModificationFromPath(IsoImageModification):
     """A modification to an .iso image, copy from path into file or into directory."""
+    overwrites = True
     def __init__(self, pathOnIso, pathOnHost):
         super(IsoImageModificationFromPath, self).__init__(pathOnIso)
         self.pathOnHost = pathOnHost
+    def pathsOnHost(self):
+        return [self.pathOnHost]
     def writeIntoAssembly(self, temporaryAssemblyDirectory):
         pathInTemporaryAssemblyDirectory = self.pathInTemporaryAssemblyDirectory(temporaryAssemblyDirectory)
         if not os.path.isdir(self.pathOnHost):
@@ -379,15 +1116,22 @@ class IsoImageModificationFromPath(IsoImageModification):
             # remove pre-existing file, if any
             if os.path.exists(pathInTemporaryAssemblyDirectory):
                 os.remove(pathInTemporaryAssemblyDirectory)
-            # copy
-            shutil.copy2(self.pathOnHost, pathInTemporaryAssemblyDirectory)
+            # if necessary make directory
+            self._makeDirectoryFor(pathInTemporaryAssemblyDirectory)
+            # copy, kernel-side if possible
+            FileCopy.copyFile(self.pathOnHost, pathInTemporaryAssemblyDirectory)
         else:
             # if a directory then
             # remove pre-existing directory, if any
             if os.path.exists(pathInTemporaryAssemblyDirectory):
                 shutil.rmtree(pathInTemporaryAssemblyDirectory)
-            # copy
-            shutil.copytree(self.pathOnHost, pathInTemporaryAssemblyDirectory, symlinks=True)
+            # if necessary make directory
+            self._makeDirectoryFor(pathInTemporaryAssemblyDirectory)
+            # copy, kernel-side if possible
+            FileCopy.copyTree(self.pathOnHost, pathInTemporaryAssemblyDirectory, symlinks=True)
+    def canonicalSerialization(self):
+        return ["FromPath", self.pathInTemporaryAssemblyDirectory("/"),
+                self._hashOfPathOnHost(self.pathOnHost)]
 class IsoImageModificationByReplacement(IsoImageModification):
     # raw string in addition to triple-quoted string because of backslashes \
     r"""A modification to an .iso image, replace within file.
@@ -406,41 +1150,220 @@ class IsoImageModificationByReplacement(IsoImageModification):
         # read pre-existing file
         with codecs.open(pathInTemporaryAssemblyDirectory, "r", encoding=self.encoding) as inputFile:
             fileContent = inputFile.read()
-        fileContent = self.regularExpression.sub(self.replacement, fileContent)
+        fileContent = self.replace(fileContent)
         # overwrite
         with codecs.open(pathInTemporaryAssemblyDirectory, "w", encoding=self.encoding) as outputFile:
             outputFile.write(fileContent)
+    def replace(self, fileContent):
+        """Return fileContent with replacement applied."""
+        return self.regularExpression.sub(self.replacement, fileContent)
+    def canonicalSerialization(self):
+        if callable(self.replacement):
+            # cannot tell what a function does
+            return None
+        return ["ByReplacement", self.pathInTemporaryAssemblyDirectory("/"),
+                self.regularExpression.pattern, self.regularExpression.flags, self.replacement, self.encoding]
 class IsoImageModificationFromByteRange(IsoImageModification):
     """A modification to an .iso image, copy from byte range from file into a file by itself."""
+    overwrites = True
     def __init__(self, pathOnIso, pathOnHost, start, stop):
         super(IsoImageModificationFromByteRange, self).__init__(pathOnIso)
         self.pathOnHost = pathOnHost
         self.start = start
         self.stop = stop
+    def pathsOnHost(self):
+        return [self.pathOnHost]
     def writeIntoAssembly(self, temporaryAssemblyDirectory):
         pathInTemporaryAssemblyDirectory = self.pathInTemporaryAssemblyDirectory(temporaryAssemblyDirectory)
-        if self.start:
-            start = self.start
-        else:
-            start = 0
-        if self.stop:
-            stop = self.stop
-        else:
-            stop = os.path.getsize(self.pathOnHost)
         # remove pre-existing file, if any
         if os.path.exists(pathInTemporaryAssemblyDirectory):
             os.remove(pathInTemporaryAssemblyDirectory)
-        # copy
-        with open(self.pathOnHost, "rb") as inputFile:
-            inputFile.seek(start)
-            with open(pathInTemporaryAssemblyDirectory, "wb") as outputFile:
-                current = start
-                while current < stop:
-                    remainder = stop - current
-                    chunk = min(remainder, 10240)
-                    bytes = inputFile.read(chunk)
-                    outputFile.write(bytes)
-                    current += chunk
+        # if necessary make directory
+        self._makeDirectoryFor(pathInTemporaryAssemblyDirectory)
+        # copy, kernel-side if possible
+        FileCopy.copyRange(self.pathOnHost, pathInTemporaryAssemblyDirectory, self.start, self.stop)
+    def canonicalSerialization(self):
+        return ["FromByteRange", self.pathInTemporaryAssemblyDirectory("/"),
+                self._hashOfPathOnHost(self.pathOnHost, self.start, self.stop)]
+class IsoImageModificationRemoval(IsoImageModification):
+    """A modification to an .iso image, remove file or directory, if any."""
+    overwrites = True
+    def writeIntoAssembly(self, temporaryAssemblyDirectory):
+        pathInTemporaryAssemblyDirectory = self.pathInTemporaryAssemblyDirectory(temporaryAssemblyDirectory)
+        if os.path.isdir(pathInTemporaryAssemblyDirectory) and not os.path.islink(pathInTemporaryAssemblyDirectory):
+            shutil.rmtree(pathInTemporaryAssemblyDirectory)
+        elif os.path.lexists(pathInTemporaryAssemblyDirectory):
+            os.remove(pathInTemporaryAssemblyDirectory)
+    def canonicalSerialization(self):
+        return ["Removal", self.pathInTemporaryAssemblyDirectory("/")]
+
+class IsoImageModificationCoalesced(IsoImageModification):
+    """Several modifications of the same file, applied in one read/write pass.
+    
+    Made by IsoImageModificationPlan, not meant to be made directly.
+    
+    base
+        an IsoImageModification which overwrites, or None to start from pre-existing file.
+    
+    replacements
+        a list of IsoImageModificationByReplacement with the same encoding, applied in order."""
+    def __init__(self, pathOnIso, base=None, replacements=[]):
+        super(IsoImageModificationCoalesced, self).__init__(pathOnIso)
+        self.base = base
+        self.replacements = list(replacements)
+        self.overwrites = base is not None
+    @property
+    def encoding(self):
+        """Encoding of replacements, or None if none."""
+        return self.replacements[0].encoding if self.replacements else None
+    def pathsOnHost(self):
+        return self.base.pathsOnHost() if self.base else []
+    def writeIntoAssembly(self, temporaryAssemblyDirectory):
+        if isinstance(self.base, IsoImageModificationFromString) \
+                and (not self.replacements or self.base.encoding == self.encoding):
+            # replace in memory, write once
+            string = self.base.string
+            for replacement in self.replacements:
+                string = replacement.replace(string)
+            IsoImageModificationFromString(self.pathOnIso, string, self.base.encoding) \
+                .writeIntoAssembly(temporaryAssemblyDirectory)
+            return
+        if self.base:
+            self.base.writeIntoAssembly(temporaryAssemblyDirectory)
+        if not self.replacements:
+            return
+        pathInTemporaryAssemblyDirectory = self.pathInTemporaryAssemblyDirectory(temporaryAssemblyDirectory)
+        # read pre-existing file once
+        with codecs.open(pathInTemporaryAssemblyDirectory, "r", encoding=self.encoding) as inputFile:
+            fileContent = inputFile.read()
+        for replacement in self.replacements:
+            fileContent = replacement.replace(fileContent)
+        # overwrite once
+        with codecs.open(pathInTemporaryAssemblyDirectory, "w", encoding=self.encoding) as outputFile:
+            outputFile.write(fileContent)
+    def canonicalSerialization(self):
+        serializations = [self.base.canonicalSerialization()] if self.base else []
+        serializations.extend(replacement.canonicalSerialization() for replacement in self.replacements)
+        if None in serializations:
+            return None
+        return ["Coalesced"] + serializations
+
+class IsoImageModificationPlan(object):
+    """Plans applying a list of modifications.
+    
+    Drops modifications which a later modification overwrites,
+    coalesces modifications of the same file into one IsoImageModificationCoalesced,
+    e.g. several IsoImageModificationByReplacement of isolinux/txt.cfg into one read/write pass,
+    and can validate before any expensive work starts.
+    
+    Applying the planned modifications has the same result as applying the given modifications in order.
+    Modifications of other kinds than the known subclasses of IsoImageModification are kept as they are,
+    and nothing is coalesced or dropped across them if their paths are related."""
+    def __init__(self, modifications):
+        """Create new IsoImageModificationPlan.
+        
+        modifications
+            a list of IsoImageModification instances, in the order they would be applied."""
+        self._given = list(modifications)
+        self._planned = []
+        for modification in self._given:
+            self._plan(modification)
+    @classmethod
+    def _normalizedPath(cls, modification):
+        """Auxiliary method, absolute path on .iso image."""
+        return modification.pathInTemporaryAssemblyDirectory("/")
+    @classmethod
+    def _isAtOrBeneath(cls, path, directoryPath):
+        """Auxiliary method."""
+        return path == directoryPath or path.startswith(directoryPath.rstrip("/") + "/")
+    @classmethod
+    def _related(cls, path, otherPath):
+        """Auxiliary method, whether modifying one could affect the other."""
+        return cls._isAtOrBeneath(path, otherPath) or cls._isAtOrBeneath(otherPath, path)
+    @classmethod
+    def _isKnown(cls, modification):
+        """Auxiliary method, whether of a kind this class knows what it does."""
+        return isinstance(modification, (IsoImageModificationFromString,
+                                         IsoImageModificationFromPath,
+                                         IsoImageModificationByReplacement,
+                                         IsoImageModificationFromByteRange,
+                                         IsoImageModificationRemoval,
+                                         IsoImageModificationCoalesced))
+    def _plan(self, modification):
+        """Auxiliary method, add one modification to the plan."""
+        path = self._normalizedPath(modification)
+        if modification.overwrites and self._isKnown(modification):
+            # a directory copied from the host, or a removal, replaces anything beneath it too
+            replacesDirectory = isinstance(modification, IsoImageModificationRemoval) \
+                                or (isinstance(modification, IsoImageModificationFromPath)
+                                    and os.path.isdir(modification.pathOnHost))
+            kept = []
+            barrier = False
+            for planned in reversed(self._planned):
+                plannedPath = self._normalizedPath(planned)
+                if not self._isKnown(planned) and self._related(plannedPath, path):
+                    barrier = True
+                if not barrier and (plannedPath == path or
+                                    (replacesDirectory and self._isAtOrBeneath(plannedPath, path))):
+                    continue
+                kept.append(planned)
+            kept.reverse()
+            self._planned = kept
+            self._planned.append(IsoImageModificationCoalesced(modification.pathOnIso, base=modification))
+            return
+        if isinstance(modification, IsoImageModificationByReplacement):
+            # latest planned modification of the same file, unless a related one is in between
+            for planned in reversed(self._planned):
+                plannedPath = self._normalizedPath(planned)
+                if plannedPath == path:
+                    if isinstance(planned, IsoImageModificationCoalesced) \
+                            and (planned.encoding or modification.encoding) == modification.encoding:
+                        planned.replacements.append(modification)
+                        return
+                    break
+                if self._related(plannedPath, path):
+                    break
+            self._planned.append(IsoImageModificationCoalesced(modification.pathOnIso, replacements=[modification]))
+            return
+        # of another kind, kept as is
+        self._planned.append(modification)
+    @property
+    def modifications(self):
+        """List of planned modifications, to be applied in order."""
+        return list(self._planned)
+    @property
+    def pathsOnIso(self):
+        """List of paths on .iso image written by planned modifications."""
+        return [modification.pathOnIso for modification in self._planned]
+    def validate(self, isoImage, udf=False, ignoreJoliet=True):
+        """Raise an exception if any planned modification would fail for sure.
+        
+        Checks that files to be modified by replacement exist,
+        either in the .iso image or as written by an earlier modification,
+        and that paths on the host disk to copy from exist.
+        
+        Reads only the directory of the .iso image, see IsoImage.entry,
+        hence fails in milliseconds rather than after extraction.
+        
+        isoImage
+            the IsoImage to be cloned."""
+        problems = []
+        written = []
+        for modification in self._planned:
+            path = self._normalizedPath(modification)
+            for pathOnHost in modification.pathsOnHost():
+                if not os.path.exists(pathOnHost):
+                    problems.append("no such file or directory {0} on host for {1}".format(pathOnHost, modification.pathOnIso))
+            if isinstance(modification, IsoImageModificationCoalesced) and not modification.overwrites:
+                if not any(self._isAtOrBeneath(path, writtenPath) for writtenPath in written):
+                    entry = isoImage.entry(modification.pathOnIso, udf=udf, ignoreJoliet=ignoreJoliet)
+                    if entry is None:
+                        problems.append("no such file {0} in {1} to replace within".format(modification.pathOnIso, isoImage.isoImagePath))
+                    elif entry.isDirectory:
+                        problems.append("cannot replace within directory {0} in {1}".format(modification.pathOnIso, isoImage.isoImagePath))
+            written.append(path)
+        if problems:
+            raise Exception("invalid modifications: {0}".format("; ".join(problems)))
 
 if __name__ == "__main__":
     from nrvr.util.requirements import SystemRequirements
@@ -0,0 +1,852 @@
+#!/usr/bin/python
+
+"""nrvr.diskimage.remaster - Write a modified copy of an ISO 9660 .iso disk image
+
+The main class provided by this module is IsoRemaster.
+
+Writes a new .iso image with fresh volume descriptors, path tables, directory records,
+Rock Ridge and Joliet names, and El Torito boot catalog,
+copying the content of unchanged files directly from the extents of the original .iso image
+with large sequential reads, and writing only modified or added files from the host disk.
+
+Hence there is no need for an assembly directory with a complete copy of all files,
+and no need for genisoimage.
+
+Without an original .iso image writes a new .iso image from an overlay directory only,
+e.g. a small .iso image with a few configuration files.
+
+Understands the subset of genisoimage options used in this package,
+see IsoRemaster.unsupportedOptions.
+Doesn't write UDF.
+
+It should work in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import copy
+import os
+import os.path
+import re
+import struct
+import time
+
+from nrvr.diskimage.iso9660 import Iso9660Reader, copyExtents
+
+class _Node(object):
+    """A file or directory or symbolic link in the tree to be written."""
+    def __init__(self, name, parent, isDirectory):
+        self.name = name
+        self.parent = parent
+        self.isDirectory = isDirectory
+        self.children = {}
+        # content is one of extents, hostPath, data
+        self.extents = []
+        self.hostPath = None
+        self.data = None
+        self.size = 0
+        self.symlinkTarget = None
+        # assigned during layout
+        self.isoName = None
+        self.jolietName = None
+        self.location = 0
+        self.directorySize = 0
+        self.jolietLocation = 0
+        self.jolietDirectorySize = 0
+        self.number = 0
+        self.jolietNumber = 0
+    @property
+    def path(self):
+        if self.parent is None:
+            return ""
+        parentPath = self.parent.path
+        return parentPath + "/" + self.name if parentPath else self.name
+    def sortedChildren(self, key):
+        return sorted(self.children.values(), key=key)
+
+class IsoRemaster(object):
+    """Writes a modified copy of an ISO 9660 .iso image, reusing extents of unchanged files."""
+
+    sectorSize = 2048
+    # largest multiple of sectorSize that fits into a 32-bit extent length
+    maxExtentSize = 0xffffffff // 2048 * 2048
+
+    _optionsWithoutArgument = set(["-r", "-R", "-T", "-f", "-J", "-joliet-long", "-relaxed-filenames",
+                                   "-no-emul-boot", "-boot-info-table"])
+    _optionsWithArgument = set(["-V", "-b", "-c", "-boot-load-size"])
+
+    _rockRidgeIdentifier = "RRIP_1991A"
+    _rockRidgeDescriptor = "THE ROCK RIDGE INTERCHANGE PROTOCOL PROVIDES SUPPORT FOR POSIX FILE SYSTEM SEMANTICS"
+    _rockRidgeSource = "PLEASE CONTACT DISC PUBLISHER FOR SPECIFICATION SOURCE.  " \
+                       "SEE PUBLISHER IDENTIFIER IN PRIMARY VOLUME DESCRIPTOR FOR CONTACT INFORMATION."
+
+    @classmethod
+    def unsupportedOptions(cls, genisoimageOptions):
+        """Return a list of those genisoimage options which are not supported, or empty list []."""
+        unsupported = []
+        index = 0
+        while index < len(genisoimageOptions):
+            option = genisoimageOptions[index]
+            if option in IsoRemaster._optionsWithArgument:
+                index += 2
+                continue
+            if not option in IsoRemaster._optionsWithoutArgument:
+                unsupported.append(option)
+            index += 1
+        return unsupported
+
+    def __init__(self, isoImagePath, ignoreJoliet=True):
+        """Create new IsoRemaster.
+
+        isoImagePath
+            path of the original .iso image,
+            or None to write a new .iso image from an overlay directory only.
+
+        ignoreJoliet
+            whether to ignore a Joliet directory tree in the original .iso image
+            when reading names of files."""
+        self._isoImagePath = isoImagePath
+        if isoImagePath:
+            self._reader = Iso9660Reader(isoImagePath, ignoreJoliet=ignoreJoliet)
+        else:
+            self._reader = None
+
+    @property
+    def isoImagePath(self):
+        """Path of the original .iso image."""
+        return self._isoImagePath
+
+    @classmethod
+    def _normalizedPathOnIso(cls, pathOnIso):
+        """Auxiliary method, without leading and trailing slashes."""
+        return re.sub(r"^/*(.*?)/*$", r"\g<1>", pathOnIso)
+
+    def originalEntries(self):
+        """Return a list of IsoImageEntry of the original .iso image, or empty list [] if none."""
+        if not self._reader:
+            return []
+        return self._reader.entries()
+
+    def extractInto(self, overlayDirectory, pathOnIso):
+        """Copy a file from the original .iso image into an overlay directory.
+
+        For modifications which need to read pre-existing content.
+        Makes directories as needed.
+
+        Does nothing if there is no such file in the original .iso image.
+        Doesn't copy directories, because a modification of a directory replaces it as a whole."""
+        relativePathOnIso = self._normalizedPathOnIso(pathOnIso)
+        pathOnHost = os.path.join(overlayDirectory, relativePathOnIso)
+        directoryOnHost = os.path.dirname(pathOnHost)
+        if not os.path.isdir(directoryOnHost):
+            os.makedirs(directoryOnHost, 0755)
+        for entry in self.originalEntries():
+            if entry.path == relativePathOnIso:
+                if entry.isDirectory:
+                    return
+                if entry.symlinkTarget is not None:
+                    os.symlink(entry.symlinkTarget, pathOnHost)
+                else:
+                    with open(self._isoImagePath, "rb") as inputFile:
+                        with open(pathOnHost, "wb") as outputFile:
+                            copyExtents(inputFile, entry.extents, outputFile)
+                return
+
+    def write(self, cloneIsoImagePath, genisoimageOptions, overlayDirectory=None, replacedPathsOnIso=[]):
+        """Write a new .iso image.
+
+        cloneIsoImagePath
+            path of the new .iso image.
+
+        genisoimageOptions
+            a list of options as would be passed to genisoimage.
+            Must not contain any of unsupportedOptions().
+
+        overlayDirectory
+            a directory with files to add or to replace files of the original .iso image.
+
+        replacedPathsOnIso
+            a list of paths on the .iso image, files or directories, which are not to be taken
+            from the original .iso image, but only from overlayDirectory, if there at all.
+
+        Can be called concurrently from several threads, each writing a different new .iso image,
+        sharing entries read once from the original .iso image."""
+        unsupportedOptions = self.unsupportedOptions(genisoimageOptions)
+        if unsupportedOptions:
+            raise Exception("cannot remaster {0} with unsupported options {1}".format(self._isoImagePath, unsupportedOptions))
+        # state of one write in a copy of its own
+        remaster = copy.copy(self)
+        options = remaster._parseOptions(genisoimageOptions)
+        root = remaster._buildTree(options, overlayDirectory, replacedPathsOnIso)
+        remaster._layoutAndWrite(root, options, cloneIsoImagePath)
+
+    def _parseOptions(self, genisoimageOptions):
+        """Auxiliary method, return a dictionary."""
+        options = {"rockRidge": False, "transTbl": False, "followLinks": False,
+                   "joliet": False, "jolietLong": False, "label": "CDROM",
+                   "bootImage": None, "bootCatalog": None, "bootLoadSize": None, "bootInfoTable": False}
+        index = 0
+        while index < len(genisoimageOptions):
+            option = genisoimageOptions[index]
+            argument = genisoimageOptions[index + 1] if index + 1 < len(genisoimageOptions) else None
+            if option in ("-r", "-R"):
+                options["rockRidge"] = True
+            elif option == "-T":
+                options["transTbl"] = True
+            elif option == "-f":
+                options["followLinks"] = True
+            elif option == "-J":
+                options["joliet"] = True
+            elif option == "-joliet-long":
+                options["jolietLong"] = True
+            elif option == "-boot-info-table":
+                options["bootInfoTable"] = True
+            elif option == "-V":
+                options["label"] = argument
+            elif option == "-b":
+                options["bootImage"] = self._normalizedPathOnIso(argument)
+            elif option == "-c":
+                options["bootCatalog"] = self._normalizedPathOnIso(argument)
+            elif option == "-boot-load-size":
+                options["bootLoadSize"] = int(argument)
+            if option in IsoRemaster._optionsWithArgument:
+                index += 2
+            else:
+                index += 1
+        if options["bootImage"] and not options["bootCatalog"]:
+            # genisoimage default
+            options["bootCatalog"] = "boot.catalog"
+        return options
+
+    @classmethod
+    def _nodeAt(cls, root, path, create=True):
+        """Auxiliary method, return node for directory path, making directory nodes as needed."""
+        node = root
+        if not path:
+            return node
+        for name in path.split("/"):
+            child = node.children.get(name)
+            if child is None:
+                if not create:
+                    return None
+                child = _Node(name, node, isDirectory=True)
+                node.children[name] = child
+            node = child
+        return node
+
+    def _buildTree(self, options, overlayDirectory, replacedPathsOnIso):
+        """Auxiliary method, merge original .iso image entries and overlay directory into a tree."""
+        replaced = [self._normalizedPathOnIso(path) for path in replacedPathsOnIso]
+        def isReplaced(path):
+            for replacedPath in replaced:
+                if path == replacedPath or path.startswith(replacedPath + "/"):
+                    return True
+            return False
+        root = _Node("", None, isDirectory=True)
+        entries = self.originalEntries()
+        entriesByPath = dict((entry.path, entry) for entry in entries)
+        for entry in entries:
+            if isReplaced(entry.path):
+                continue
+            directoryPath, name = entry.path.rpartition("/")[0::2]
+            if options["transTbl"] and name.upper() == "TRANS.TBL":
+                # to be made anew
+                continue
+            directory = self._nodeAt(root, directoryPath)
+            if entry.isDirectory:
+                self._nodeAt(root, entry.path)
+                continue
+            node = _Node(name, directory, isDirectory=False)
+            if entry.symlinkTarget is not None:
+                target = None
+                if options["followLinks"]:
+                    # only within the .iso image
+                    targetPath = os.path.normpath(os.path.join("/" + directoryPath, entry.symlinkTarget))[1:]
+                    target = entriesByPath.get(targetPath)
+                if target is not None and not target.isDirectory and target.symlinkTarget is None:
+                    node.extents = target.extents
+                    node.size = target.size
+                else:
+                    node.symlinkTarget = entry.symlinkTarget
+            else:
+                node.extents = entry.extents
+                node.size = entry.size
+            directory.children[name] = node
+        if overlayDirectory:
+            for top, directoryNames, fileNames in os.walk(overlayDirectory, followlinks=options["followLinks"]):
+                relativeTop = os.path.relpath(top, overlayDirectory)
+                relativeTop = "" if relativeTop == "." else relativeTop.replace(os.sep, "/")
+                directory = self._nodeAt(root, relativeTop)
+                for directoryName in directoryNames:
+                    if not os.path.islink(os.path.join(top, directoryName)) or options["followLinks"]:
+                        self._nodeAt(directory, directoryName)
+                for fileName in fileNames + [name for name in directoryNames
+                                             if os.path.islink(os.path.join(top, name)) and not options["followLinks"]]:
+                    pathOnHost = os.path.join(top, fileName)
+                    node = _Node(fileName, directory, isDirectory=False)
+                    if os.path.islink(pathOnHost) and not options["followLinks"]:
+                        node.symlinkTarget = os.readlink(pathOnHost)
+                    else:
+                        node.hostPath = pathOnHost
+                        node.size = os.path.getsize(pathOnHost)
+                    directory.children[fileName] = node
+        if options["bootImage"]:
+            bootImageNode = self._nodeAt(root, options["bootImage"], create=False)
+            if bootImageNode is None or bootImageNode.isDirectory:
+                raise Exception("cannot find boot image {0} for {1}".format(options["bootImage"], self._isoImagePath))
+            if options["bootInfoTable"]:
+                # will be patched, hence read into memory
+                bootImageNode.data = self._readNodeContent(bootImageNode)
+                bootImageNode.extents = []
+                bootImageNode.hostPath = None
+            directoryPath, name = options["bootCatalog"].rpartition("/")[0::2]
+            directory = self._nodeAt(root, directoryPath)
+            bootCatalogNode = _Node(name, directory, isDirectory=False)
+            bootCatalogNode.data = "\x00" * IsoRemaster.sectorSize
+            bootCatalogNode.size = IsoRemaster.sectorSize
+            directory.children[name] = bootCatalogNode
+        return root
+
+    def _readNodeContent(self, node):
+        """Auxiliary method, return whole content of a file as a string."""
+        if node.data is not None:
+            return node.data
+        if node.hostPath is not None:
+            with open(node.hostPath, "rb") as inputFile:
+                return inputFile.read()
+        parts = []
+        with open(self._isoImagePath, "rb") as inputFile:
+            for byteOffset, byteLength in node.extents:
+                if byteOffset is None:
+                    parts.append("\x00" * byteLength)
+                else:
+                    inputFile.seek(byteOffset)
+                    parts.append(inputFile.read(byteLength))
+        return "".join(parts)
+
+    # names
+
+    _dCharactersRegex = re.compile(r"[^A-Z0-9_]")
+
+    @classmethod
+    def _assignIsoNames(cls, directory):
+        """Auxiliary method, assign ISO 9660 level 1 names, unique within directory."""
+        used = set()
+        for node in sorted(directory.children.values(), key=lambda node: node.name):
+            upper = node.name.upper()
+            if node.isDirectory:
+                base, extension = cls._dCharactersRegex.sub("_", upper)[:8], None
+            else:
+                dot = upper.rfind(".")
+                if dot > 0:
+                    base, extension = upper[:dot], upper[dot + 1:]
+                else:
+                    base, extension = upper, ""
+                base = cls._dCharactersRegex.sub("_", base)[:8]
+                extension = cls._dCharactersRegex.sub("_", extension)[:3]
+            candidateBase = base or "_"
+            counter = 0
+            while True:
+                if node.isDirectory:
+                    candidate = candidateBase
+                else:
+                    candidate = candidateBase + "." + extension + ";1"
+                if not candidate in used:
+                    break
+                suffix = str(counter)
+                candidateBase = base[:8 - len(suffix)] + suffix
+                counter += 1
+            used.add(candidate)
+            node.isoName = candidate
+
+    @classmethod
+    def _assignJolietNames(cls, directory, maxLength):
+        """Auxiliary method, assign Joliet names, unique within directory."""
+        used = set()
+        for node in sorted(directory.children.values(), key=lambda node: node.name):
+            name = node.name.decode("utf-8", "replace")
+            for character in u"*/:;?\\":
+                name = name.replace(character, u"_")
+            candidate = name[:maxLength]
+            counter = 0
+            while candidate.lower() in used:
+                suffix = unicode(counter)
+                candidate = name[:maxLength - len(suffix)] + suffix
+                counter += 1
+            used.add(candidate.lower())
+            node.jolietName = candidate.encode("utf-16-be") + (";1".encode("utf-16-be") if not node.isDirectory else "")
+
+    # binary fields
+
+    @classmethod
+    def _both16(cls, value):
+        return struct.pack("<H", value) + struct.pack(">H", value)
+
+    @classmethod
+    def _both32(cls, value):
+        return struct.pack("<I", value) + struct.pack(">I", value)
+
+    @classmethod
+    def _recordDate(cls, timeTuple):
+        return struct.pack("7B", timeTuple.tm_year - 1900, timeTuple.tm_mon, timeTuple.tm_mday,
+                           timeTuple.tm_hour, timeTuple.tm_min, timeTuple.tm_sec, 0)
+
+    @classmethod
+    def _descriptorDate(cls, timeTuple):
+        return time.strftime("%Y%m%d%H%M%S", timeTuple) + "00" + "\x00"
+
+    @classmethod
+    def _padded(cls, string, length, padding=" "):
+        return (string + padding * length)[:length]
+
+    @classmethod
+    def _roundUp(cls, length):
+        return -(-length // IsoRemaster.sectorSize) * IsoRemaster.sectorSize
+
+    # Rock Ridge
+
+    @classmethod
+    def _suspEntry(cls, signature, data, version=1):
+        return signature + chr(4 + len(data)) + chr(version) + data
+
+    def _rockRidgeEntries(self, node, kind):
+        """Auxiliary method, list of SUSP entries for a directory record.
+
+        kind
+            "self" or "parent" or "child"."""
+        entries = []
+        if kind == "self" and node.parent is None:
+            entries.append(self._suspEntry("SP", "\xbe\xef\x00"))
+        if node.symlinkTarget is not None:
+            mode, links = 0120777, 1
+        elif node.isDirectory:
+            mode, links = 040555, 2 + sum(1 for child in node.children.values() if child.isDirectory)
+        else:
+            mode, links = 0100444, 1
+        entries.append(self._suspEntry("RR", chr(0x01 | (0x08 if kind == "child" else 0) |
+                                                 (0x04 if node.symlinkTarget is not None else 0))))
+        entries.append(self._suspEntry("PX", self._both32(mode) + self._both32(links) +
+                                       self._both32(0) + self._both32(0)))
+        if kind == "child":
+            name = node.name
+            while True:
+                part, name = name[:250], name[250:]
+                entries.append(self._suspEntry("NM", chr(0x01 if name else 0x00) + part))
+                if not name:
+                    break
+        if node.symlinkTarget is not None and kind == "child":
+            components = ""
+            target = node.symlinkTarget
+            if target.startswith("/"):
+                components += "\x08\x00"
+                target = target.lstrip("/")
+            for component in target.split("/") if target else []:
+                if component == ".":
+                    components += "\x02\x00"
+                elif component == "..":
+                    components += "\x04\x00"
+                elif component:
+                    components += "\x00" + chr(len(component[:248])) + component[:248]
+            entries.append(self._suspEntry("SL", "\x00" + components))
+        if kind == "self" and node.parent is None:
+            entries.append(self._suspEntry("ER",
+                                           chr(len(IsoRemaster._rockRidgeIdentifier)) +
+                                           chr(len(IsoRemaster._rockRidgeDescriptor)) +
+                                           chr(len(IsoRemaster._rockRidgeSource)) +
+                                           chr(1) +
+                                           IsoRemaster._rockRidgeIdentifier +
+                                           IsoRemaster._rockRidgeDescriptor +
+                                           IsoRemaster._rockRidgeSource))
+        return entries
+
+    def _directoryRecord(self, identifier, location, dataLength, flags, systemUse=""):
+        """Auxiliary method, one directory record."""
+        record = (chr(0) + chr(0) +
+                  self._both32(location) + self._both32(dataLength) +
+                  self._recordDate(self._timeTuple) +
+                  chr(flags) + chr(0) + chr(0) +
+                  self._both16(1) +
+                  chr(len(identifier)) + identifier)
+        if len(identifier) % 2 == 0:
+            record += "\x00"
+        record += systemUse
+        if len(record) % 2:
+            record += "\x00"
+        if len(record) > 255:
+            raise Exception("directory record too long for {0}".format(identifier))
+        return chr(len(record)) + record[1:]
+
+    def _recordsFor(self, node, kind, identifier, location, dataLength, flags, joliet, continuation):
+        """Auxiliary method, directory records for a node, more than one if multi-extent.
+
+        continuation
+            a dictionary with "areas", a list of continuation areas, each a list [content, location, offset],
+            and "next", index of next area to reuse, for writing again with same sizes after locations are known."""
+        systemUse = ""
+        if self._options["rockRidge"] and not joliet:
+            entries = self._rockRidgeEntries(node, kind)
+            baseLength = 33 + len(identifier) + (1 if len(identifier) % 2 == 0 else 0)
+            available = 254 - baseLength
+            systemUse = "".join(entries)
+            if len(systemUse) > available:
+                # into a continuation area as much as needed
+                inline = ""
+                index = 0
+                while index < len(entries) and len(inline) + len(entries[index]) <= available - 28:
+                    inline += entries[index]
+                    index += 1
+                if continuation["next"] < len(continuation["areas"]):
+                    area = continuation["areas"][continuation["next"]]
+                else:
+                    area = ["".join(entries[index:]), 0, 0]
+                    continuation["areas"].append(area)
+                continuation["next"] += 1
+                systemUse = inline + self._suspEntry("CE", self._both32(area[1]) + self._both32(area[2]) +
+                                                           self._both32(len(area[0])))
+        if node is not None and not node.isDirectory and node.size > IsoRemaster.maxExtentSize:
+            records = []
+            remainder = dataLength
+            partLocation = location
+            while remainder > IsoRemaster.maxExtentSize:
+                records.append(self._directoryRecord(identifier, partLocation, IsoRemaster.maxExtentSize,
+                                                     flags | 0x80, systemUse))
+                partLocation += IsoRemaster.maxExtentSize // IsoRemaster.sectorSize
+                remainder -= IsoRemaster.maxExtentSize
+            records.append(self._directoryRecord(identifier, partLocation, remainder, flags, systemUse))
+            return records
+        return [self._directoryRecord(identifier, location, dataLength, flags, systemUse)]
+
+    def _directoryContent(self, directory, joliet, continuation):
+        """Auxiliary method, all directory records of a directory, padded to whole sectors."""
+        if not joliet:
+            location, size = directory.location, directory.directorySize
+            parent = directory.parent or directory
+            parentLocation, parentSize = parent.location, parent.directorySize
+            children = directory.sortedChildren(key=lambda node: node.isoName)
+        else:
+            location, size = directory.jolietLocation, directory.jolietDirectorySize
+            parent = directory.parent or directory
+            parentLocation, parentSize = parent.jolietLocation, parent.jolietDirectorySize
+            children = directory.sortedChildren(key=lambda node: node.jolietName)
+        records = self._recordsFor(directory, "self", "\x00", location, size, 0x02, joliet, continuation)
+        records += self._recordsFor(parent, "parent", "\x01", parentLocation, parentSize, 0x02, joliet, continuation)
+        for child in children:
+            identifier = child.isoName if not joliet else child.jolietName
+            if child.isDirectory:
+                if not joliet:
+                    childLocation, childSize = child.location, child.directorySize
+                else:
+                    childLocation, childSize = child.jolietLocation, child.jolietDirectorySize
+                records += self._recordsFor(child, "child", identifier, childLocation, childSize, 0x02,
+                                            joliet, continuation)
+            else:
+                records += self._recordsFor(child, "child", identifier, child.location, child.size, 0x00,
+                                            joliet, continuation)
+        content = ""
+        for record in records:
+            if len(content) % IsoRemaster.sectorSize + len(record) > IsoRemaster.sectorSize:
+                # records don't cross sector boundaries
+                content += "\x00" * (IsoRemaster.sectorSize - len(content) % IsoRemaster.sectorSize)
+            content += record
+        return content + "\x00" * (self._roundUp(len(content)) - len(content))
+
+    @classmethod
+    def _directoriesInPathTableOrder(cls, root, key):
+        """Auxiliary method, directories breadth first, siblings sorted."""
+        directories = [root]
+        index = 0
+        while index < len(directories):
+            directories.extend(child for child in directories[index].sortedChildren(key=key) if child.isDirectory)
+            index += 1
+        return directories
+
+    def _pathTable(self, directories, joliet, bigEndian):
+        """Auxiliary method, a path table."""
+        pack = ">" if bigEndian else "<"
+        table = ""
+        for directory in directories:
+            if directory.parent is None:
+                identifier = "\x00"
+                parentNumber = 1
+            else:
+                identifier = directory.isoName if not joliet else directory.jolietName
+                parentNumber = directory.parent.number if not joliet else directory.parent.jolietNumber
+            location = directory.location if not joliet else directory.jolietLocation
+            table += chr(len(identifier)) + chr(0) + struct.pack(pack + "I", location) + \
+                     struct.pack(pack + "H", parentNumber) + identifier
+            if len(identifier) % 2:
+                table += "\x00"
+        return table
+
+    def _volumeDescriptor(self, descriptorType, root, joliet, pathTableSize, pathTableLocations, volumeSpaceSize):
+        """Auxiliary method, a primary or supplementary volume descriptor."""
+        label = self._options["label"] or ""
+        if not joliet:
+            volumeIdentifier = self._padded(label.upper()[:32], 32)
+            rootRecord = self._directoryRecord("\x00", root.location, root.directorySize, 0x02)
+            escapeSequences = self._padded("", 32, "\x00")
+        else:
+            volumeIdentifier = (label.decode("utf-8", "replace")[:16] + u" " * 16)[:16].encode("utf-16-be")
+            rootRecord = self._directoryRecord("\x00", root.jolietLocation, root.jolietDirectorySize, 0x02)
+            escapeSequences = self._padded("%/E", 32, "\x00")
+        def text(string, length):
+            if not joliet:
+                return self._padded(string, length)
+            return self._padded(string.decode("utf-8").encode("utf-16-be"), length, "\x00 ") if string else \
+                   ("\x00 " * length)[:length]
+        descriptorDate = self._descriptorDate(self._timeTuple)
+        lPathTable, mPathTable = pathTableLocations
+        descriptor = (chr(descriptorType) + "CD001" + chr(1) + chr(0) +
+                      text("LINUX", 32) +
+                      volumeIdentifier +
+                      "\x00" * 8 +
+                      self._both32(volumeSpaceSize) +
+                      escapeSequences +
+                      self._both16(1) + self._both16(1) + self._both16(IsoRemaster.sectorSize) +
+                      self._both32(pathTableSize) +
+                      struct.pack("<I", lPathTable) + struct.pack("<I", 0) +
+                      struct.pack(">I", mPathTable) + struct.pack(">I", 0) +
+                      rootRecord +
+                      text("", 128) + text("", 128) + text("", 128) +
+                      text("NRVR COMMANDER", 128) +
+                      text("", 37) + text("", 37) + text("", 37) +
+                      descriptorDate + descriptorDate +
+                      "0000000000000000\x00" + "0000000000000000\x00" +
+                      chr(1) + chr(0))
+        return descriptor + "\x00" * (IsoRemaster.sectorSize - len(descriptor))
+
+    def _bootRecord(self, bootCatalogLocation):
+        """Auxiliary method, El Torito boot record volume descriptor."""
+        descriptor = (chr(0) + "CD001" + chr(1) +
+                      self._padded("EL TORITO SPECIFICATION", 32, "\x00") +
+                      "\x00" * 32 +
+                      struct.pack("<I", bootCatalogLocation))
+        return descriptor + "\x00" * (IsoRemaster.sectorSize - len(descriptor))
+
+    def _bootCatalog(self, bootImageNode):
+        """Auxiliary method, El Torito boot catalog with one no emulation entry."""
+        validation = chr(1) + chr(0) + "\x00\x00" + self._padded("", 24, "\x00") + "\x00\x00" + "\x55\xaa"
+        words = struct.unpack("<16H", validation)
+        checksum = (-sum(words)) & 0xffff
+        validation = validation[:28] + struct.pack("<H", checksum) + validation[30:]
+        bootLoadSize = self._options["bootLoadSize"]
+        if not bootLoadSize:
+            # genisoimage default for no emulation, whole boot image in 512-byte sectors
+            bootLoadSize = -(-bootImageNode.size // 512)
+        initial = (chr(0x88) + chr(0) + struct.pack("<H", 0) + chr(0) + chr(0) +
+                   struct.pack("<H", min(bootLoadSize, 0xffff)) + struct.pack("<I", bootImageNode.location) +
+                   "\x00" * 20)
+        catalog = validation + initial
+        return catalog + "\x00" * (IsoRemaster.sectorSize - len(catalog))
+
+    def _patchBootInfoTable(self, bootImageNode):
+        """Auxiliary method, as genisoimage -boot-info-table does."""
+        data = bootImageNode.data
+        if len(data) < 64:
+            raise Exception("boot image too small for boot info table")
+        paddedData = data + "\x00" * (-len(data) % 4)
+        checksum = sum(struct.unpack("<{0}I".format((len(paddedData) - 64) // 4), paddedData[64:])) & 0xffffffff
+        table = struct.pack("<IIII", Iso9660Reader.firstVolumeDescriptorSector, bootImageNode.location,
+                            len(data), checksum) + "\x00" * 40
+        bootImageNode.data = data[:8] + table + data[64:]
+
+    def _addTransTbls(self, root):
+        """Auxiliary method, as genisoimage -T does, a TRANS.TBL file in each directory."""
+        directories = self._directoriesInPathTableOrder(root, key=lambda node: node.name)
+        for directory in directories:
+            lines = []
+            for child in directory.sortedChildren(key=lambda node: node.isoName):
+                if child.symlinkTarget is not None:
+                    lines.append("L {0:<34}{1}\t{2}\n".format(child.isoName, child.name, child.symlinkTarget))
+                else:
+                    lines.append("{0} {1:<34}{2}\n".format("D" if child.isDirectory else "F",
+                                                           child.isoName, child.name))
+            node = _Node("TRANS.TBL", directory, isDirectory=False)
+            node.data = "".join(lines)
+            node.size = len(node.data)
+            node.isoName = "TRANS.TBL;1"
+            directory.children[node.name] = node
+
+    def _layoutAndWrite(self, root, options, cloneIsoImagePath):
+        """Auxiliary method, assign locations and write."""
+        self._options = options
+        self._timeTuple = time.gmtime()
+        isoNameKey = lambda node: node.isoName
+        jolietNameKey = lambda node: node.jolietName
+        # names
+        allDirectories = self._directoriesInPathTableOrder(root, key=lambda node: node.name)
+        for directory in allDirectories:
+            self._assignIsoNames(directory)
+        if options["transTbl"]:
+            self._addTransTbls(root)
+        directories = self._directoriesInPathTableOrder(root, key=isoNameKey)
+        for number, directory in enumerate(directories):
+            directory.number = number + 1
+        if options["joliet"]:
+            maxLength = 103 if options["jolietLong"] else 64
+            for directory in directories:
+                self._assignJolietNames(directory, maxLength)
+            jolietDirectories = self._directoriesInPathTableOrder(root, key=jolietNameKey)
+            for number, directory in enumerate(jolietDirectories):
+                directory.jolietNumber = number + 1
+        else:
+            jolietDirectories = []
+        # sizes, computed with provisional locations, same length regardless of locations
+        continuation = {"areas": [], "next": 0}
+        for directory in directories:
+            directory.directorySize = IsoRemaster.sectorSize
+            directory.directorySize = len(self._directoryContent(directory, False, continuation))
+        for directory in jolietDirectories:
+            directory.jolietDirectorySize = IsoRemaster.sectorSize
+            directory.jolietDirectorySize = len(self._directoryContent(directory, True, None))
+        continuationSize = 0
+        for area in continuation["areas"]:
+            if continuationSize % IsoRemaster.sectorSize + len(area[0]) > IsoRemaster.sectorSize:
+                continuationSize = self._roundUp(continuationSize)
+            continuationSize += len(area[0])
+        continuationSize = self._roundUp(continuationSize)
+        pathTableSize = len(self._pathTable(directories, False, False))
+        jolietPathTableSize = len(self._pathTable(jolietDirectories, True, False)) if options["joliet"] else 0
+        # locations
+        sector = Iso9660Reader.firstVolumeDescriptorSector
+        primaryVolumeDescriptorLocation = sector
+        sector += 1
+        bootRecordLocation = None
+        if options["bootImage"]:
+            bootRecordLocation = sector
+            sector += 1
+        jolietVolumeDescriptorLocation = None
+        if options["joliet"]:
+            jolietVolumeDescriptorLocation = sector
+            sector += 1
+        terminatorLocation = sector
+        sector += 1
+        pathTableSectors = self._roundUp(pathTableSize) // IsoRemaster.sectorSize
+        lPathTableLocation = sector
+        sector += pathTableSectors
+        mPathTableLocation = sector
+        sector += pathTableSectors
+        if options["joliet"]:
+            jolietPathTableSectors = self._roundUp(jolietPathTableSize) // IsoRemaster.sectorSize
+            jolietLPathTableLocation = sector
+            sector += jolietPathTableSectors
+            jolietMPathTableLocation = sector
+            sector += jolietPathTableSectors
+        for directory in directories:
+            directory.location = sector
+            sector += directory.directorySize // IsoRemaster.sectorSize
+        for directory in jolietDirectories:
+            directory.jolietLocation = sector
+            sector += directory.jolietDirectorySize // IsoRemaster.sectorSize
+        continuationLocation = sector
+        sector += continuationSize // IsoRemaster.sectorSize
+        # files, those from original .iso image in original order to read front to back
+        files = []
+        def collectFiles(directory):
+            for child in directory.sortedChildren(key=isoNameKey):
+                if child.isDirectory:
+                    collectFiles(child)
+                elif child.symlinkTarget is None:
+                    files.append(child)
+        collectFiles(root)
+        bootCatalogNode = self._nodeAt(root, options["bootCatalog"], create=False) if options["bootImage"] else None
+        bootImageNode = self._nodeAt(root, options["bootImage"], create=False) if options["bootImage"] else None
+        def firstByteOffset(node):
+            for byteOffset, byteLength in node.extents:
+                if byteOffset is not None:
+                    return byteOffset
+            return 0
+        originalFiles = sorted((node for node in files if node.extents), key=firstByteOffset)
+        otherFiles = [node for node in files if not node.extents]
+        if bootCatalogNode is not None:
+            # boot catalog first, then others
+            otherFiles.remove(bootCatalogNode)
+            otherFiles.insert(0, bootCatalogNode)
+        orderedFiles = otherFiles + originalFiles
+        for node in orderedFiles:
+            if node.size:
+                node.location = sector
+                sector += self._roundUp(node.size) // IsoRemaster.sectorSize
+            else:
+                node.location = 0
+        volumeSpaceSize = sector
+        # continuation area locations
+        offset = 0
+        for area in continuation["areas"]:
+            if offset % IsoRemaster.sectorSize + len(area[0]) > IsoRemaster.sectorSize:
+                offset = self._roundUp(offset)
+            area[1] = continuationLocation + offset // IsoRemaster.sectorSize
+            area[2] = offset % IsoRemaster.sectorSize
+            offset += len(area[0])
+        # boot
+        if bootImageNode is not None:
+            if options["bootInfoTable"]:
+                self._patchBootInfoTable(bootImageNode)
+            bootCatalogNode.data = self._bootCatalog(bootImageNode)
+        # write
+        with open(cloneIsoImagePath, "wb") as outputFile:
+            # system area
+            outputFile.write("\x00" * (Iso9660Reader.firstVolumeDescriptorSector * IsoRemaster.sectorSize))
+            outputFile.write(self._volumeDescriptor(1, root, False, pathTableSize,
+                                                    (lPathTableLocation, mPathTableLocation), volumeSpaceSize))
+            if bootRecordLocation is not None:
+                outputFile.write(self._bootRecord(bootCatalogNode.location))
+            if jolietVolumeDescriptorLocation is not None:
+                outputFile.write(self._volumeDescriptor(2, root, True, jolietPathTableSize,
+                                                        (jolietLPathTableLocation, jolietMPathTableLocation),
+                                                        volumeSpaceSize))
+            terminator = chr(255) + "CD001" + chr(1)
+            outputFile.write(terminator + "\x00" * (IsoRemaster.sectorSize - len(terminator)))
+            def writePadded(data):
+                outputFile.write(data)
+                outputFile.write("\x00" * (self._roundUp(len(data)) - len(data)))
+            writePadded(self._pathTable(directories, False, False))
+            writePadded(self._pathTable(directories, False, True))
+            if options["joliet"]:
+                writePadded(self._pathTable(jolietDirectories, True, False))
+                writePadded(self._pathTable(jolietDirectories, True, True))
+            # final records now with final locations
+            continuation["next"] = 0
+            for directory in directories:
+                outputFile.write(self._directoryContent(directory, False, continuation))
+            for directory in jolietDirectories:
+                outputFile.write(self._directoryContent(directory, True, None))
+            # continuation areas
+            continuationContent = ""
+            for area in continuation["areas"]:
+                offset = (area[1] - continuationLocation) * IsoRemaster.sectorSize + area[2]
+                continuationContent += "\x00" * (offset - len(continuationContent)) + area[0]
+            writePadded(continuationContent)
+            # file content
+            inputFile = open(self._isoImagePath, "rb") if self._isoImagePath else None
+            try:
+                for node in orderedFiles:
+                    if not node.size:
+                        continue
+                    if node.data is not None:
+                        outputFile.write(node.data)
+                    elif node.hostPath is not None:
+                        with open(node.hostPath, "rb") as hostFile:
+                            copyExtents(hostFile, [(0, node.size)], outputFile, chunkSize=4194304)
+                    else:
+                        copyExtents(inputFile, node.extents, outputFile, chunkSize=4194304)
+                    outputFile.write("\x00" * (self._roundUp(node.size) - node.size))
+            finally:
+                if inputFile:
+                    inputFile.close()
+            if outputFile.tell() != volumeSpaceSize * IsoRemaster.sectorSize:
+                raise Exception("internal error writing {0}, size {1} instead of {2}".format(cloneIsoImagePath, outputFile.tell(), volumeSpaceSize * IsoRemaster.sectorSize))
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 2:
+        IsoRemaster(sys.argv[1]).write(sys.argv[2], ["-r", "-T", "-f", "-J", "-V", "REMASTERED"])
+        _reader = Iso9660Reader(sys.argv[2])
+        print "volume identifier " + _reader.volumeIdentifier
+        print "Rock Ridge " + str(_reader.hasRockRidge) + ", Joliet " + str(_reader.hasJoliet)
+        for _entry in _reader.entries():
+            print "{0:>12} {1}{2}".format(_entry.size, _entry.path, "/" if _entry.isDirectory else "")
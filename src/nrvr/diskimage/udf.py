@@ -0,0 +1,413 @@
+#!/usr/bin/python
+
+"""nrvr.diskimage.udf - Read a UDF .iso disk image in-process
+
+The main class provided by this module is UdfReader.
+
+Reads the anchor volume descriptor pointer, the volume descriptor sequence,
+the file set descriptor, and the file entries and file identifier descriptors
+of a UDF .iso image directly, without spawning any iso-info or iso-read subprocesses.
+
+Supports type 1 and metadata partition maps,
+short and long and extended allocation descriptors, and embedded data.
+Does not support virtual partitions of incrementally written media.
+
+It should work in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import struct
+
+from nrvr.diskimage.iso9660 import IsoImageEntry
+
+class UdfReader(object):
+    """Reads the directory structure of a UDF .iso image in-process."""
+
+    sectorSize = 2048
+    anchorSector = 256
+
+    # descriptor tag identifiers
+    _primaryVolumeDescriptorTag = 1
+    _anchorVolumeDescriptorPointerTag = 2
+    _volumeDescriptorPointerTag = 3
+    _partitionDescriptorTag = 5
+    _logicalVolumeDescriptorTag = 6
+    _terminatingDescriptorTag = 8
+    _fileSetDescriptorTag = 256
+    _fileIdentifierDescriptorTag = 257
+    _allocationExtentDescriptorTag = 258
+    _fileEntryTag = 261
+    _extendedFileEntryTag = 266
+
+    # file types in ICB tag
+    _fileTypeDirectory = 4
+    _fileTypeSymlink = 12
+
+    # file characteristics in file identifier descriptor
+    _characteristicDirectory = 0x02
+    _characteristicDeleted = 0x04
+    _characteristicParent = 0x08
+
+    def __init__(self, isoImagePath):
+        """Create new UdfReader.
+
+        Reads the volume descriptors right away.
+        Reads the directory structure when first needed.
+
+        isoImagePath
+            path of the .iso image."""
+        self._isoImagePath = isoImagePath
+        self._logicalBlockSize = UdfReader.sectorSize
+        self._logicalVolumeIdentifier = None
+        # partition number to starting sector
+        self._partitionStarts = {}
+        # partition reference number to a function mapping a logical block number to a byte offset
+        self._partitionMaps = []
+        self._rootIcb = None
+        self._entries = None
+        with open(self._isoImagePath, "rb") as imageFile:
+            self._readVolumeDescriptors(imageFile)
+            self._readFileSetDescriptor(imageFile)
+
+    @property
+    def isoImagePath(self):
+        """Path of the .iso image."""
+        return self._isoImagePath
+
+    @property
+    def logicalVolumeIdentifier(self):
+        """Logical volume identifier, aka label."""
+        return self._logicalVolumeIdentifier
+
+    @property
+    def logicalBlockSize(self):
+        """Logical block size in bytes, normally 2048."""
+        return self._logicalBlockSize
+
+    @classmethod
+    def isUdf(cls, isoImagePath):
+        """Return whether there is a UDF anchor volume descriptor pointer."""
+        with open(isoImagePath, "rb") as imageFile:
+            imageFile.seek(UdfReader.anchorSector * UdfReader.sectorSize)
+            data = imageFile.read(16)
+        return len(data) == 16 and struct.unpack_from("<H", data, 0)[0] == UdfReader._anchorVolumeDescriptorPointerTag
+
+    def _readAt(self, imageFile, byteOffset, byteLength):
+        """Auxiliary method, read exactly, or raise an exception."""
+        imageFile.seek(byteOffset)
+        data = imageFile.read(byteLength)
+        if len(data) != byteLength:
+            raise Exception("unexpected end of {0} reading {1} bytes at byte {2}".format(self._isoImagePath, byteLength, byteOffset))
+        return data
+
+    def _readDescriptor(self, imageFile, byteOffset, byteLength, expectedTags):
+        """Auxiliary method, read a descriptor and check its tag identifier.
+
+        Return 2-tuple (tagIdentifier, data)."""
+        data = self._readAt(imageFile, byteOffset, byteLength)
+        tagIdentifier = struct.unpack_from("<H", data, 0)[0]
+        if expectedTags is not None and tagIdentifier not in expectedTags:
+            raise Exception("unexpected UDF descriptor tag {0} instead of {1} at byte {2} of {3}".format(tagIdentifier, expectedTags, byteOffset, self._isoImagePath))
+        return tagIdentifier, data
+
+    @classmethod
+    def _dstring(cls, data):
+        """Auxiliary method, decode OSTA compressed unicode into a UTF-8 string."""
+        if not data:
+            return ""
+        compressionId = ord(data[0])
+        if compressionId in (8, 254):
+            name = data[1:].decode("latin-1")
+        elif compressionId in (16, 255):
+            name = data[1:].decode("utf-16-be", "replace")
+        else:
+            raise Exception("unexpected UDF compression id {0}".format(compressionId))
+        return name.encode("utf-8")
+
+    def _readVolumeDescriptors(self, imageFile):
+        """Auxiliary method, called by constructor."""
+        tagIdentifier, anchor = self._readDescriptor(imageFile, UdfReader.anchorSector * UdfReader.sectorSize, 512,
+                                                     [UdfReader._anchorVolumeDescriptorPointerTag])
+        sequenceLength, sequenceLocation = struct.unpack_from("<II", anchor, 16)
+        logicalVolumeDescriptor = None
+        sector = sequenceLocation
+        stopSector = sequenceLocation + sequenceLength // UdfReader.sectorSize
+        while sector < stopSector:
+            tagIdentifier, descriptor = self._readDescriptor(imageFile, sector * UdfReader.sectorSize,
+                                                             UdfReader.sectorSize, None)
+            sector += 1
+            if tagIdentifier == UdfReader._partitionDescriptorTag:
+                partitionNumber = struct.unpack_from("<H", descriptor, 22)[0]
+                self._partitionStarts[partitionNumber] = struct.unpack_from("<I", descriptor, 188)[0]
+            elif tagIdentifier == UdfReader._logicalVolumeDescriptorTag:
+                logicalVolumeDescriptor = descriptor
+            elif tagIdentifier == UdfReader._volumeDescriptorPointerTag:
+                # continue at next extent of volume descriptor sequence
+                sequenceLength, sequenceLocation = struct.unpack_from("<II", descriptor, 20)
+                sector = sequenceLocation
+                stopSector = sequenceLocation + sequenceLength // UdfReader.sectorSize
+            elif tagIdentifier == UdfReader._terminatingDescriptorTag or tagIdentifier == 0:
+                break
+        if logicalVolumeDescriptor is None or not self._partitionStarts:
+            raise Exception("no UDF logical volume or partition in {0}".format(self._isoImagePath))
+        self._logicalBlockSize = struct.unpack_from("<I", logicalVolumeDescriptor, 212)[0]
+        self._logicalVolumeIdentifier = self._dstring(logicalVolumeDescriptor[84:84 + ord(logicalVolumeDescriptor[211])])
+        # long_ad of file set descriptor
+        self._fileSetDescriptorAddress = struct.unpack_from("<IH", logicalVolumeDescriptor, 252)
+        numberOfPartitionMaps = struct.unpack_from("<I", logicalVolumeDescriptor, 268)[0]
+        offset = 440
+        metadataMaps = []
+        for partitionReference in range(numberOfPartitionMaps):
+            mapType = ord(logicalVolumeDescriptor[offset])
+            mapLength = ord(logicalVolumeDescriptor[offset + 1])
+            if mapType == 1:
+                partitionNumber = struct.unpack_from("<H", logicalVolumeDescriptor, offset + 4)[0]
+                self._partitionMaps.append(self._physicalMapping(partitionNumber))
+            elif mapType == 2:
+                identifier = logicalVolumeDescriptor[offset + 5:offset + 28].rstrip("\x00")
+                partitionNumber = struct.unpack_from("<H", logicalVolumeDescriptor, offset + 38)[0]
+                if identifier == "*UDF Metadata Partition":
+                    metadataFileLocation = struct.unpack_from("<I", logicalVolumeDescriptor, offset + 40)[0]
+                    # placeholder, resolved below once physical mappings are known
+                    self._partitionMaps.append(None)
+                    metadataMaps.append((partitionReference, partitionNumber, metadataFileLocation))
+                elif identifier == "*UDF Sparable Partition":
+                    # read-only images have no defects to spare, hence same as physical
+                    self._partitionMaps.append(self._physicalMapping(partitionNumber))
+                else:
+                    raise Exception("unsupported UDF partition map {0} in {1}".format(identifier, self._isoImagePath))
+            else:
+                raise Exception("unsupported UDF partition map type {0} in {1}".format(mapType, self._isoImagePath))
+            offset += mapLength
+        for partitionReference, partitionNumber, metadataFileLocation in metadataMaps:
+            physicalMapping = self._physicalMapping(partitionNumber)
+            fileType, informationLength, extents = self._readFileEntry(imageFile,
+                                                                       physicalMapping(metadataFileLocation),
+                                                                       physicalMapping)
+            self._partitionMaps[partitionReference] = self._metadataMapping(extents)
+
+    def _physicalMapping(self, partitionNumber):
+        """Auxiliary method, return a function mapping a logical block number to a byte offset."""
+        if not partitionNumber in self._partitionStarts:
+            raise Exception("no UDF partition number {0} in {1}".format(partitionNumber, self._isoImagePath))
+        partitionStart = self._partitionStarts[partitionNumber]
+        logicalBlockSize = self._logicalBlockSize
+        return lambda logicalBlockNumber: (partitionStart * UdfReader.sectorSize
+                                           + logicalBlockNumber * logicalBlockSize)
+
+    def _metadataMapping(self, extents):
+        """Auxiliary method, return a function mapping a logical block number to a byte offset,
+        in a metadata partition consisting of extents."""
+        logicalBlockSize = self._logicalBlockSize
+        def mapping(logicalBlockNumber):
+            remainder = logicalBlockNumber * logicalBlockSize
+            for byteOffset, byteLength in extents:
+                if remainder < byteLength:
+                    return byteOffset + remainder
+                remainder -= byteLength
+            raise Exception("UDF metadata partition block {0} out of range".format(logicalBlockNumber))
+        return mapping
+
+    def _mapping(self, partitionReference):
+        """Auxiliary method, mapping function for a partition reference number."""
+        if partitionReference >= len(self._partitionMaps):
+            raise Exception("no UDF partition reference {0} in {1}".format(partitionReference, self._isoImagePath))
+        return self._partitionMaps[partitionReference]
+
+    def _readFileSetDescriptor(self, imageFile):
+        """Auxiliary method, called by constructor."""
+        logicalBlockNumber, partitionReference = self._fileSetDescriptorAddress
+        tagIdentifier, fileSetDescriptor = self._readDescriptor(imageFile,
+                                                                self._mapping(partitionReference)(logicalBlockNumber),
+                                                                512,
+                                                                [UdfReader._fileSetDescriptorTag])
+        # long_ad of root directory ICB
+        self._rootIcb = struct.unpack_from("<IH", fileSetDescriptor, 404)
+
+    def _allocationDescriptors(self, imageFile, data, adType, mapping):
+        """Auxiliary method, return a list of extents from allocation descriptors.
+
+        Extents not recorded are returned as (None, byteLength), meaning zeros."""
+        extents = []
+        # guard against loops in a damaged image
+        continuations = 0
+        while data:
+            nextData = None
+            offset = 0
+            if adType == 0: # short_ad
+                adSize = 8
+            elif adType == 1: # long_ad
+                adSize = 16
+            elif adType == 2: # ext_ad
+                adSize = 20
+            else:
+                raise Exception("unexpected UDF allocation descriptor type {0}".format(adType))
+            while offset + adSize <= len(data):
+                lengthAndType = struct.unpack_from("<I", data, offset)[0]
+                extentLength = lengthAndType & 0x3fffffff
+                extentType = lengthAndType >> 30
+                if extentLength == 0:
+                    break
+                if adType == 0:
+                    logicalBlockNumber = struct.unpack_from("<I", data, offset + 4)[0]
+                    extentMapping = mapping
+                elif adType == 1:
+                    logicalBlockNumber, partitionReference = struct.unpack_from("<IH", data, offset + 4)
+                    extentMapping = self._mapping(partitionReference)
+                else:
+                    logicalBlockNumber, partitionReference = struct.unpack_from("<IH", data, offset + 12)
+                    extentMapping = self._mapping(partitionReference)
+                offset += adSize
+                if extentType == 3:
+                    # next extent of allocation descriptors
+                    if continuations < 1024:
+                        continuations += 1
+                        tagIdentifier, allocationExtentDescriptor = \
+                            self._readDescriptor(imageFile, extentMapping(logicalBlockNumber), extentLength,
+                                                 [UdfReader._allocationExtentDescriptorTag])
+                        lengthOfAllocationDescriptors = struct.unpack_from("<I", allocationExtentDescriptor, 20)[0]
+                        nextData = allocationExtentDescriptor[24:24 + lengthOfAllocationDescriptors]
+                    break
+                elif extentType == 0:
+                    extents.append((extentMapping(logicalBlockNumber), extentLength))
+                else:
+                    # allocated and not recorded, or not allocated, reads as zeros
+                    extents.append((None, extentLength))
+            data = nextData
+        return extents
+
+    def _readFileEntry(self, imageFile, byteOffset, mapping):
+        """Auxiliary method, read a file entry or extended file entry.
+
+        Return 3-tuple (fileType, informationLength, extents)."""
+        tagIdentifier, fileEntry = self._readDescriptor(imageFile, byteOffset, self._logicalBlockSize,
+                                                        [UdfReader._fileEntryTag, UdfReader._extendedFileEntryTag])
+        fileType = ord(fileEntry[27])
+        icbFlags = struct.unpack_from("<H", fileEntry, 34)[0]
+        adType = icbFlags & 0x07
+        informationLength = struct.unpack_from("<Q", fileEntry, 56)[0]
+        if tagIdentifier == UdfReader._fileEntryTag:
+            lengthOfExtendedAttributes, lengthOfAllocationDescriptors = struct.unpack_from("<II", fileEntry, 168)
+            adStart = 176 + lengthOfExtendedAttributes
+        else:
+            lengthOfExtendedAttributes, lengthOfAllocationDescriptors = struct.unpack_from("<II", fileEntry, 208)
+            adStart = 216 + lengthOfExtendedAttributes
+        if adType == 3:
+            # embedded data
+            extents = [(byteOffset + adStart, lengthOfAllocationDescriptors)] if lengthOfAllocationDescriptors else []
+        else:
+            extents = self._allocationDescriptors(imageFile,
+                                                  fileEntry[adStart:adStart + lengthOfAllocationDescriptors],
+                                                  adType, mapping)
+        # trim to information length, last extent may be rounded up to a whole block
+        trimmedExtents = []
+        remainder = informationLength
+        for extentByteOffset, extentLength in extents:
+            if remainder <= 0:
+                break
+            extentLength = min(extentLength, remainder)
+            trimmedExtents.append((extentByteOffset, extentLength))
+            remainder -= extentLength
+        return fileType, informationLength, trimmedExtents
+
+    def _readExtents(self, imageFile, extents):
+        """Auxiliary method, read content of extents into a string."""
+        parts = []
+        for byteOffset, byteLength in extents:
+            if byteOffset is None:
+                parts.append("\x00" * byteLength)
+            else:
+                parts.append(self._readAt(imageFile, byteOffset, byteLength))
+        return "".join(parts)
+
+    @classmethod
+    def _symlinkTarget(cls, content):
+        """Auxiliary method, decode UDF path components into a symbolic link target."""
+        components = []
+        offset = 0
+        while offset + 4 <= len(content):
+            componentType = ord(content[offset])
+            componentLength = ord(content[offset + 1])
+            componentIdentifier = content[offset + 4:offset + 4 + componentLength]
+            offset += 4 + componentLength
+            if componentType in (1, 2):
+                # root
+                components = [""]
+            elif componentType == 3:
+                components.append("..")
+            elif componentType == 4:
+                components.append(".")
+            elif componentType == 5:
+                components.append(cls._dstring(componentIdentifier))
+        if components == [""]:
+            return "/"
+        return "/".join(components)
+
+    def entries(self):
+        """Return a list of IsoImageEntry, for all directories and files.
+
+        Directories are listed before their contents."""
+        if self._entries is None:
+            entries = []
+            with open(self._isoImagePath, "rb") as imageFile:
+                rootLogicalBlockNumber, rootPartitionReference = self._rootIcb
+                directoriesToDo = [("", rootLogicalBlockNumber, rootPartitionReference)]
+                # guard against loops in a damaged image
+                directoriesSeen = set()
+                while directoriesToDo:
+                    directoryPath, logicalBlockNumber, partitionReference = directoriesToDo.pop(0)
+                    mapping = self._mapping(partitionReference)
+                    directoryByteOffset = mapping(logicalBlockNumber)
+                    if directoryByteOffset in directoriesSeen:
+                        continue
+                    directoriesSeen.add(directoryByteOffset)
+                    fileType, informationLength, extents = self._readFileEntry(imageFile, directoryByteOffset, mapping)
+                    directoryContent = self._readExtents(imageFile, extents)
+                    offset = 0
+                    while offset + 38 <= len(directoryContent):
+                        tagIdentifier = struct.unpack_from("<H", directoryContent, offset)[0]
+                        if tagIdentifier != UdfReader._fileIdentifierDescriptorTag:
+                            raise Exception("unexpected UDF descriptor tag {0} in directory {1} of {2}".format(tagIdentifier, directoryPath, self._isoImagePath))
+                        fileCharacteristics = ord(directoryContent[offset + 18])
+                        lengthOfFileIdentifier = ord(directoryContent[offset + 19])
+                        icbExtentLength, icbLogicalBlockNumber, icbPartitionReference = \
+                            struct.unpack_from("<IIH", directoryContent, offset + 20)
+                        lengthOfImplementationUse = struct.unpack_from("<H", directoryContent, offset + 36)[0]
+                        identifierStart = offset + 38 + lengthOfImplementationUse
+                        fileIdentifier = directoryContent[identifierStart:identifierStart + lengthOfFileIdentifier]
+                        # padded to a multiple of 4 bytes
+                        offset += (38 + lengthOfImplementationUse + lengthOfFileIdentifier + 3) & ~3
+                        if fileCharacteristics & (UdfReader._characteristicParent | UdfReader._characteristicDeleted):
+                            continue
+                        name = self._dstring(fileIdentifier)
+                        path = directoryPath + "/" + name if directoryPath else name
+                        if fileCharacteristics & UdfReader._characteristicDirectory:
+                            entries.append(IsoImageEntry(path=path, isDirectory=True, extents=[], size=0,
+                                                         symlinkTarget=None))
+                            directoriesToDo.append((path, icbLogicalBlockNumber, icbPartitionReference))
+                            continue
+                        childMapping = self._mapping(icbPartitionReference)
+                        childFileType, childInformationLength, childExtents = \
+                            self._readFileEntry(imageFile, childMapping(icbLogicalBlockNumber), childMapping)
+                        if childFileType == UdfReader._fileTypeSymlink:
+                            symlinkTarget = self._symlinkTarget(self._readExtents(imageFile, childExtents))
+                            entries.append(IsoImageEntry(path=path, isDirectory=False, extents=[], size=0,
+                                                         symlinkTarget=symlinkTarget))
+                        else:
+                            entries.append(IsoImageEntry(path=path, isDirectory=False, extents=childExtents,
+                                                         size=childInformationLength, symlinkTarget=None))
+            self._entries = entries
+        return list(self._entries)
+
+if __name__ == "__main__":
+    import sys
+    if len(sys.argv) > 1:
+        _reader = UdfReader(sys.argv[1])
+        print "logical volume identifier " + _reader.logicalVolumeIdentifier
+        for _entry in _reader.entries():
+            print "{0:>12} {1}{2}".format(_entry.size, _entry.path, "/" if _entry.isDirectory else "")
@@ -18,15 +18,26 @@ Public repository - https://github.com/srguiwiz/nrvr-commander
 Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
+import hashlib
+import os
+import os.path
 import re
 
 import nrvr.diskimage.isoimage
-from nrvr.process.commandcapture import CommandCapture
+from nrvr.process.commandmemo import CommandMemo
 from nrvr.util.networkinterface import NetworkConfigurationStaticParameters
+from nrvr.util.times import Timestamp
 
 class DistroIsoImage(nrvr.diskimage.isoimage.IsoImage):
     """A Linux distribution .iso ISO CD-ROM or DVD-ROM disk image."""
 
+    # paths on .iso image needed to boot, kept in a boot-only .iso image,
+    # may be different per distro specific subclass
+    bootOnlyPathsOnIso = ["isolinux"]
+
+    # path of the kickstart file on a config .iso image
+    kickstartPathOnConfigIso = "ks.cfg"
+
     def __init__(self, isoImagePath):
         """Create new Linux distribution DistroIsoImage descriptor.
         
@@ -60,6 +71,38 @@ class DistroIsoImage(nrvr.diskimage.isoimage.IsoImage):
         ])
         return genisoimageOptions
 
+    def validateElToritoBoot(self,
+                             bootImage="isolinux/isolinux.bin", bootCatalog="isolinux/boot.cat"):
+        """Check bootImage and bootCatalog, as would be passed to method genisoimageOptions,
+        against the El Torito boot catalog of the original .iso image.
+        
+        Raises an exception if there is no file bootImage,
+        or if bootImage isn't the boot image of any entry in the boot catalog,
+        because then a clone wouldn't boot the same way.
+        Only prints a note if bootCatalog isn't where the boot catalog is,
+        because genisoimage makes a new one anyway.
+        
+        Reads in-process, see nrvr.diskimage.eltorito.
+        
+        return
+            the nrvr.diskimage.eltorito.ElToritoBootCatalog."""
+        bootCatalogOfOriginal = self.elToritoBootCatalog()
+        bootImageEntry = self.entry(bootImage)
+        if bootImageEntry is None or bootImageEntry.isDirectory:
+            raise Exception("no boot image {0} in {1}".format(bootImage, self._isoImagePath))
+        bootEntries = [bootEntry for bootEntry in bootCatalogOfOriginal.entries
+                       if bootEntry.byteOffset == bootImageEntry.firstByteOffset]
+        if not bootEntries:
+            raise Exception("boot image {0} is not in El Torito boot catalog of {1}, which has {2}".format
+                            (bootImage, self._isoImagePath,
+                             ", ".join("{0} at sector {1}".format(bootEntry.platformName, bootEntry.loadRba)
+                                       for bootEntry in bootCatalogOfOriginal.entries)))
+        bootCatalogEntry = self.entry(bootCatalog)
+        if bootCatalogEntry is None \
+                or bootCatalogEntry.firstByteOffset != bootCatalogOfOriginal.catalogSector * 2048:
+            print "note El Torito boot catalog of {0} is not {1}".format(self._isoImagePath, bootCatalog)
+        return bootCatalogOfOriginal
+
     def modificationsIncludingKickstartFile(self, _kickstartFileContent):
         """Construct and return a list of modifications to be passed to method cloneWithModifications.
         
@@ -77,8 +120,163 @@ class DistroIsoImage(nrvr.diskimage.isoimage.IsoImage):
         modifications = []
         return modifications
 
+    def modificationsForAutoBooting(self, kickstartLocation):
+        """Construct and return a list of modifications which make the .iso image
+        automatically boot with a kickstart file at kickstartLocation.
+        
+        Called by method bootOnlyIsoImage.
+        
+        Subclasses should provide implementations of this method.
+        Expected to be different per distro specific subclass.
+        This class implementation raises an exception.
+        
+        kickstartLocation
+            as would be given by ks= on the boot line, e.g. "hd:sr1:/ks.cfg".
+        
+        Return a list of modifications."""
+        raise Exception("booting with a kickstart file from a config .iso image not implemented for {0}".format
+                        (self.__class__.__name__))
+
+    def bootOnlyIsoImage(self, configDevice="sr1", bootOnlyIsoImagePath=None, kickstartUrl=None):
+        """Return a small .iso image which only boots, with the boot line pointing at a kickstart file
+        on a config .iso image, see method configIsoImageWithKickstart,
+        or at a kickstart file served by HTTP, see method isoImagesForKickstartFromServer.
+        
+        Keeps only bootOnlyPathsOnIso, e.g. isolinux with kernel and initrd.
+        Meant to be attached to a virtual machine together with a config .iso image
+        and with this .iso image unmodified as the package source,
+        see method isoImagesForAutoBootingKickstart.
+        
+        Derived once per distro .iso image, then reused.
+        By default kept in a directory next to this .iso image, keyed by identity of this .iso image.
+        
+        configDevice
+            device name of the config .iso image as seen by the installer,
+            "sr1" for the second CD-ROM drive.
+        
+        bootOnlyIsoImagePath
+            if not given then in a directory next to this .iso image.
+        
+        kickstartUrl
+            if given then the boot line points at it rather than at configDevice,
+            e.g. "http://10.123.45.1:8019/ks.cfg".
+        
+        return
+            IsoImage(bootOnlyIsoImagePath)."""
+        if kickstartUrl:
+            kickstartLocation = kickstartUrl
+            variant = "url-" + hashlib.sha256(kickstartUrl).hexdigest()[:16]
+        else:
+            kickstartLocation = "hd:" + configDevice + ":/" + self.kickstartPathOnConfigIso
+            variant = configDevice
+        if not bootOnlyIsoImagePath:
+            bootOnlyDirectory = self._isoImagePath + ".bootonly"
+            identity = self._identity()
+            if not os.path.exists(bootOnlyDirectory):
+                os.mkdir(bootOnlyDirectory, 0755)
+            # remove stale boot-only .iso images of a previous .iso image at the same path
+            isoImageIdentityPrefix = "-".join(identity.split("-")[:2]) + "-"
+            for otherName in os.listdir(bootOnlyDirectory):
+                if not otherName.startswith(isoImageIdentityPrefix):
+                    os.remove(os.path.join(bootOnlyDirectory, otherName))
+            bootOnlyIsoImagePath = os.path.join(bootOnlyDirectory, "{0}-{1}.iso".format(identity, variant))
+        if os.path.exists(bootOnlyIsoImagePath):
+            return nrvr.diskimage.isoimage.IsoImage(bootOnlyIsoImagePath)
+        # fail early rather than after extracting
+        self.validateElToritoBoot()
+        keptNames = set(path.strip("/").split("/")[0] for path in self.bootOnlyPathsOnIso)
+        modifications = [nrvr.diskimage.isoimage.IsoImageModificationRemoval(entry.path)
+                         for entry in self.listing()
+                         if not "/" in entry.path and not entry.path in keptNames]
+        modifications.extend(self.modificationsForAutoBooting(kickstartLocation))
+        # made under a temporary name, for a concurrent process not to see it incomplete
+        temporaryIsoImagePath = bootOnlyIsoImagePath + ".tmp" + Timestamp.microsecondTimestamp()
+        self.cloneWithModifications(modifications=modifications,
+                                    cloneIsoImagePath=temporaryIsoImagePath,
+                                    engine="remaster")
+        os.rename(temporaryIsoImagePath, bootOnlyIsoImagePath)
+        return nrvr.diskimage.isoimage.IsoImage(bootOnlyIsoImagePath)
+
+    def configIsoImageWithKickstart(self, _kickstartFileContent, configIsoImagePath=None):
+        """Make a small config .iso image with only a kickstart file, per virtual machine.
+        
+        Takes well under a second, see class IsoImage method createWithModifications.
+        
+        _kickstartFileContent
+            A DistroKickstartFileContent object.
+        
+        configIsoImagePath
+            if not given then in same directory as this .iso image with a timestamp in the filename.
+        
+        return
+            IsoImage(configIsoImagePath)."""
+        # timestamp to the microsecond should be good enough
+        timestamp = Timestamp.microsecondTimestamp()
+        if not configIsoImagePath:
+            isoImagePathSplitext = os.path.splitext(self._isoImagePath)
+            configIsoImagePath = isoImagePathSplitext[0] + ".config." + timestamp + isoImagePathSplitext[1]
+        return nrvr.diskimage.isoimage.IsoImage.createWithModifications \
+            (configIsoImagePath,
+             [nrvr.diskimage.isoimage.IsoImageModificationFromString
+              (self.kickstartPathOnConfigIso,
+               _kickstartFileContent.string)],
+             label="ks-" + timestamp)
+
+    def isoImagesForAutoBootingKickstart(self, _kickstartFileContent, configIsoImagePath=None):
+        """Alternative to method cloneWithAutoBootingKickstart without cloning all of this .iso image.
+        
+        Returns a boot-only .iso image, see method bootOnlyIsoImage,
+        a config .iso image with the kickstart file, see method configIsoImageWithKickstart,
+        and this .iso image unmodified as the package source.
+        
+        Per virtual machine only the config .iso image is made,
+        taking well under a second rather than minutes.
+        
+        _kickstartFileContent
+            A DistroKickstartFileContent object.
+        
+        configIsoImagePath
+            if not given then in same directory as this .iso image with a timestamp in the filename.
+        
+        return
+            a list of three IsoImage, in the order to attach them,
+            e.g. VMwareMachine.create(ideDrives=[40000] + isoImages),
+            which makes the config .iso image the second CD-ROM drive sr1."""
+        bootOnlyIsoImage = self.bootOnlyIsoImage(configDevice="sr1")
+        configIsoImage = self.configIsoImageWithKickstart(_kickstartFileContent, configIsoImagePath=configIsoImagePath)
+        return [bootOnlyIsoImage, configIsoImage, self]
+
+    def isoImagesForKickstartFromServer(self, configServer, _kickstartFileContent, key=None):
+        """Alternative to method cloneWithAutoBootingKickstart without any .iso image per virtual machine.
+        
+        Puts the kickstart file into configServer, to be served by HTTP,
+        and returns a boot-only .iso image pointing at it, see method bootOnlyIsoImage,
+        the same for all virtual machines using the same configServer,
+        and this .iso image unmodified as the package source.
+        
+        The kickstart file can be changed without rebuilding any .iso image.
+        
+        configServer
+            an nrvr.util.configserver.ConfigServer, started, best with a fixed port,
+            to reuse the boot-only .iso image across runs.
+        
+        _kickstartFileContent
+            A DistroKickstartFileContent object.
+        
+        key
+            MAC address or IP address of the virtual machine,
+            if None then for any virtual machine without a kickstart file of its own.
+        
+        return
+            a list of two IsoImage, in the order to attach them,
+            e.g. VMwareMachine.create(ideDrives=[40000] + isoImages)."""
+        configServer.put(self.kickstartPathOnConfigIso, _kickstartFileContent, key=key)
+        bootOnlyIsoImage = self.bootOnlyIsoImage(kickstartUrl=configServer.url(self.kickstartPathOnConfigIso))
+        return [bootOnlyIsoImage, self]
+
     def cloneWithAutoBootingKickstart(self, _kickstartFileContent, modifications=[], cloneIsoImagePath=None,
-                                      ignoreJoliet=True):
+                                      ignoreJoliet=True, persistentExtraction=False, engine="genisoimage",
+                                      cloneCache=None):
         """Clone with kickstart file added and modified to automatically boot with it.
         
         For more on behavior see documentation of class IsoImage method cloneWithModifications.
@@ -92,14 +290,28 @@ class DistroIsoImage(nrvr.diskimage.isoimage.IsoImage):
         cloneIsoImagePath
             if not given then in same directory with a timestamp in the filename.
         
+        persistentExtraction
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        engine
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        cloneCache
+            see documentation of class IsoImage method cloneWithModifications.
+        
         return
             IsoImage(cloneIsoImagePath)."""
+        # fail early rather than after extracting
+        self.validateElToritoBoot()
         # modifications, could be quite different per distro specific subclass
         modifications.extend(self.modificationsIncludingKickstartFile(_kickstartFileContent))
         # clone with modifications
         clone = self.cloneWithModifications(modifications=modifications,
                                             cloneIsoImagePath=cloneIsoImagePath,
-                                            ignoreJoliet=ignoreJoliet)
+                                            ignoreJoliet=ignoreJoliet,
+                                            persistentExtraction=persistentExtraction,
+                                            engine=engine,
+                                            cloneCache=cloneCache)
         return clone
 
 
@@ -268,12 +480,13 @@ class DistroKickstartFileContent(object):
         """Encrypt in a format acceptable for kickstart."""
         # as implemented MD5 hash it, e.g. $1$sodiumch$UqZCYecJ/y5M5pp1x.7C4/
         # TODO explore allowing and defaulting to newer SHA-512 (aka sha512), starting with $6
-        cryptedPwd = CommandCapture(["openssl",
-                                     "passwd",
-                                     "-1", # use the MD5 based BSD pwd algorithm 1
-                                     "-salt", "sodiumchloride",
-                                     plainPwd],
-                                    copyToStdio=False).stdout
+        # with a fixed salt the same every time, hence memoized if CommandMemo is enabled
+        cryptedPwd = CommandMemo.capture(["openssl",
+                                          "passwd",
+                                          "-1", # use the MD5 based BSD pwd algorithm 1
+                                          "-salt", "sodiumchloride",
+                                          plainPwd],
+                                         copyToStdio=False).stdout
         # get rid of extraneous newline or any extraneous whitespace
         cryptedPwd = re.search(r"^\s*([^\s]+)", cryptedPwd).group(1)
         # here cryptedPwd should start with $
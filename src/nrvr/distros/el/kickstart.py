@@ -57,7 +57,30 @@ class ElIsoImage(nrvr.distros.common.kickstart.DistroIsoImage):
             # the kickstart file
             nrvr.diskimage.isoimage.IsoImageModificationFromString
             (kickstartCustomConfigurationPathOnIso,
-             _kickstartFileContent.string),
+             _kickstartFileContent.string)
+            ])
+        # documentation says "ks=cdrom:/directory/filename.cfg" with a single "/" slash, NOT double
+        modifications.extend(self.modificationsForAutoBooting("cdrom:/" + kickstartCustomConfigurationPathOnIso))
+        return modifications
+
+    def modificationsForAutoBooting(self, kickstartLocation):
+        """Construct and return a list of modifications which make the .iso image
+        automatically boot with a kickstart file at kickstartLocation.
+        
+        Called by method modificationsIncludingKickstartFile, and by method bootOnlyIsoImage.
+        
+        kickstartLocation
+            as would be given by ks= on the boot line, e.g. "cdrom:/isolinux/ks-custom.cfg",
+            or for a kickstart file on a config .iso image in the second CD-ROM drive "hd:sr1:/ks.cfg",
+            or "http://10.123.45.1:8019/ks.cfg".
+        
+        Return a list of modifications."""
+        if kickstartLocation.startswith("http:"):
+            # kssendmac for an nrvr.util.configserver.ConfigServer to tell virtual machines apart
+            kickstartLocation += " kssendmac"
+        # modifications
+        modifications = []
+        modifications.extend([
             # in isolinux/isolinux.cfg
             # delete any pre-existing "menu default"
             nrvr.diskimage.isoimage.IsoImageModificationByReplacement
@@ -66,7 +89,6 @@ class ElIsoImage(nrvr.distros.common.kickstart.DistroIsoImage):
              r"\3"),
             # in isolinux/isolinux.cfg
             # insert section with label "ks-custom", first, before "label linux",
-            # documentation says "ks=cdrom:/directory/filename.cfg" with a single "/" slash, NOT double,
             # e.g. see http://fedoraproject.org/wiki/Anaconda/Kickstart,
             # must set "ksdevice=eth0" or "ksdevice=link" or else asks which network interface to use,
             # e.g. see http://wiki.centos.org/TipsAndTricks/KickStart,
@@ -78,7 +100,7 @@ class ElIsoImage(nrvr.distros.common.kickstart.DistroIsoImage):
              r"  menu label Custom ^Kickstart\1"
              r"  menu default\1"
              r"  kernel vmlinuz\1"
-             r"  append initrd=initrd.img ks=cdrom:/" + kickstartCustomConfigurationPathOnIso + r" ksdevice=eth0 \1\2"),
+             r"  append initrd=initrd.img ks=" + kickstartLocation + r" ksdevice=eth0 \1\2"),
             # in isolinux/isolinux.cfg
             # change to "timeout 50" measured in 1/10th seconds
             nrvr.diskimage.isoimage.IsoImageModificationByReplacement
@@ -249,6 +271,37 @@ xconfig --startxonboot --defaultdesktop=GNOME
                                 + (" --iscrypted" if isCrypted else "") \
                                 + "\n"
 
+    def elSetProxy(self, proxyUrl):
+        """Set proxy for downloading packages, e.g. the url of a nrvr.util.packageproxy.PackageProxy.
+
+        Applies to any url and repo commands during installation,
+        and to yum on the installed system.
+        Installing from cdrom needs no proxy.
+
+        proxyUrl
+            e.g. "http://10.123.45.1:3142/".
+
+        return
+            self, for daisychaining."""
+        # see http://docs.redhat.com/docs/en-US/Red_Hat_Enterprise_Linux/6/html/Installation_Guide/s1-kickstart2-options.html
+        commandSection = self.sectionByName("command")
+        # remove any pre-existing --proxy option, then add
+        commandSection.string = re.sub(r"(?m)^(?:url|repo)[ \t]+.*$",
+                                       lambda match: re.sub(r"[ \t]+--proxy=\S*", "", match.group(0).rstrip())
+                                                     + " --proxy=" + proxyUrl,
+                                       commandSection.string)
+        postSection = self.sectionByName("%post")
+        settingProxy = "".join(
+            "\n#"
+            "\n# Set proxy for yum"
+            "\nsed -i -e '/^proxy=/d' /etc/yum.conf"
+            "\nsed -i -e '/^\\[main\\]/ a \\proxy=" + proxyUrl + "' /etc/yum.conf"
+            )
+        # simply append
+        # in case of multiple invocations last one would be effective
+        postSection.string = postSection.string + settingProxy + "\n"
+        return self
+
 if __name__ == "__main__":
     from nrvr.distros.el.kickstarttemplates import ElKickstartTemplates
     _kickstartFileContent = ElKickstartFileContent(ElKickstartTemplates.usableElKickstartTemplate001)
@@ -273,6 +326,7 @@ if __name__ == "__main__":
     _kickstartFileContent.elAddUser("jack", pwd="rainbow")
     _kickstartFileContent.elAddUser("jill", "sunshine")
     _kickstartFileContent.elAddUser("pat")
+    _kickstartFileContent.elSetProxy("http://10.123.45.1:3142/")
     _kickstartFileContent.sectionByName("%post").string = "\n#\n%post\n# replaced all of %post this time, just for testing\n"
     _kickstartFileContent.setSwappiness(30)
     print _kickstartFileContent.string
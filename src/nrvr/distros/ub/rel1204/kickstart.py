@@ -422,6 +422,20 @@ echo '<monitors version="1">
         # see https://help.ubuntu.com/12.04/installation-guide/example-preseed.txt
         return self.ubSetPreseedValue("d-i", "pkgsel/update-policy", "select", "unattended-upgrades")
 
+    def ubSetProxy(self, proxyUrl):
+        """Set proxy for downloading packages, e.g. the url of a nrvr.util.packageproxy.PackageProxy.
+
+        The installer writes it into the apt configuration of the installed system too.
+
+        proxyUrl
+            e.g. "http://10.123.45.1:3142/".
+
+        return
+            self, for daisychaining."""
+        # see https://help.ubuntu.com/12.04/installation-guide/example-preseed.txt
+        self.ubSetPreseedValue("d-i", "mirror/http/proxy", "string", proxyUrl)
+        return self
+
 if __name__ == "__main__":
     from nrvr.distros.ub.rel1204.kickstarttemplates import UbKickstartTemplates
     from nrvr.util.nameserver import Nameserver
@@ -444,6 +458,7 @@ if __name__ == "__main__":
                                                           nameservers=Nameserver.list)
     _kickstartFileContent.ubSetUpgradeNone()
     _kickstartFileContent.ubSetUpdatePolicyNone()
+    _kickstartFileContent.ubSetProxy("http://10.123.45.1:3142/")
     _kickstartFileContent.ubActivateGraphicalLogin()
     _kickstartFileContent.ubSetUser("jack", pwd="rainbow")
     _kickstartFileContent.ubSetUser("jill", pwd="sunshine")
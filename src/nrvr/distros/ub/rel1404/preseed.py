@@ -126,7 +126,9 @@ class Ub1404IsoImage(nrvr.diskimage.isoimage.IsoImage):
             ])
         return modifications
 
-    def cloneWithAutoBootingPreseed(self, _preseedFileContent, _firstTimeStartScript, modifications=[], cloneIsoImagePath=None):
+    def cloneWithAutoBootingPreseed(self, _preseedFileContent, _firstTimeStartScript, modifications=[], cloneIsoImagePath=None,
+                                    persistentExtraction=False, engine="genisoimage",
+                                    cloneCache=None):
         """Clone with preseed file added and modified to automatically boot with it.
         
         For more on behavior see documentation of class IsoImage method cloneWithModifications.
@@ -143,13 +145,25 @@ class Ub1404IsoImage(nrvr.diskimage.isoimage.IsoImage):
         cloneIsoImagePath
             if not given then in same directory with a timestamp in the filename.
         
+        persistentExtraction
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        engine
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        cloneCache
+            see documentation of class IsoImage method cloneWithModifications.
+        
         return
             IsoImage(cloneIsoImagePath)."""
         # modifications, could be quite different per release specific subclass
         modifications.extend(self.modificationsIncludingPreseedFile(_preseedFileContent, _firstTimeStartScript))
         # clone with modifications
         clone = self.cloneWithModifications(modifications=modifications,
-                                            cloneIsoImagePath=cloneIsoImagePath)
+                                            cloneIsoImagePath=cloneIsoImagePath,
+                                            persistentExtraction=persistentExtraction,
+                                            engine=engine,
+                                            cloneCache=cloneCache)
         return clone
 
 
@@ -455,6 +469,29 @@ class UbPreseedFileContent(object):
         self.setPreseedValue("d-i", "pkgsel/update-policy", "select", "unattended-upgrades")
         return self
 
+    def setProxy(self, proxyUrl):
+        """Set proxy for downloading packages, e.g. the url of a nrvr.util.packageproxy.PackageProxy.
+
+        Applies during installation, including to apt-get in ubiquity/success_command,
+        and to apt on the installed system.
+
+        proxyUrl
+            e.g. "http://10.123.45.1:3142/".
+
+        return
+            self, for daisychaining."""
+        # see https://help.ubuntu.com/14.04/installation-guide/example-preseed.txt
+        self.setPreseedValue("d-i", "mirror/http/proxy", "string", proxyUrl)
+        # must be first, before any in-target apt-get,
+        # replacing any pre-existing
+        settingProxyCommand = "echo 'Acquire::http::Proxy \"" + proxyUrl + "\";' > /target/etc/apt/apt.conf.d/01proxy"
+        successCommandRegex = r"(?m)^([ \t]*ubiquity[ \t]+ubiquity/success_command[ \t]+string[ \t]+(?:\\\n[ \t]*)?)" \
+                              r"(?:echo 'Acquire::http::Proxy .*? ; \\\n[ \t]*)?"
+        self._wholeContent = re.sub(successCommandRegex,
+                                    lambda match: match.group(1) + settingProxyCommand + " ; \\\n  ",
+                                    self._wholeContent)
+        return self
+
     def setSwappiness(self, swappiness):
         """Set swappiness.
         
@@ -496,6 +533,7 @@ if __name__ == "__main__":
                                                       gateway="10.123.45.2",
                                                       nameservers=Nameserver.list)
     _preseedFileContent.addPackage("default-jre")
+    _preseedFileContent.setProxy("http://10.123.45.1:3142/")
     _preseedFileContent.setUpgradeNone()
     _preseedFileContent.setUpdatePolicyNone()
     _preseedFileContent.setSwappiness(30)
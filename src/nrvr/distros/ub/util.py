@@ -11,8 +11,10 @@ Public repository - https://github.com/srguiwiz/nrvr-commander
 Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
+import os.path
 import re
 
+import nrvr.diskimage.isoimage
 import nrvr.distros.common.util
 
 class UbUtil(nrvr.distros.common.util.LinuxUtil):
@@ -20,7 +22,21 @@ class UbUtil(nrvr.distros.common.util.LinuxUtil):
 
     @classmethod
     def ubReleaseVersion(cls, isoImagePath):
-        """Return release version from isoImagePath."""
+        """Return release version from isoImagePath.
+        
+        If the .iso image exists then from file .disk/info in it,
+        else, or if not found in there, from the filename."""
+        if os.path.isfile(isoImagePath):
+            try:
+                with nrvr.diskimage.isoimage.IsoImage(isoImagePath).open(".disk/info") as diskInfoFile:
+                    diskInfo = diskInfoFile.read(1024)
+                # e.g. Ubuntu 14.04.1 LTS "Trusty Tahr" - Release amd64 (20140722.2)
+                match = re.search(r'^Ubuntu(?:-Server)?\s+([0-9]{2}\.[0-9]{2}(?:\.[0-9]+)?)\b', diskInfo)
+                if match:
+                    return match.group(1)
+            except Exception:
+                # e.g. not an .iso image, fall back to filename
+                pass
         return re.search(r'ubuntu-([0-9]{2}\.[0-9]{2}(?:\.[0-9]+)?)[^/]*\.iso', isoImagePath).group(1);
 
     @classmethod
@@ -0,0 +1,142 @@
+#!/usr/bin/python
+
+"""nrvr.process.chrometrace - Write a timeline of subprocesses as Chrome trace events
+
+Class provided by this module is ChromeTraceSink.
+
+Writes what CommandCaptureHooks report, i.e. every CommandCapture, SshCommand,
+ScpCommand and Download, into a file which can be opened as a timeline
+in Chrome at chrome://tracing or at https://ui.perfetto.dev/,
+e.g. to see which phases of a whole script run are serialized and where the minutes go.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import json
+import os
+import os.path
+import sys
+import threading
+
+from nrvr.process.commandcapture import CommandCaptureHooks
+
+class ChromeTraceSink(object):
+    """A hook for CommandCaptureHooks writing Chrome trace events into a file.
+
+    Each subprocess becomes an async slice, hence concurrent ones show side by side.
+
+    Writes and flushes each event right away, hence even if a script is stopped
+    the file can be opened, because the closing bracket of a JSON array is optional
+    in the trace event format."""
+
+    def __init__(self, path, jsonl=False):
+        """Create new ChromeTraceSink, writing into a new file.
+
+        Does not add itself to CommandCaptureHooks, call CommandCaptureHooks.add(sink),
+        or use in a with statement.
+
+        Example use::
+
+            with ChromeTraceSink("run-trace.json"):
+                CommandCapture(["hostname"])
+
+        path
+            of file to write.
+
+        jsonl
+            whether to write one JSON object per line,
+            else a JSON array as in the trace event format."""
+        self._path = path
+        self._jsonl = jsonl
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+        self._file = open(path, "w")
+        self._first = True
+        if not self._jsonl:
+            self._file.write("[\n")
+        self._write({"name": "process_name", "ph": "M", "pid": self._pid,
+                     "args": {"name": os.path.basename(sys.argv[0]) if sys.argv and sys.argv[0] else "python"}})
+
+    @property
+    def path(self):
+        """Path of file written."""
+        return self._path
+
+    def _write(self, traceEvent):
+        """Auxiliary method."""
+        with self._lock:
+            if not self._file:
+                return
+            if self._jsonl:
+                self._file.write(json.dumps(traceEvent) + "\n")
+            else:
+                if not self._first:
+                    self._file.write(",\n")
+                self._file.write(json.dumps(traceEvent))
+            self._first = False
+            self._file.flush()
+
+    @classmethod
+    def nameOf(cls, event):
+        """Return name to show for a CommandCaptureEvent, e.g. "vmrun" or "ssh shutdown"."""
+        command = os.path.basename(event.args[0]) if event.args else ""
+        if event.kind == "command":
+            return command
+        if command:
+            return event.kind + " " + command
+        return event.kind
+
+    def __call__(self, event):
+        """Write a CommandCaptureEvent, called by CommandCaptureHooks."""
+        traceEvent = {"name": ChromeTraceSink.nameOf(event),
+                      "cat": event.kind,
+                      "id": event.id,
+                      "ts": int(event.time * 1000000),
+                      "pid": self._pid,
+                      "tid": event.threadId}
+        if event.phase == "start":
+            traceEvent["ph"] = "b"
+            traceEvent["args"] = {"argv": event.args, "thread": event.threadName}
+            if event.ipaddress:
+                traceEvent["args"]["ipaddress"] = event.ipaddress
+        else:
+            traceEvent["ph"] = "e"
+            traceEvent["args"] = {"returncode": event.returncode, "duration": event.duration}
+        self._write(traceEvent)
+
+    def close(self):
+        """Finish writing the file.
+
+        Does not remove itself from CommandCaptureHooks, unless used in a with statement."""
+        with self._lock:
+            if not self._file:
+                return
+            if not self._jsonl:
+                self._file.write("\n]\n")
+            self._file.close()
+            self._file = None
+
+    def __enter__(self):
+        CommandCaptureHooks.add(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        CommandCaptureHooks.remove(self)
+        self.close()
+
+if __name__ == "__main__":
+    import tempfile
+    from nrvr.process.commandcapture import CommandCapture
+    _path = os.path.join(tempfile.gettempdir(), "chrometrace-example.json")
+    with ChromeTraceSink(_path):
+        _handles = [CommandCapture.start(["sleep", "0.3"]) for _ in range(3)]
+        CommandCapture(["hostname"])
+        for _handle in _handles:
+            _handle.wait()
+    with open(_path) as _traceFile:
+        _traceEvents = json.load(_traceFile)
+    print "wrote {0} trace events into {1}".format(len(_traceEvents), _path)
@@ -2,6 +2,20 @@
 
 """nrvr.process.commandcapture - Subprocesses wrapped for automation
 
+Classes provided by this module include
+* CommandCaptureException
+* CommandCaptureUsage
+* CommandCaptureUsageTotals
+* CommandCaptureStatistics
+* CommandCaptureEvent
+* CommandCaptureHooks
+* StreamCollector
+* MultiplexedStreamCollector
+* StreamMultiplexer
+* CommandCaptureHandle
+* CommandCapture
+* CommandCapturePipeline
+
 The main class provided by this module is CommandCapture.
 
 It should work in Linux and Windows.
@@ -16,14 +30,23 @@ Public repository - https://github.com/srguiwiz/nrvr-commander
 Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
+from collections import namedtuple
+from contextlib import contextmanager
 from io import BlockingIOError
+import errno
+import itertools
 import os
 import re
+import select
+import signal
 import subprocess
 import sys
 import threading
 import time
 
+from nrvr.process.outputbuffer import OutputBuffer
+from nrvr.process.spawn import SpawnedProcess
+
 _gotPty = False
 try:
     import pty
@@ -31,6 +54,21 @@ try:
 except ImportError:
     pass
 
+_gotFcntl = False
+try:
+    import fcntl
+    _gotFcntl = True
+except ImportError:
+    pass
+
+# os.wait4 reports resources used by a subprocess, not available in Windows
+_gotWait4 = hasattr(os, "wait4")
+
+def _setCloseOnExec(fd):
+    """Auxiliary function, so subprocesses started meanwhile by other threads don't inherit fd."""
+    if _gotFcntl:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
 class CommandCaptureException(Exception):
     def __init__(self, message):
         self._message = message
@@ -40,16 +78,214 @@ class CommandCaptureException(Exception):
     def message(self):
         return self._message
 
+class CommandCaptureUsage(namedtuple("CommandCaptureUsage",
+                                     ["command", "wallSeconds", "userSeconds", "systemSeconds",
+                                      "maxRssKilobytes", "stdoutBytes", "stderrBytes", "pty", "returncode"])):
+    """Resources used by one subprocess.
+    
+    command is the basename of argv[0], e.g. "vmrun".
+    
+    userSeconds, systemSeconds and maxRssKilobytes are None where os.wait4 is not available,
+    i.e. in Windows."""
+
+    __slots__ = ()
+
+    @classmethod
+    def fromRusage(cls, command, wallSeconds, rusage, stdoutBytes, stderrBytes, pty, returncode):
+        """Return a new CommandCaptureUsage, given rusage as returned by os.wait4, or None."""
+        if rusage is None:
+            return cls(command, wallSeconds, None, None, None, stdoutBytes, stderrBytes, pty, returncode)
+        maxRssKilobytes = rusage.ru_maxrss
+        if sys.platform == "darwin":
+            # in Mac OS X bytes rather than kilobytes
+            maxRssKilobytes //= 1024
+        return cls(command, wallSeconds, rusage.ru_utime, rusage.ru_stime, maxRssKilobytes,
+                   stdoutBytes, stderrBytes, pty, returncode)
+
+CommandCaptureUsageTotals = namedtuple("CommandCaptureUsageTotals",
+                                       ["count", "wallSeconds", "userSeconds", "systemSeconds",
+                                        "maxRssKilobytes", "stdoutBytes", "stderrBytes", "ptyCount"])
+
+class CommandCaptureStatistics(object):
+    """Process-wide totals of resources used by subprocesses, grouped by command,
+    e.g. to see how much time has gone into vmrun versus ssh.
+    
+    Every CommandCapture and CommandCaptureHandle records into it once done,
+    SshCommand and ScpCommand do too.
+    
+    maxRssKilobytes of totals is the largest of any single subprocess, not a sum."""
+
+    # whether to record
+    enabled = True
+
+    _lock = threading.Lock()
+    _totals = {}
+
+    @classmethod
+    def record(cls, usage):
+        """Add a CommandCaptureUsage to the totals of its command."""
+        if not CommandCaptureStatistics.enabled:
+            return
+        with CommandCaptureStatistics._lock:
+            totals = CommandCaptureStatistics._totals.get(usage.command)
+            if not totals:
+                totals = CommandCaptureUsageTotals(0, 0.0, 0.0, 0.0, 0, 0, 0, 0)
+            CommandCaptureStatistics._totals[usage.command] = CommandCaptureUsageTotals(
+                totals.count + 1,
+                totals.wallSeconds + usage.wallSeconds,
+                totals.userSeconds + (usage.userSeconds or 0.0),
+                totals.systemSeconds + (usage.systemSeconds or 0.0),
+                max(totals.maxRssKilobytes, usage.maxRssKilobytes or 0),
+                totals.stdoutBytes + usage.stdoutBytes,
+                totals.stderrBytes + usage.stderrBytes,
+                totals.ptyCount + (1 if usage.pty else 0))
+
+    @classmethod
+    def totals(cls):
+        """Return a dictionary of CommandCaptureUsageTotals by command."""
+        with CommandCaptureStatistics._lock:
+            return dict(CommandCaptureStatistics._totals)
+
+    @classmethod
+    def reset(cls):
+        """Forget all totals."""
+        with CommandCaptureStatistics._lock:
+            CommandCaptureStatistics._totals = {}
+
+    @classmethod
+    def report(cls):
+        """Return a table of totals as a string, one line per command, most wall time first.
+        
+        Example use::
+        
+            print CommandCaptureStatistics.report()"""
+        totals = CommandCaptureStatistics.totals()
+        lines = ["{0:<16} {1:>6} {2:>10} {3:>10} {4:>10} {5:>12} {6:>12} {7:>12} {8:>6}".format(
+            "command", "count", "wall s", "user s", "sys s", "max RSS KB", "stdout B", "stderr B", "pty")]
+        for command, commandTotals in sorted(totals.iteritems(), key=lambda item: -item[1].wallSeconds):
+            lines.append("{0:<16} {1:>6} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>12} {6:>12} {7:>12} {8:>6}".format(
+                command, *commandTotals))
+        return "\n".join(lines)
+
+CommandCaptureEvent = namedtuple("CommandCaptureEvent",
+                                 ["phase", "id", "kind", "args", "ipaddress", "time", "duration", "returncode",
+                                  "threadId", "threadName"])
+
+class CommandCaptureHooks(object):
+    """Process-wide registry of hooks called when subprocesses start and end,
+    e.g. to write a timeline of a whole script run, see ChromeTraceSink.
+    
+    Every CommandCapture and CommandCaptureHandle fires them, kind "command",
+    SshCommand fires them, kind "ssh", ScpCommand, kind "scp",
+    Download while downloading, kind "download".
+    
+    A hook is called with a CommandCaptureEvent, phase "start" or "end",
+    with the same id for both.
+    At "start" duration and returncode are None.
+    At "end" time is when ended, and duration is seconds since start.
+    threadId and threadName are of the thread that started it.
+    
+    Hooks may be called in any thread, e.g. for an end in the thread of the StreamMultiplexer,
+    hence should be quick and thread-safe.
+    Exceptions raised by hooks are ignored."""
+
+    _lock = threading.Lock()
+    _hooks = []
+    _ids = itertools.count(1)
+
+    @classmethod
+    def add(cls, hook):
+        """Add a hook, a function with one argument, a CommandCaptureEvent.
+        
+        return
+            hook, e.g. to remove it later."""
+        with CommandCaptureHooks._lock:
+            # replace rather than modify, so firing can iterate without holding the lock
+            CommandCaptureHooks._hooks = CommandCaptureHooks._hooks + [hook]
+        return hook
+
+    @classmethod
+    def remove(cls, hook):
+        """Remove a hook, if it has been added."""
+        with CommandCaptureHooks._lock:
+            CommandCaptureHooks._hooks = [existing for existing in CommandCaptureHooks._hooks
+                                          if existing is not hook]
+
+    @classmethod
+    def _fire(cls, event):
+        """Auxiliary method."""
+        for hook in CommandCaptureHooks._hooks:
+            try:
+                hook(event)
+            except Exception:
+                # tracing should not break what is being traced
+                pass
+
+    @classmethod
+    def started(cls, kind, args, ipaddress=None):
+        """Fire hooks for a start.
+        
+        return
+            the CommandCaptureEvent fired, to pass to ended(),
+            or None if no hooks."""
+        if not CommandCaptureHooks._hooks:
+            return None
+        currentThread = threading.current_thread()
+        event = CommandCaptureEvent("start", next(CommandCaptureHooks._ids), kind, list(args),
+                                    str(ipaddress) if ipaddress else None,
+                                    time.time(), None, None,
+                                    currentThread.ident, currentThread.name)
+        CommandCaptureHooks._fire(event)
+        return event
+
+    @classmethod
+    def ended(cls, startEvent, returncode, endTime=None):
+        """Fire hooks for an end.
+        
+        startEvent
+            as returned by started(), if None then does nothing.
+        
+        endTime
+            if None then now."""
+        if startEvent is None:
+            return
+        if endTime is None:
+            endTime = time.time()
+        CommandCaptureHooks._fire(startEvent._replace(phase="end", time=endTime,
+                                                      duration=endTime - startEvent.time,
+                                                      returncode=returncode))
+
+    @classmethod
+    @contextmanager
+    def traced(cls, kind, args, ipaddress=None):
+        """Fire hooks for a start, and for an end once the with statement has been left,
+        with returncode 0, or -1 if left by an exception.
+        
+        Example use::
+        
+            with CommandCaptureHooks.traced("download", [url]):
+                download(url)"""
+        startEvent = CommandCaptureHooks.started(kind, args, ipaddress)
+        try:
+            yield
+        except:
+            CommandCaptureHooks.ended(startEvent, -1)
+            raise
+        CommandCaptureHooks.ended(startEvent, 0)
+
 class StreamCollector(threading.Thread):
     """Collects from a stream into a string, and optionally also copies
     into another stream."""
-    def __init__(self, fromStream, toStream=None, flushToStream=False, slowDown=0.0):
+    def __init__(self, fromStream, toStream=None, flushToStream=False, slowDown=0.0, outputBuffer=None):
         """Create new StreamCollector thread.
         
-        Can be join()ed to wait until the thread terminates."""
+        Can be join()ed to wait until the thread terminates.
+        
+        outputBuffer
+            if given then an OutputBuffer to collect into, else a new OutputBuffer."""
         threading.Thread.__init__(self)
         self._fromStream = fromStream
-        self._collected = ""
+        self._collected = outputBuffer if outputBuffer is not None else OutputBuffer()
         self._toStream = toStream
         self._flushToStream = flushToStream
         self._slowDown = slowDown
@@ -61,7 +297,7 @@ class StreamCollector(threading.Thread):
             while True:
                 line = self._fromStream.readline()
                 if line != "":
-                    self._collected += line
+                    self._collected.append(line)
                     if self._slowDown > 0:
                         now = time.time()
                         stillToSleep = self._slowDown - (now - self._mostRecent)
@@ -83,6 +319,7 @@ class StreamCollector(threading.Thread):
             pass
         finally:
             self._done = True
+            self._collected.end()
             try:
                 # probably good to flush any remaining output
                 self._toStream.flush()
@@ -92,65 +329,330 @@ class StreamCollector(threading.Thread):
     @property
     def collected(self):
         """A string containing all text that has been written to the stream."""
+        return self._collected.getvalue()
+
+    @property
+    def outputBuffer(self):
+        """The OutputBuffer collected into."""
         return self._collected
 
-class CommandCapture(object):
-    """A subprocess wrapped for automation.
+class MultiplexedStreamCollector(object):
+    """Collects from a file descriptor into a string, and optionally also copies
+    into another stream, serviced by a StreamMultiplexer rather than by a thread of its own.
     
-    This class uses subprocess.Popen.
-    It further wraps for better use in automation.
+    Same behavior as StreamCollector, copying line by line."""
+    def __init__(self, fd, toStream=None, flushToStream=False, closeOnEnd=None, onEnd=None, outputBuffer=None):
+        """Create new MultiplexedStreamCollector.
+        
+        Register with StreamMultiplexer.shared().register() to start collecting.
+        
+        Can be join()ed to wait until the end of the stream.
+        
+        fd
+            file descriptor to read from.
+        
+        closeOnEnd
+            if given then an object with a close() method to call at the end of the stream,
+            else fd is closed.
+        
+        onEnd
+            if given then called without arguments at the end of the stream,
+            in the thread of the StreamMultiplexer.
+        
+        outputBuffer
+            if given then an OutputBuffer to collect into, else a new OutputBuffer."""
+        self._fd = fd
+        self._collected = outputBuffer if outputBuffer is not None else OutputBuffer()
+        self._partialLine = ""
+        self._toStream = toStream
+        self._flushToStream = flushToStream
+        self._closeOnEnd = closeOnEnd
+        self._onEnd = onEnd
+        self._endEvent = threading.Event()
+
+    @property
+    def fd(self):
+        return self._fd
+
+    def _copy(self, data):
+        """Auxiliary method, copy complete lines to toStream, keep any partial line for later."""
+        if not self._toStream:
+            return
+        lines = (self._partialLine + data).split("\n")
+        self._partialLine = lines.pop()
+        self._printLines(lines)
+
+    def _printLines(self, lines):
+        """Auxiliary method."""
+        for line in lines:
+            print >> self._toStream, line.rstrip()
+        if lines and self._flushToStream:
+            try:
+                self._toStream.flush()
+            except BlockingIOError:
+                pass # i.e. ignore for now
+
+    def _received(self, data):
+        """Auxiliary method, called by the StreamMultiplexer."""
+        self._collected.append(data)
+        self._copy(data)
+
+    def _ended(self):
+        """Auxiliary method, called by the StreamMultiplexer."""
+        try:
+            if self._toStream and self._partialLine:
+                # as readline() would have returned the last line without newline
+                self._printLines([self._partialLine])
+                self._partialLine = ""
+            try:
+                # probably good to flush any remaining output
+                self._toStream.flush()
+            except:
+                pass
+            try:
+                if self._closeOnEnd:
+                    self._closeOnEnd.close()
+                else:
+                    os.close(self._fd)
+            except:
+                pass
+        finally:
+            self._collected.end()
+            self._endEvent.set()
+            if self._onEnd:
+                self._onEnd()
+
+    def join(self, timeout=None):
+        """Wait until the end of the stream."""
+        self._endEvent.wait(timeout)
+
+    @property
+    def done(self):
+        """Whether the end of the stream has been reached."""
+        return self._endEvent.is_set()
+
+    @property
+    def collected(self):
+        """A string containing all text that has been written to the stream."""
+        return self._collected.getvalue()
+
+    @property
+    def outputBuffer(self):
+        """The OutputBuffer collected into."""
+        return self._collected
+
+class StreamMultiplexer(object):
+    """Services any number of MultiplexedStreamCollector in a single background thread,
+    and watches for subprocesses to exit.
     
-    This class captures returncode, stdout and stderr.
+    Uses epoll where available, i.e. in Linux, else poll.
     
-    This class copies to stdio, unless constructed with copyToStdio=False.
+    Works in Linux, not in Windows, where select cannot wait for pipes."""
+
+    # whether it can work here
+    supported = hasattr(select, "epoll") or hasattr(select, "poll")
+
+    # when watching for subprocesses to exit, how often to poll them,
+    # starting soon because usually the end of streams comes just before exiting,
+    # then less often
+    exitPollMinInterval = 0.001
+    exitPollMaxInterval = 0.05
+
+    _readSize = 65536
+
+    _shared = None
+    _sharedLock = threading.Lock()
+
+    @classmethod
+    def shared(cls):
+        """Return the StreamMultiplexer shared by all CommandCaptureHandle, starting it if necessary."""
+        with StreamMultiplexer._sharedLock:
+            if not StreamMultiplexer._shared:
+                StreamMultiplexer._shared = StreamMultiplexer()
+            return StreamMultiplexer._shared
+
+    def __init__(self):
+        """Create new StreamMultiplexer, with its background thread started."""
+        if hasattr(select, "epoll"):
+            self._poller = select.epoll()
+            self._pollerTimeoutFactor = 1.0
+            _setCloseOnExec(self._poller.fileno())
+        else:
+            self._poller = select.poll()
+            # poll takes milliseconds
+            self._pollerTimeoutFactor = 1000.0
+        self._readableMask = select.POLLIN | select.POLLPRI | select.POLLERR | select.POLLHUP
+        self._lock = threading.Lock()
+        self._collectors = {}
+        # list of [nextPoll, interval, exited, callback, failed]
+        self._exitWatches = []
+        # a pipe to wake up the background thread when registering
+        self._wakeRead, self._wakeWrite = os.pipe()
+        for fd in [self._wakeRead, self._wakeWrite]:
+            _setCloseOnExec(fd)
+        self._poller.register(self._wakeRead, self._readableMask)
+        self._thread = threading.Thread(target=self._run, name="StreamMultiplexer")
+        self._thread.daemon = True
+        self._thread.start()
+
+    def register(self, collector):
+        """Start servicing a MultiplexedStreamCollector."""
+        with self._lock:
+            self._collectors[collector.fd] = collector
+            self._poller.register(collector.fd, self._readableMask)
+        self._wake()
+
+    def watchExit(self, exited, callback, failed=None):
+        """Call callback without arguments once a subprocess has exited,
+        in the thread of this StreamMultiplexer.
+
+        exited
+            a function without arguments, returning whether the subprocess has exited,
+            e.g. reaping it, called in the thread of this StreamMultiplexer.
+
+        failed
+            if given then a function called with the exception instead of callback,
+            if exited raises an exception, after which watching ends."""
+        with self._lock:
+            self._exitWatches.append([time.time() + self.exitPollMinInterval, self.exitPollMinInterval,
+                                      exited, callback, failed])
+        self._wake()
+
+    @property
+    def collectorCount(self):
+        """Number of MultiplexedStreamCollector being serviced."""
+        return len(self._collectors)
+
+    def _wake(self):
+        """Auxiliary method."""
+        try:
+            os.write(self._wakeWrite, "x")
+        except OSError:
+            pass
+
+    def _run(self):
+        """Auxiliary method, run in the background thread."""
+        while True:
+            timeout = -1
+            if self._exitWatches:
+                timeout = max(min(exitWatch[0] for exitWatch in self._exitWatches) - time.time(), 0.0001)
+            try:
+                events = self._poller.poll(timeout * self._pollerTimeoutFactor if timeout > 0 else -1)
+            except (IOError, OSError, select.error) as ex:
+                if ex.args[0] == errno.EINTR:
+                    continue
+                raise
+            for fd, event in events:
+                if fd == self._wakeRead:
+                    os.read(self._wakeRead, StreamMultiplexer._readSize)
+                    continue
+                collector = self._collectors.get(fd)
+                if not collector:
+                    continue
+                try:
+                    data = os.read(fd, StreamMultiplexer._readSize)
+                except OSError as ex:
+                    if ex.errno in (errno.EINTR, errno.EAGAIN):
+                        continue
+                    # e.g. EIO seen reading from a pty master after all slaves have been closed
+                    data = ""
+                if data:
+                    try:
+                        collector._received(data)
+                    except Exception:
+                        # e.g. a broken toStream should not stop servicing other streams
+                        pass
+                else:
+                    with self._lock:
+                        self._poller.unregister(fd)
+                        del self._collectors[fd]
+                    try:
+                        collector._ended()
+                    except Exception:
+                        pass
+            if self._exitWatches:
+                with self._lock:
+                    exitWatches = self._exitWatches
+                    self._exitWatches = []
+                stillWatching = []
+                now = time.time()
+                for exitWatch in exitWatches:
+                    nextPoll, interval, exited, callback, failed = exitWatch
+                    if nextPoll > now:
+                        stillWatching.append(exitWatch)
+                        continue
+                    try:
+                        hasExited = exited()
+                    except Exception as ex:
+                        # e.g. an unexpected OSError from os.wait4 should not stop servicing others
+                        if failed:
+                            try:
+                                failed(ex)
+                            except Exception:
+                                pass
+                        continue
+                    if not hasExited:
+                        exitWatch[1] = min(interval * 2, self.exitPollMaxInterval)
+                        exitWatch[0] = now + exitWatch[1]
+                        stillWatching.append(exitWatch)
+                        continue
+                    try:
+                        callback()
+                    except Exception:
+                        pass
+                if stillWatching:
+                    with self._lock:
+                        self._exitWatches.extend(stillWatching)
+
+class CommandCaptureHandle(object):
+    """A subprocess started for automation, not waited for yet.
     
-    If module pty is available (e.g. in Python 2.6 on Linux, but not on Windows)
-    and output is copied to stdio, and unless constructed with forgoPty=True,
-    then uses pty.openpty() in order to see output right away.  Else uses pipes.
-    Reason has been, more commands are flushing their stdout more often when
-    they are thinking they are talking to a terminal, e.g. a pseudo-terminal,
-    rather than buffering their output when they are thinking they are talking
-    to a pipe.
+    Returned by CommandCapture.start.
     
-    What is nice about this class, it keeps separate stdout and stderr while
-    providing streaming output of both.
-    Having separate stderr does make a difference not only for easily separately
-    processing what the subprocess is writing to stderr, but also by maintaining
-    the ability to show stderr in a different color, e.g. in red if using
-    http://sourceforge.net/projects/hilite/.
+    Can be poll()ed, wait()ed for with an optional timeout,
+    terminate()d or kill()ed.
     
-    True defaults exceptionIfNotZero=True and exceptionIfAnyStderr=True should
-    make for less hidden surprises when a subprocess encounters a problem,
-    because exceptions by default would propagate up in a system of scripts,
-    rather than being absorbed silently.
-    Obviously, these parameters can be set False if needed.
+    Provides the same returncode, stdout, stderr and raiseExceptionIfThereIsAReason
+    as CommandCapture, available once done.
     
-    It should work in Linux and Windows.
+    Once done also provides usage, resources used by the subprocess,
+    which also are recorded into CommandCaptureStatistics.
     
-    On the downside, nothing has been coded in this class to allow input
-    into a running subprocess."""
+    If started with processGroup=True, where supported, i.e. in Linux,
+    the subprocess is started in a process group of its own,
+    so terminate() and kill() reach any further subprocesses it has started too.
+    Hence a KeyboardInterrupt while in wait() kills the subprocess, as if it
+    had been in the foreground process group of the terminal."""
+
+    # whether to use the StreamMultiplexer where supported,
+    # else two StreamCollector threads and a waiter thread per subprocess
+    useMultiplexer = True
 
     def __init__(self, args, copyToStdio=True, forgoPty=False,
-                 exceptionIfNotZero=True, exceptionIfAnyStderr=True):
-        """Create new CommandCapture instance.
+                 exceptionIfNotZero=True, exceptionIfAnyStderr=True,
+                 processGroup=True,
+                 outputSpillThreshold=None, outputMaxRetained=None,
+                 stdin=None, stdout=None):
+        """Create new CommandCaptureHandle instance.
         
-        Will wait until completed.
+        Starts the subprocess and returns right away.
         
-        Example use::
+        processGroup
+            whether to start the subprocess in a process group of its own.
+            Not for commands that read from the terminal, e.g. asking for a password,
+            because in a background process group they would be stopped.
         
-            example = CommandCapture(["hostname"])
-            print "returncode=" + str(example.returncode)
-            print "stdout=" + example.stdout
-            print >> sys.stderr, "stderr=" + example.stderr
+        stdin
+            if given then passed on to subprocess.Popen(),
+            e.g. a file, or property stdoutPipe of another CommandCaptureHandle.
         
-        args
-            are passed on to subprocess.Popen().
-            
-            If given a string instead of a list then fixed by args=args.split() making a list.
-            That may only work as expected for some commands on some platforms.
-            It should work for a command without arguments.
-            
-            Hence if you don't want a string split, pass it in wrapped as sole item of a list."""
+        stdout
+            if given then passed on to subprocess.Popen() and stdout is not collected,
+            e.g. a file, or subprocess.PIPE to be read from property stdoutPipe,
+            see class CommandCapturePipeline.
+            Then uses pipes rather than a pty.
+        
+        For other parameters see documentation of class CommandCapture."""
         if isinstance(args, basestring):
             args = args.split()
         self._args = args
@@ -163,106 +665,414 @@ class CommandCapture(object):
             # if not watching output then no point in extra effort of using pty,
             # hence, for now
             self._forgoPty = True
+        if stdin is not None or stdout is not None:
+            # as in a pipeline in a shell
+            self._forgoPty = True
+        # whether to collect stdout
+        self._collectStdout = stdout is None
         self._exceptionIfNotZero = exceptionIfNotZero
         self._exceptionIfAnyStderr = exceptionIfAnyStderr
         self._commandProcess = None
         self._returncode = None
+        self._stdoutBuffer = OutputBuffer(spillThreshold=outputSpillThreshold, maxRetained=outputMaxRetained)
+        self._stderrBuffer = OutputBuffer(spillThreshold=outputSpillThreshold, maxRetained=outputMaxRetained)
         self._stdoutCollector = None
         self._stderrCollector = None
         self._stdoutSlave = None
         self._stderrSlave = None
-        self._done = False
+        self._doneEvent = threading.Event()
+        self._waiter = None
+        self._rusage = None
+        self._exitTime = None
+        self._usage = None
+        # if waiting for the subprocess has failed
+        self._exception = None
+        # whether in a process group of its own, hence killpg can be used
+        self._processGroup = processGroup and os.name == "posix"
+        # as in a shell, so a stage quietly exits once a later stage has exited,
+        # because Python ignores SIGPIPE, and subprocesses would inherit that
+        defaultSigpipe = (stdin is not None or stdout is not None) and hasattr(signal, "SIGPIPE")
+        self._multiplexed = CommandCaptureHandle.useMultiplexer and StreamMultiplexer.supported
+        stdoutCollectorOptions = {"outputBuffer": self._stdoutBuffer}
+        stderrCollectorOptions = {"outputBuffer": self._stderrBuffer}
+        if self._copyToStdio:
+            stdoutCollectorOptions.update({"toStream": sys.stdout, "flushToStream": True})
+            stderrCollectorOptions.update({"toStream": sys.stderr, "flushToStream": True})
+        self._startTime = time.time()
+        self._startEvent = CommandCaptureHooks.started("command", self._args)
         try:
             if self._forgoPty:
-                self._commandProcess = subprocess.Popen(self._args,
-                                                        stdout=subprocess.PIPE,
-                                                        stderr=subprocess.PIPE)
-                if self._copyToStdio:
-                    self._stdoutCollector = StreamCollector(self._commandProcess.stdout,
-                                                            toStream=sys.stdout, flushToStream=True)
-                    self._stderrCollector = StreamCollector(self._commandProcess.stderr,
-                                                            toStream=sys.stderr, flushToStream=True)
+                self._commandProcess = SpawnedProcess.popen(self._args,
+                                                            stdin=stdin,
+                                                            stdout=subprocess.PIPE if self._collectStdout else stdout,
+                                                            stderr=subprocess.PIPE,
+                                                            processGroup=processGroup,
+                                                            defaultSigpipe=defaultSigpipe)
+                if self._commandProcess.stdout:
+                    # whether collected here or passed on to another subprocess,
+                    # yet other subprocesses should not inherit it
+                    _setCloseOnExec(self._commandProcess.stdout.fileno())
+                if not self._collectStdout:
+                    self._stdoutBuffer.end()
+                if self._multiplexed:
+                    stderrFd = self._commandProcess.stderr.fileno()
+                    _setCloseOnExec(stderrFd)
+                    if self._collectStdout:
+                        self._stdoutCollector = MultiplexedStreamCollector(self._commandProcess.stdout.fileno(),
+                                                                           closeOnEnd=self._commandProcess.stdout,
+                                                                           onEnd=self._collectorEnded,
+                                                                           **stdoutCollectorOptions)
+                    self._stderrCollector = MultiplexedStreamCollector(stderrFd,
+                                                                       closeOnEnd=self._commandProcess.stderr,
+                                                                       onEnd=self._collectorEnded,
+                                                                       **stderrCollectorOptions)
                 else:
-                    self._stdoutCollector = StreamCollector(self._commandProcess.stdout)
-                    self._stderrCollector = StreamCollector(self._commandProcess.stderr)
-                # note: could return from constructor here
-                # and then have a wait() as a separate method,
-                # but probably safer to keep here as is because of
-                # potential issues around closing
-                self._returncode = self._commandProcess.wait()
-                self._stdoutCollector.join()
-                self._stderrCollector.join()
+                    if self._collectStdout:
+                        self._stdoutCollector = StreamCollector(self._commandProcess.stdout, **stdoutCollectorOptions)
+                    self._stderrCollector = StreamCollector(self._commandProcess.stderr, **stderrCollectorOptions)
             else:
                 # use a pseudo-terminal (pty) so more commands flush their _stdout more often,
                 # to see output right away
                 stdoutMaster, self._stdoutSlave = pty.openpty()
                 stderrMaster, self._stderrSlave = pty.openpty()
-                stdoutMasterStream = os.fdopen(stdoutMaster, "r", 1)
-                stderrMasterStream = os.fdopen(stderrMaster, "r", 1)
-                self._commandProcess = subprocess.Popen(self._args,
-                                                        stdout=self._stdoutSlave,
-                                                        stderr=self._stderrSlave)
-                if self._copyToStdio:
-                    self._stdoutCollector = StreamCollector(stdoutMasterStream,
-                                                            toStream=sys.stdout, flushToStream=True)
-                    self._stderrCollector = StreamCollector(stderrMasterStream,
-                                                            toStream=sys.stderr, flushToStream=True)
-                else:
-                    self._stdoutCollector = StreamCollector(stdoutMasterStream)
-                    self._stderrCollector = StreamCollector(stderrMasterStream)
-                # note: could return from constructor here
-                # and then have a wait() as a separate method,
-                # but probably safer to keep here as is because of
-                # potential issues around closing
-                self._returncode = self._commandProcess.wait()
+                for fd in [stdoutMaster, stderrMaster, self._stdoutSlave, self._stderrSlave]:
+                    # slaves become stdout and stderr of the subprocess nonetheless, because dup2 clears it
+                    _setCloseOnExec(fd)
                 try:
-                    os.close(self._stdoutSlave)
+                    self._commandProcess = SpawnedProcess.popen(self._args,
+                                                                stdout=self._stdoutSlave,
+                                                                stderr=self._stderrSlave,
+                                                                processGroup=processGroup)
                 except:
-                    pass
-                finally:
-                    self._stdoutSlave = None
+                    os.close(stdoutMaster)
+                    os.close(stderrMaster)
+                    raise
+                if self._multiplexed:
+                    self._stdoutCollector = MultiplexedStreamCollector(stdoutMaster,
+                                                                       onEnd=self._collectorEnded,
+                                                                       **stdoutCollectorOptions)
+                    self._stderrCollector = MultiplexedStreamCollector(stderrMaster,
+                                                                       onEnd=self._collectorEnded,
+                                                                       **stderrCollectorOptions)
+                    # the end of the streams is seen once the subprocess and any of its subprocesses
+                    # have closed them, hence no need to keep slaves open here
+                    self._closeSlaves()
+                else:
+                    self._stdoutCollector = StreamCollector(os.fdopen(stdoutMaster, "r", 1), **stdoutCollectorOptions)
+                    self._stderrCollector = StreamCollector(os.fdopen(stderrMaster, "r", 1), **stderrCollectorOptions)
+        except:
+            self._closeSlaves()
+            self._doneEvent.set()
+            CommandCaptureHooks.ended(self._startEvent, None)
+            raise
+        if self._multiplexed:
+            # collected by the single thread of the StreamMultiplexer, no threads of its own
+            self._endedCollectors = 0
+            multiplexer = StreamMultiplexer.shared()
+            if self._stdoutCollector:
+                multiplexer.register(self._stdoutCollector)
+            multiplexer.register(self._stderrCollector)
+        else:
+            # the waiter thread waits for the subprocess and then cleans up,
+            # keeping cleanup in one place as it has been when waiting in the constructor
+            self._waiter = threading.Thread(target=self._waitAndCleanUp)
+            self._waiter.daemon = True
+            self._waiter.start()
+
+    def _collectorEnded(self):
+        """Auxiliary method, called by the StreamMultiplexer at the end of each stream."""
+        self._endedCollectors += 1
+        if self._endedCollectors < (2 if self._stdoutCollector else 1):
+            return
+        try:
+            exited = self._reap()
+        except Exception as ex:
+            self._failed(ex)
+            return
+        if exited:
+            self._finish()
+        else:
+            # rarely, the subprocess closes its output before exiting
+            StreamMultiplexer.shared().watchExit(self._reap, self._finish, self._failed)
+
+    def _reap(self, block=False):
+        """Auxiliary method, return whether the subprocess has exited.
+        
+        Where available uses os.wait4 rather than subprocess.Popen.poll or wait,
+        to get resources used by the subprocess."""
+        if self._commandProcess.returncode is not None:
+            return True
+        if not _gotWait4:
+            if block:
+                self._commandProcess.wait()
+            else:
+                self._commandProcess.poll()
+        else:
+            while True:
                 try:
-                    os.close(self._stderrSlave)
-                except:
-                    pass
-                finally:
-                    self._stderrSlave = None
+                    pid, status, rusage = os.wait4(self._commandProcess.pid, 0 if block else os.WNOHANG)
+                    break
+                except OSError as ex:
+                    if ex.errno == errno.EINTR:
+                        continue
+                    if ex.errno != errno.ECHILD:
+                        raise
+                    # already reaped elsewhere, let subprocess.Popen deal with it as it would
+                    self._commandProcess.poll()
+                    pid = 0
+                    break
+            if pid:
+                self._rusage = rusage
+                # set returncode the same way subprocess.Popen would,
+                # decoding here rather than relying on its internals
+                if os.WIFSIGNALED(status):
+                    self._commandProcess.returncode = -os.WTERMSIG(status)
+                elif os.WIFEXITED(status):
+                    self._commandProcess.returncode = os.WEXITSTATUS(status)
+                else:
+                    raise RuntimeError("unknown child exit status")
+        if self._commandProcess.returncode is None:
+            return False
+        self._exitTime = time.time()
+        return True
+
+    def _finish(self):
+        """Auxiliary method, once the subprocess has exited and all its output has been collected."""
+        self._returncode = self._commandProcess.returncode
+        self._recordUsage()
+        self._doneEvent.set()
+
+    def _failed(self, exception):
+        """Auxiliary method, if waiting for the subprocess has failed, so waiters are released,
+        and wait() raises a CommandCaptureException."""
+        self._exception = exception
+        self._returncode = self._commandProcess.returncode
+        CommandCaptureHooks.ended(self._startEvent, self._returncode)
+        self._doneEvent.set()
+
+    def _recordUsage(self):
+        """Auxiliary method, once the subprocess has exited and all its output has been collected."""
+        if self._returncode is None:
+            return
+        self._usage = CommandCaptureUsage.fromRusage(os.path.basename(self._args[0]),
+                                                     (self._exitTime or time.time()) - self._startTime,
+                                                     self._rusage,
+                                                     len(self._stdoutBuffer), len(self._stderrBuffer),
+                                                     not self._forgoPty,
+                                                     self._returncode)
+        CommandCaptureStatistics.record(self._usage)
+        CommandCaptureHooks.ended(self._startEvent, self._returncode, self._exitTime)
+
+    def _closeSlaves(self):
+        """Auxiliary method."""
+        if self._stdoutSlave != None:
+            try:
+                os.close(self._stdoutSlave)
+            except:
+                pass
+            finally:
+                self._stdoutSlave = None
+        if self._stderrSlave != None:
+            try:
+                os.close(self._stderrSlave)
+            except:
+                pass
+            finally:
+                self._stderrSlave = None
+
+    def _waitAndCleanUp(self):
+        """Auxiliary method, run in the waiter thread."""
+        try:
+            self._reap(block=True)
+            # for the pty case, closing the slaves makes the collectors see the end
+            self._closeSlaves()
+            if self._stdoutCollector:
                 self._stdoutCollector.join()
-                self._stderrCollector.join()
+            self._stderrCollector.join()
+        except Exception as ex:
+            # reported by wait()
+            self._exception = ex
         finally:
             # note: could also have some of this cleanup in a __del__,
             # but be aware not all modules might be available
             # at the time Python itself is shutting down,
             # see pexpect spawn __del__,
             # overall probably safer to keep here as is
-            if self._stdoutSlave != None:
-                try:
-                    os.close(self._stdoutSlave)
-                except:
-                    pass
-                finally:
-                    self._stdoutSlave = None
-            if self._stderrSlave != None:
-                try:
-                    os.close(self._stderrSlave)
-                except:
-                    pass
-                finally:
-                    self._stderrSlave = None
-            self._commandProcess = None
-            if self._stdoutCollector:
-                self._stdout = self._stdoutCollector.collected
-                self._stdoutCollector = None
-            else:
-                self._stdout = None
-            if self._stderrCollector:
-                self._stderr = self._stderrCollector.collected
-                self._stderrCollector = None
-            else:
-                self._stderr = None
-            self._done = True
-        # raise an exception if asked to and there is a reason
+            self._closeSlaves()
+            self._returncode = self._commandProcess.returncode
+            self._recordUsage()
+            self._doneEvent.set()
+
+    @property
+    def done(self):
+        """Whether the subprocess has exited and all its output has been collected."""
+        return self._doneEvent.is_set()
+
+    @property
+    def pid(self):
+        """Process id of the subprocess, if in a process group of its own also its process group id."""
+        return self._commandProcess.pid if self._commandProcess else None
+
+    def poll(self):
+        """Return returncode if done, else None, without waiting."""
+        if self._doneEvent.is_set():
+            return self._returncode
+        return None
+
+    def wait(self, timeout=None):
+        """Wait until done, or until timeout.
+        
+        If done raise a CommandCaptureException if there is a reason,
+        as CommandCapture would.
+        
+        If interrupted by a KeyboardInterrupt kill the subprocess and re-raise.
+        
+        timeout
+            seconds, if None then no limit.
+        
+        return
+            returncode if done, None if timed out."""
+        if not self._waitUntilDone(timeout):
+            return None
         self.raiseExceptionIfThereIsAReason()
+        return self._returncode
+
+    def _waitUntilDone(self, timeout=None):
+        """Auxiliary method, return whether done."""
+        deadline = time.time() + timeout if timeout is not None else None
+        try:
+            while not self._doneEvent.is_set():
+                # waiting in slices rather than without timeout,
+                # because in Python 2 an Event.wait() without timeout cannot be interrupted
+                slice = 1.0
+                if deadline is not None:
+                    slice = min(slice, deadline - time.time())
+                    if slice <= 0:
+                        return False
+                self._doneEvent.wait(slice)
+        except KeyboardInterrupt:
+            self.kill()
+            raise
+        return True
+
+    def lines(self, fromStderr=False, timeout=None, encoding="utf-8"):
+        """Yield lines of output as they arrive, without line endings.
+        
+        Starts from the first line, even if it has arrived before calling.
+        Ends at the end of output, or at timeout.
+        
+        Can be used while output also is being copied to stdio and collected.
+        
+        If started with outputMaxRetained then lines not retained anymore by the time
+        they would be read are skipped.
+        
+        fromStderr
+            whether lines of stderr rather than of stdout.
+        
+        timeout
+            seconds from calling, if None then no limit.
+        
+        encoding
+            to decode lines with, replacing what cannot be decoded,
+            if None then lines are not decoded."""
+        outputBuffer = self._stderrBuffer if fromStderr else self._stdoutBuffer
+        deadline = time.time() + timeout if timeout is not None else None
+        offset = 0
+        partialLine = ""
+        while True:
+            data, offset = outputBuffer.readFrom(offset)
+            if data:
+                lines = (partialLine + data).split("\n")
+                partialLine = lines.pop()
+                for line in lines:
+                    line = line.rstrip("\r")
+                    yield line.decode(encoding, "replace") if encoding else line
+                continue
+            if outputBuffer.ended:
+                if partialLine:
+                    line = partialLine.rstrip("\r")
+                    yield line.decode(encoding, "replace") if encoding else line
+                return
+            # waiting in slices, see method wait
+            slice = 1.0
+            if deadline is not None:
+                slice = min(slice, deadline - time.time())
+                if slice <= 0:
+                    return
+            outputBuffer.waitForMore(offset, slice)
+
+    def waitUntil(self, until, timeout=None, kill=False, fromStderr=False):
+        """Wait until a line of output matches, or until the end of output, or until timeout.
+        
+        Reacts as soon as the line arrives, rather than once the subprocess has exited.
+        
+        Does not raise a CommandCaptureException.
+        
+        until
+            a regular expression, searched for in each line,
+            if a unicode pattern then in lines decoded from UTF-8.
+        
+        timeout
+            seconds, if None then no limit.
+        
+        kill
+            whether, if matched, to kill the subprocess, and wait for it to be done,
+            else leave it running.
+        
+        fromStderr
+            whether to look at lines of stderr rather than of stdout.
+        
+        return
+            the match object if matched, else None."""
+        if isinstance(until, basestring):
+            until = re.compile(until)
+        # a str pattern searched for in undecoded lines, a unicode pattern in decoded lines
+        encoding = None if isinstance(until.pattern, str) else "utf-8"
+        for line in self.lines(fromStderr=fromStderr, timeout=timeout, encoding=encoding):
+            match = until.search(line)
+            if match:
+                if kill:
+                    self.kill()
+                    self._waitUntilDone()
+                return match
+        return None
+
+    def _signal(self, posixSignal):
+        """Auxiliary method, send a signal to the process group."""
+        if self._doneEvent.is_set() or not self._commandProcess:
+            return
+        try:
+            if self._processGroup:
+                os.killpg(self._commandProcess.pid, posixSignal)
+            elif os.name == "posix":
+                os.kill(self._commandProcess.pid, posixSignal)
+            elif posixSignal == signal.SIGTERM:
+                self._commandProcess.terminate()
+            else:
+                self._commandProcess.kill()
+        except OSError as ex:
+            if ex.errno != errno.ESRCH:
+                raise
+
+    def terminate(self):
+        """Terminate the subprocess, and its process group if it has one of its own.
+        
+        Does not wait, call wait() to wait.
+        
+        return
+            self, for daisychaining."""
+        self._signal(signal.SIGTERM)
+        return self
+
+    def kill(self):
+        """Kill the subprocess, and its process group if it has one of its own.
+        
+        Does not wait, call wait() to wait.
+        
+        return
+            self, for daisychaining."""
+        self._signal(getattr(signal, "SIGKILL", signal.SIGTERM))
+        return self
 
     def raiseExceptionIfThereIsAReason(self):
         """Raise a CommandCaptureException if there is a reason.
@@ -271,8 +1081,12 @@ class CommandCapture(object):
         with exceptionIfAnyStderr=False after looking at .stderr decides
         in some circumstances only to raise an exception."""
         exceptionMessage = ""
-        if self._exceptionIfAnyStderr and self._stderr:
-            exceptionMessage += "stderr:\n" + self._stderr
+        if self._exception:
+            exceptionMessage += "failed waiting for subprocess: " + str(self._exception)
+        if self._exceptionIfAnyStderr and self.stderr:
+            if exceptionMessage:
+                exceptionMessage += "\n"
+            exceptionMessage += "stderr:\n" + self.stderr
         if self._exceptionIfNotZero and self._returncode:
             if exceptionMessage:
                 exceptionMessage += "\n"
@@ -286,20 +1100,444 @@ class CommandCapture(object):
             exceptionMessage = commandDescription + "\n" + exceptionMessage
             raise CommandCaptureException(exceptionMessage)
 
+    @property
+    def args(self):
+        """List of args of subprocess."""
+        return self._args
+
     @property
     def returncode(self):
-        """Int returncode of subprocess."""
+        """Int returncode of subprocess, None if not done yet."""
         return self._returncode
 
+    @property
+    def stdout(self):
+        """Collected stdout string of subprocess, None if not done yet.
+        
+        Empty if constructed with stdout, because then not collected."""
+        if not self._doneEvent.is_set():
+            return None
+        return self._stdoutBuffer.getvalue()
+
+    @property
+    def stdoutPipe(self):
+        """File to read stdout of subprocess from if constructed with stdout=subprocess.PIPE, else None.
+        
+        E.g. to pass on as stdin of another CommandCaptureHandle,
+        and then to close here."""
+        return self._commandProcess.stdout if not self._collectStdout else None
+
+    @property
+    def stderr(self):
+        """Collected stderr string of subprocess, None if not done yet."""
+        if not self._doneEvent.is_set():
+            return None
+        return self._stderrBuffer.getvalue()
+
+    @property
+    def usage(self):
+        """CommandCaptureUsage of subprocess, None if not done yet."""
+        return self._usage
+
+    @property
+    def wallSeconds(self):
+        """Seconds from starting until the subprocess has exited, None if not done yet."""
+        return self._usage.wallSeconds if self._usage else None
+
+    @property
+    def userSeconds(self):
+        """Seconds of user CPU time of subprocess, None if not done yet or not available."""
+        return self._usage.userSeconds if self._usage else None
+
+    @property
+    def systemSeconds(self):
+        """Seconds of system CPU time of subprocess, None if not done yet or not available."""
+        return self._usage.systemSeconds if self._usage else None
+
+    @property
+    def maxRssKilobytes(self):
+        """Maximum resident set size of subprocess, None if not done yet or not available."""
+        return self._usage.maxRssKilobytes if self._usage else None
+
+    @property
+    def stdoutBytes(self):
+        """Number of bytes of stdout of subprocess so far, including any not retained."""
+        return len(self._stdoutBuffer)
+
+    @property
+    def stderrBytes(self):
+        """Number of bytes of stderr of subprocess so far, including any not retained."""
+        return len(self._stderrBuffer)
+
+    @property
+    def usedPty(self):
+        """Whether a pseudo-terminal (pty) has been used rather than pipes."""
+        return not self._forgoPty
+
+    @property
+    def stdoutBuffer(self):
+        """OutputBuffer collecting stdout of subprocess, e.g. to look at its tail while running,
+        or to avoid making one large string."""
+        return self._stdoutBuffer
+
+    @property
+    def stderrBuffer(self):
+        """OutputBuffer collecting stderr of subprocess."""
+        return self._stderrBuffer
+
+class CommandCapture(object):
+    """A subprocess wrapped for automation.
+    
+    This class uses subprocess.Popen, or where available posix_spawnp,
+    which is faster when this process is large, see SpawnedProcess.
+    It further wraps for better use in automation.
+    
+    This class captures returncode, stdout and stderr.
+    
+    This class copies to stdio, unless constructed with copyToStdio=False.
+    
+    If module pty is available (e.g. in Python 2.6 on Linux, but not on Windows)
+    and output is copied to stdio, and unless constructed with forgoPty=True,
+    then uses pty.openpty() in order to see output right away.  Else uses pipes.
+    Reason has been, more commands are flushing their stdout more often when
+    they are thinking they are talking to a terminal, e.g. a pseudo-terminal,
+    rather than buffering their output when they are thinking they are talking
+    to a pipe.
+    
+    What is nice about this class, it keeps separate stdout and stderr while
+    providing streaming output of both.
+    Having separate stderr does make a difference not only for easily separately
+    processing what the subprocess is writing to stderr, but also by maintaining
+    the ability to show stderr in a different color, e.g. in red if using
+    http://sourceforge.net/projects/hilite/.
+    
+    True defaults exceptionIfNotZero=True and exceptionIfAnyStderr=True should
+    make for less hidden surprises when a subprocess encounters a problem,
+    because exceptions by default would propagate up in a system of scripts,
+    rather than being absorbed silently.
+    Obviously, these parameters can be set False if needed.
+    
+    The constructor waits until the subprocess has exited.
+    To start several subprocesses and wait for them later, use method start,
+    which returns a CommandCaptureHandle.
+    
+    It should work in Linux and Windows.
+    
+    On the downside, nothing has been coded in this class to allow input
+    into a running subprocess."""
+
+    def __init__(self, args, copyToStdio=True, forgoPty=False,
+                 exceptionIfNotZero=True, exceptionIfAnyStderr=True,
+                 outputSpillThreshold=None, outputMaxRetained=None,
+                 until=None, killWhenMatched=False):
+        """Create new CommandCapture instance.
+        
+        Will wait until completed, or if given until then until a line of stdout matches.
+        
+        Example use::
+        
+            example = CommandCapture(["hostname"])
+            print "returncode=" + str(example.returncode)
+            print "stdout=" + example.stdout
+            print >> sys.stderr, "stderr=" + example.stderr
+        
+        args
+            are passed on to subprocess.Popen().
+            
+            If given a string instead of a list then fixed by args=args.split() making a list.
+            That may only work as expected for some commands on some platforms.
+            It should work for a command without arguments.
+            
+            Hence if you don't want a string split, pass it in wrapped as sole item of a list.
+        
+        outputSpillThreshold
+            if given then number of bytes of stdout or stderr past which to spill it into a temporary file,
+            see OutputBuffer.
+        
+        outputMaxRetained
+            if given then only retain the last outputMaxRetained bytes of stdout and of stderr,
+            e.g. for very chatty commands, see OutputBuffer.
+        
+        until
+            if given then a regular expression, searched for in each line of stdout as it arrives,
+            and if matched then not raising a CommandCaptureException, see property untilMatch.
+        
+        killWhenMatched
+            whether, if until matched, to kill the subprocess, and any further subprocesses it has started,
+            hence then started in a process group of its own, see class CommandCaptureHandle,
+            else leave it running, in which case returncode, stdout and stderr are None
+            until done, see property handle."""
+        # in the same process group as before, in case the command reads from the terminal,
+        # unless to be killed, then killing further subprocesses it has started too
+        self._handle = CommandCaptureHandle(args, copyToStdio=copyToStdio, forgoPty=forgoPty,
+                                            exceptionIfNotZero=exceptionIfNotZero,
+                                            exceptionIfAnyStderr=exceptionIfAnyStderr,
+                                            processGroup=until is not None and killWhenMatched,
+                                            outputSpillThreshold=outputSpillThreshold,
+                                            outputMaxRetained=outputMaxRetained)
+        self._untilMatch = None
+        if until is not None:
+            self._untilMatch = self._handle.waitUntil(until, kill=killWhenMatched)
+            if self._untilMatch:
+                # no reason to raise an exception after having found what was looked for
+                return
+        # raise an exception if asked to and there is a reason
+        self._handle.wait()
+
+    @classmethod
+    def start(cls, args, copyToStdio=True, forgoPty=False,
+              exceptionIfNotZero=True, exceptionIfAnyStderr=True,
+              processGroup=True,
+              outputSpillThreshold=None, outputMaxRetained=None,
+              stdin=None, stdout=None):
+        """Start a subprocess and return right away.
+        
+        Example use::
+        
+            pings = [CommandCapture.start(["ping", "-c", "3", ipaddress], copyToStdio=False)
+                     for ipaddress in ["10.123.45.67", "10.123.45.68"]]
+            for ping in pings:
+                ping.wait()
+        
+        processGroup, stdin, stdout
+            see documentation of class CommandCaptureHandle.
+        
+        For other parameters see documentation of constructor.
+        
+        return
+            a CommandCaptureHandle."""
+        return CommandCaptureHandle(args, copyToStdio=copyToStdio, forgoPty=forgoPty,
+                                    exceptionIfNotZero=exceptionIfNotZero,
+                                    exceptionIfAnyStderr=exceptionIfAnyStderr,
+                                    processGroup=processGroup,
+                                    outputSpillThreshold=outputSpillThreshold,
+                                    outputMaxRetained=outputMaxRetained,
+                                    stdin=stdin, stdout=stdout)
+
+    def raiseExceptionIfThereIsAReason(self):
+        """Raise a CommandCaptureException if there is a reason.
+        
+        Available to provide standardized exception content in case calling code
+        with exceptionIfAnyStderr=False after looking at .stderr decides
+        in some circumstances only to raise an exception."""
+        self._handle.raiseExceptionIfThereIsAReason()
+
+    @property
+    def returncode(self):
+        """Int returncode of subprocess."""
+        return self._handle.returncode
+
     @property
     def stdout(self):
         """Collected stdout string of subprocess."""
-        return self._stdout
+        return self._handle.stdout
 
     @property
     def stderr(self):
         """Collected stderr string of subprocess."""
-        return self._stderr
+        return self._handle.stderr
+
+    @property
+    def untilMatch(self):
+        """Match object if constructed with until and matched, else None."""
+        return self._untilMatch
+
+    @property
+    def handle(self):
+        """CommandCaptureHandle of subprocess, e.g. to wait() for it if left running after until matched."""
+        return self._handle
+
+    @property
+    def usage(self):
+        """CommandCaptureUsage of subprocess, None if left running after until matched."""
+        return self._handle.usage
+
+    @property
+    def wallSeconds(self):
+        """Seconds from starting until the subprocess has exited."""
+        return self._handle.wallSeconds
+
+    @property
+    def userSeconds(self):
+        """Seconds of user CPU time of subprocess, None if not available, e.g. in Windows."""
+        return self._handle.userSeconds
+
+    @property
+    def systemSeconds(self):
+        """Seconds of system CPU time of subprocess, None if not available, e.g. in Windows."""
+        return self._handle.systemSeconds
+
+    @property
+    def maxRssKilobytes(self):
+        """Maximum resident set size of subprocess, None if not available, e.g. in Windows."""
+        return self._handle.maxRssKilobytes
+
+    @property
+    def stdoutBytes(self):
+        """Number of bytes of stdout of subprocess, including any not retained."""
+        return self._handle.stdoutBytes
+
+    @property
+    def stderrBytes(self):
+        """Number of bytes of stderr of subprocess, including any not retained."""
+        return self._handle.stderrBytes
+
+    @property
+    def usedPty(self):
+        """Whether a pseudo-terminal (pty) has been used rather than pipes."""
+        return self._handle.usedPty
+
+    @property
+    def stdoutBuffer(self):
+        """OutputBuffer collected stdout of subprocess into."""
+        return self._handle.stdoutBuffer
+
+    @property
+    def stderrBuffer(self):
+        """OutputBuffer collected stderr of subprocess into."""
+        return self._handle.stderrBuffer
+
+class CommandCapturePipeline(object):
+    """Subprocesses connected by pipes, as in a shell, e.g. tar | gzip.
+    
+    Output of each stage goes into the next stage through a pipe of the operating system,
+    never through Python.
+    Only stdout of the last stage is collected, unless written into a file,
+    stderr of each stage is collected.
+    
+    Uses pipes rather than a pty, see class CommandCapture.
+    
+    The constructor waits until all stages have exited.
+    
+    Raises a CommandCaptureException if there is a reason in any stage,
+    as if in a shell with option pipefail,
+    except for an earlier stage ended by SIGPIPE because a later stage has exited,
+    e.g. in ... | head.
+    
+    It should work in Linux and Windows."""
+
+    def __init__(self, argsList, copyToStdio=True,
+                 exceptionIfNotZero=True, exceptionIfAnyStderr=True,
+                 stdinPath=None, stdoutPath=None,
+                 outputSpillThreshold=None, outputMaxRetained=None):
+        """Create new CommandCapturePipeline instance.
+        
+        Will wait until completed.
+        
+        Example use::
+        
+            CommandCapturePipeline([["tar", "-cf", "-", "somedirectory"],
+                                    ["gzip", "-c"]],
+                                   stdoutPath="somedirectory.tar.gz")
+            isolinuxCfgSha256 = CommandCapturePipeline([["iso-read", "-i", isoPath,
+                                                         "-e", "/isolinux/isolinux.cfg", "-o", "/dev/stdout"],
+                                                        ["sha256sum"]],
+                                                       copyToStdio=False).stdout.split()[0]
+        
+        argsList
+            a list of args, one for each stage, see documentation of class CommandCapture.
+        
+        stdinPath
+            if given then path of file for the first stage to read from.
+        
+        stdoutPath
+            if given then path of file for the last stage to write into, instead of collecting.
+        
+        For other parameters see documentation of class CommandCapture."""
+        if not argsList:
+            raise Exception("must have at least one stage in a pipeline")
+        self._handles = []
+        stdinFile = open(stdinPath, "rb") if stdinPath else None
+        stdoutFile = None
+        try:
+            stdoutFile = open(stdoutPath, "wb") if stdoutPath else None
+            pipeOut = stdinFile
+            for index, args in enumerate(argsList):
+                lastStage = index == len(argsList) - 1
+                try:
+                    handle = CommandCaptureHandle(args, copyToStdio=copyToStdio, forgoPty=True,
+                                                  exceptionIfNotZero=exceptionIfNotZero,
+                                                  exceptionIfAnyStderr=exceptionIfAnyStderr,
+                                                  processGroup=False,
+                                                  outputSpillThreshold=outputSpillThreshold,
+                                                  outputMaxRetained=outputMaxRetained,
+                                                  stdin=pipeOut,
+                                                  stdout=stdoutFile if lastStage else subprocess.PIPE)
+                finally:
+                    if pipeOut is not None and pipeOut is not stdinFile:
+                        # only the next stage should hold on to it,
+                        # so the stage before sees when the next stage has exited
+                        pipeOut.close()
+                self._handles.append(handle)
+                pipeOut = handle.stdoutPipe
+        except:
+            for handle in self._handles:
+                handle.kill()
+            raise
+        finally:
+            # subprocesses have their own copies
+            if stdinFile:
+                stdinFile.close()
+            if stdoutFile:
+                stdoutFile.close()
+        try:
+            for handle in self._handles:
+                handle._waitUntilDone()
+        except KeyboardInterrupt:
+            for handle in self._handles:
+                handle.kill()
+            raise
+        # raise an exception if asked to and there is a reason
+        self.raiseExceptionIfThereIsAReason()
+
+    def raiseExceptionIfThereIsAReason(self):
+        """Raise a CommandCaptureException if there is a reason in any stage.
+        
+        Available to provide standardized exception content in case calling code
+        with exceptionIfAnyStderr=False after looking at .stderr decides
+        in some circumstances only to raise an exception."""
+        exceptionMessages = []
+        for index, handle in enumerate(self._handles):
+            if index < len(self._handles) - 1 and hasattr(signal, "SIGPIPE") \
+                and handle.returncode == -signal.SIGPIPE and not handle.stderr:
+                # a later stage has exited, e.g. head, normal in a pipeline
+                continue
+            try:
+                handle.raiseExceptionIfThereIsAReason()
+            except CommandCaptureException as ex:
+                exceptionMessages.append("stage {0}:\n{1}".format(index + 1, ex.message))
+        if exceptionMessages:
+            raise CommandCaptureException("\n".join(exceptionMessages))
+
+    @property
+    def handles(self):
+        """List of CommandCaptureHandle, one for each stage, e.g. for usage of each stage."""
+        return self._handles
+
+    @property
+    def returncode(self):
+        """Int returncode of last stage, as in a shell."""
+        return self._handles[-1].returncode
+
+    @property
+    def returncodes(self):
+        """List of int returncode of each stage."""
+        return [handle.returncode for handle in self._handles]
+
+    @property
+    def stdout(self):
+        """Collected stdout string of last stage, empty if written into a file."""
+        return self._handles[-1].stdout
+
+    @property
+    def stderrs(self):
+        """List of collected stderr string of each stage."""
+        return [handle.stderr for handle in self._handles]
+
+    @property
+    def stderr(self):
+        """Collected stderr strings of all stages, joined."""
+        return "".join(self.stderrs)
 
 if __name__ == "__main__":
     _example1 = CommandCapture(["hostname"], forgoPty=True)
@@ -347,3 +1585,50 @@ if __name__ == "__main__":
         print >> sys.stderr, "stderr=" + _example6.stderr
     except Exception as ex:
         print "Exception ({0}):\n{1}".format(ex.__class__.__name__, str(ex))
+    #
+    _handles = [CommandCapture.start(["sleep", "1"]) for _ in range(5)]
+    _begin = time.time()
+    print "returncodes=" + str([_handle.wait() for _handle in _handles])
+    print "overlapped 5 times sleep 1 in {0:.1f} seconds".format(time.time() - _begin)
+    #
+    _handle9 = CommandCapture.start(["sh", "-c", "sleep 30 ; echo notreached"], exceptionIfNotZero=False)
+    print "poll=" + str(_handle9.poll())
+    print "wait with timeout=" + str(_handle9.wait(timeout=0.5))
+    print "returncode after kill=" + str(_handle9.kill().wait())
+    print "stdout=" + _handle9.stdout
+    #
+    _handle10 = CommandCapture.start(["sh", "-c", "for i in 1 2 3 ; do echo line $i ; sleep 0.2 ; done"])
+    for _line in _handle10.lines():
+        print "line arrived " + repr(_line)
+    #
+    _begin = time.time()
+    _example11 = CommandCapture(["sh", "-c", "echo starting ; sleep 0.2 ; echo ready ; sleep 30"],
+                                until=r"^ready", killWhenMatched=True)
+    print "until matched {0!r} in {1:.1f} seconds, returncode={2}".format(
+        _example11.untilMatch.group(0), time.time() - _begin, _example11.returncode)
+    #
+    _example12 = CommandCapture(["sh", "-c", "i=0 ; while [ $i -lt 100000 ] ; do i=$((i+1)) ; done ; echo counted"])
+    print "usage=" + str(_example12.usage)
+    #
+    _example13 = CommandCapturePipeline([["seq", "1", "100000"], ["sort", "-r", "-n"], ["head", "-n", "3"]])
+    print "returncodes=" + str(_example13.returncodes)
+    print "stdout=" + _example13.stdout
+    #
+    print CommandCaptureStatistics.report()
+    #
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        # scaling with number of concurrent subprocesses, threads per subprocess versus one multiplexer thread
+        for _concurrency in [1, 10, 50, 200]:
+            _results = []
+            for _name, _useMultiplexer in [("threads", False), ("multiplexer", True)]:
+                CommandCaptureHandle.useMultiplexer = _useMultiplexer
+                _begin = time.time()
+                _handles = [CommandCapture.start(["sh", "-c", "echo out ; echo err >&2 ; sleep 0.2"],
+                                                 copyToStdio=False, exceptionIfAnyStderr=False)
+                            for _ in range(_concurrency)]
+                _threadCount = threading.active_count()
+                for _handle in _handles:
+                    _handle.wait()
+                _results.append("{0} {1:>4} threads {2:>6.3f} s".format(_name, _threadCount, time.time() - _begin))
+            print "{0:>4} concurrent  {1}".format(_concurrency, "  ".join(_results))
+        CommandCaptureHandle.useMultiplexer = True
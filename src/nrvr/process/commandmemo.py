@@ -0,0 +1,354 @@
+#!/usr/bin/python
+
+"""nrvr.process.commandmemo - Memoize results of idempotent commands across runs
+
+Classes provided by this module include
+* CommandMemoResult
+* CommandMemoStats
+* CommandMemo
+
+The main class provided by this module is CommandMemo.
+
+Some commands are run again on every run of a script even though their result
+only depends on their arguments and on files they read,
+e.g. openssl passwd with a fixed salt, or iso-info listing a given .iso image.
+
+Results are keyed by args, by values of declared environment variables,
+by identity of the command's executable,
+and by size, modification time and inode of declared input files.
+Results are kept on disk, hence a warm run does not spawn those commands at all.
+
+Memoizing is opt-in, only once CommandMemo.enable() has been called,
+else CommandMemo.capture() simply runs a CommandCapture.
+
+Results are kept for a limited time, and least recently used results are evicted
+to stay within a size limit.
+
+Only results of commands which have not raised an exception are kept.
+
+It should work in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+from collections import namedtuple
+import errno
+import hashlib
+import json
+import os
+import os.path
+import threading
+import time
+
+from nrvr.process.commandcapture import CommandCapture
+from nrvr.util.classproperty import classproperty
+from nrvr.util.times import Timestamp
+from nrvr.util.user import ScriptUser
+
+class CommandMemoResult(namedtuple("CommandMemoResult",
+                                   ["args", "returncode", "stdout", "stderr", "memoized"])):
+    """Result of a command, with the same returncode, stdout and stderr as a CommandCapture.
+
+    memoized is whether it has been found memoized rather than by running the command."""
+
+    __slots__ = ()
+
+class CommandMemoStats(namedtuple("CommandMemoStats",
+                                  ["hits", "misses", "expired", "evictions",
+                                   "entries", "bytes", "maxBytes"])):
+    """Statistics of a CommandMemo.
+
+    hits, misses, expired, evictions are counted since the CommandMemo instance has been made.
+
+    entries, bytes are of the memo directory on the host disk at the time of asking."""
+
+    __slots__ = ()
+
+class CommandMemo(object):
+    """A size-bounded memo of results of commands, kept on disk, with results expiring."""
+
+    def __init__(self, memoDirectory=None, ttlSeconds=7 * 24 * 60 * 60, maxBytes=16 * 1024 * 1024):
+        """Create new CommandMemo.
+
+        memoDirectory
+            path of directory to keep results in, made if it doesn't exist yet,
+            if None then ~/.nrvr/commandmemo.
+
+        ttlSeconds
+            default number of seconds a result is kept.
+
+        maxBytes
+            maximum total size of results kept."""
+        if memoDirectory is None:
+            memoDirectory = ScriptUser.loggedIn.userHomeRelative(".nrvr/commandmemo")
+        self._memoDirectory = memoDirectory
+        self._ttlSeconds = ttlSeconds
+        self._maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+        self._expired = 0
+        self._evictions = 0
+        if not os.path.isdir(self._memoDirectory):
+            try:
+                os.makedirs(self._memoDirectory, 0700)
+            except OSError:
+                if not os.path.isdir(self._memoDirectory): # not concurrently made
+                    raise
+
+    _enabled = None
+
+    @classmethod
+    def enable(cls, memoDirectory=None, ttlSeconds=7 * 24 * 60 * 60, maxBytes=16 * 1024 * 1024):
+        """Start memoizing in this process, for all uses of CommandMemo.capture().
+
+        For parameters see documentation of constructor.
+
+        return
+            the CommandMemo made, e.g. to look at its stats()."""
+        CommandMemo._enabled = CommandMemo(memoDirectory, ttlSeconds=ttlSeconds, maxBytes=maxBytes)
+        return CommandMemo._enabled
+
+    @classmethod
+    def disable(cls):
+        """Stop memoizing in this process."""
+        CommandMemo._enabled = None
+
+    @classproperty
+    def enabled(cls):
+        """The CommandMemo in use in this process, None if not enabled."""
+        return CommandMemo._enabled
+
+    @property
+    def memoDirectory(self):
+        """Path of directory to keep results in."""
+        return self._memoDirectory
+
+    @classmethod
+    def _executablePath(cls, command):
+        """Auxiliary method, return path of executable command would run, or None if not found."""
+        if os.path.dirname(command):
+            return os.path.abspath(command)
+        for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+            path = os.path.join(directory, command)
+            if os.path.isfile(path) and os.access(path, os.X_OK):
+                return path
+        return None
+
+    @classmethod
+    def _identity(cls, path):
+        """Auxiliary method, return identity of a file, changing when the file changes,
+        or None if no such file."""
+        try:
+            pathStat = os.stat(path)
+        except OSError:
+            return None
+        return [os.path.realpath(path), pathStat.st_size, pathStat.st_mtime, pathStat.st_ino]
+
+    @classmethod
+    def key(cls, args, envNames=(), inputPaths=(), exceptionIfNotZero=True, exceptionIfAnyStderr=True):
+        """Return a key for a result.
+
+        Args are part of the key only hashed, hence e.g. a password in args is not kept on disk."""
+        if isinstance(args, basestring):
+            args = args.split()
+        serialization = json.dumps({"args": list(args),
+                                    "executable": cls._identity(cls._executablePath(args[0]) or args[0]),
+                                    "env": dict((name, os.environ.get(name)) for name in envNames),
+                                    "inputs": [cls._identity(path) for path in inputPaths],
+                                    "exceptionIfNotZero": exceptionIfNotZero,
+                                    "exceptionIfAnyStderr": exceptionIfAnyStderr},
+                                   sort_keys=True)
+        return hashlib.sha256(serialization).hexdigest()
+
+    def _memoPath(self, key):
+        """Auxiliary method."""
+        return os.path.join(self._memoDirectory, key + ".json")
+
+    def lookup(self, key, ttlSeconds=None):
+        """Return (returncode, stdout, stderr) if memoized and not expired, else None.
+
+        ttlSeconds
+            if None then as given when making this CommandMemo."""
+        if ttlSeconds is None:
+            ttlSeconds = self._ttlSeconds
+        memoPath = self._memoPath(key)
+        try:
+            with open(memoPath, "r") as memoFile:
+                memo = json.load(memoFile)
+        except (IOError, OSError, ValueError):
+            # not there, or removed meanwhile, or incomplete
+            with self._lock:
+                self._misses += 1
+            return None
+        if memo["created"] + ttlSeconds < time.time():
+            self._remove(key)
+            with self._lock:
+                self._expired += 1
+            return None
+        try:
+            # time of last use, for evicting least recently used first
+            os.utime(memoPath, None)
+        except OSError:
+            pass
+        with self._lock:
+            self._hits += 1
+        # latin-1 to get back the very same bytes
+        return (memo["returncode"], memo["stdout"].encode("latin-1"), memo["stderr"].encode("latin-1"))
+
+    def store(self, key, returncode, stdout, stderr):
+        """Keep a result, then evict least recently used results as needed."""
+        memoPath = self._memoPath(key)
+        temporaryPath = memoPath + ".tmp" + Timestamp.microsecondTimestamp()
+        try:
+            with open(temporaryPath, "w") as memoFile:
+                # latin-1 because any bytes can be decoded, output may not be UTF-8
+                json.dump({"created": time.time(),
+                           "returncode": returncode,
+                           "stdout": stdout.decode("latin-1"),
+                           "stderr": stderr.decode("latin-1")},
+                          memoFile)
+            # atomic, in case another process has stored the same key meanwhile
+            os.rename(temporaryPath, memoPath)
+        finally:
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+        self.evict()
+
+    def _entries(self):
+        """Auxiliary method, return a list of (lastUsed, key, size), least recently used first."""
+        entries = []
+        for name in os.listdir(self._memoDirectory):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-5]
+            try:
+                memoStat = os.stat(self._memoPath(key))
+            except OSError:
+                # removed meanwhile
+                continue
+            entries.append((memoStat.st_mtime, key, memoStat.st_size))
+        entries.sort()
+        return entries
+
+    def _remove(self, key):
+        """Auxiliary method."""
+        try:
+            os.remove(self._memoPath(key))
+        except OSError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+
+    def evict(self, maxBytes=None):
+        """Remove least recently used results until total size is not more than maxBytes.
+
+        maxBytes
+            if None then as given when making this CommandMemo."""
+        if maxBytes is None:
+            maxBytes = self._maxBytes
+        entries = self._entries()
+        totalBytes = sum(size for lastUsed, key, size in entries)
+        for lastUsed, key, size in entries:
+            if totalBytes <= maxBytes:
+                break
+            self._remove(key)
+            totalBytes -= size
+            with self._lock:
+                self._evictions += 1
+
+    def clear(self):
+        """Remove all results."""
+        for lastUsed, key, size in self._entries():
+            self._remove(key)
+
+    def stats(self):
+        """Return a CommandMemoStats."""
+        entries = self._entries()
+        return CommandMemoStats(hits=self._hits,
+                                misses=self._misses,
+                                expired=self._expired,
+                                evictions=self._evictions,
+                                entries=len(entries),
+                                bytes=sum(size for lastUsed, key, size in entries),
+                                maxBytes=self._maxBytes)
+
+    @classmethod
+    def capture(cls, args, envNames=(), inputPaths=(), ttlSeconds=None,
+                copyToStdio=False, forgoPty=False,
+                exceptionIfNotZero=True, exceptionIfAnyStderr=True):
+        """Return result of a command, memoized if enabled, else by running a CommandCapture.
+
+        Only for commands whose result only depends on args, environment variables named in envNames,
+        the command's executable, and files in inputPaths.
+
+        Example use::
+
+            isoInfo = CommandMemo.capture(["iso-info", "-i", isoImagePath, "-f"],
+                                          inputPaths=[isoImagePath])
+            print isoInfo.stdout
+
+        envNames
+            names of environment variables the result depends on.
+
+        inputPaths
+            paths of files the result depends on, they need not exist.
+
+        ttlSeconds
+            if None then as given when enabling.
+
+        For other parameters see documentation of class CommandCapture,
+        except copyToStdio defaults to False, because when memoized there is nothing to copy.
+
+        return
+            a CommandMemoResult."""
+        if isinstance(args, basestring):
+            args = args.split()
+        memo = CommandMemo._enabled
+        key = None
+        if memo:
+            key = memo.key(args, envNames=envNames, inputPaths=inputPaths,
+                           exceptionIfNotZero=exceptionIfNotZero, exceptionIfAnyStderr=exceptionIfAnyStderr)
+            memoized = memo.lookup(key, ttlSeconds=ttlSeconds)
+            if memoized:
+                returncode, stdout, stderr = memoized
+                return CommandMemoResult(args, returncode, stdout, stderr, True)
+        # raises an exception if asked to and there is a reason, then nothing is memoized
+        commandCapture = CommandCapture(args, copyToStdio=copyToStdio, forgoPty=forgoPty,
+                                        exceptionIfNotZero=exceptionIfNotZero,
+                                        exceptionIfAnyStderr=exceptionIfAnyStderr)
+        if memo:
+            memo.store(key, commandCapture.returncode, commandCapture.stdout, commandCapture.stderr)
+        return CommandMemoResult(args, commandCapture.returncode, commandCapture.stdout, commandCapture.stderr,
+                                 False)
+
+if __name__ == "__main__":
+    import shutil
+    import tempfile
+    _testDir = os.path.join(tempfile.gettempdir(), Timestamp.microsecondTimestamp())
+    os.mkdir(_testDir, 0755)
+    try:
+        _memo = CommandMemo.enable(os.path.join(_testDir, "memo"))
+        _inputPath = os.path.join(_testDir, "input.txt")
+        with open(_inputPath, "w") as _inputFile:
+            _inputFile.write("hello\n")
+        for _ in range(3):
+            _begin = time.time()
+            _result = CommandMemo.capture(["cat", _inputPath], inputPaths=[_inputPath])
+            print "memoized={0} stdout={1!r} in {2:.4f} seconds".format(_result.memoized, _result.stdout,
+                                                                       time.time() - _begin)
+        with open(_inputPath, "w") as _inputFile:
+            _inputFile.write("changed input file\n")
+        _result = CommandMemo.capture(["cat", _inputPath], inputPaths=[_inputPath])
+        print "memoized={0} stdout={1!r}".format(_result.memoized, _result.stdout)
+        _result = CommandMemo.capture(["cat", _inputPath], inputPaths=[_inputPath], ttlSeconds=0)
+        print "memoized={0} after ttlSeconds=0".format(_result.memoized)
+        print _memo.stats()
+        _memo.evict(maxBytes=0)
+        print _memo.stats()
+    finally:
+        CommandMemo.disable()
+        shutil.rmtree(_testDir)
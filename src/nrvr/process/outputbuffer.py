@@ -0,0 +1,262 @@
+#!/usr/bin/python
+
+"""nrvr.process.outputbuffer - Collect output of subprocesses in linear time
+
+Class provided by this module is OutputBuffer.
+
+Appending is linear in time, by keeping a list of chunks rather than
+concatenating strings, which would copy everything collected so far each time.
+
+Optionally spills into a temporary file once past a size threshold,
+or optionally only retains the tail, to bound memory use.
+
+Can be read from while being appended to, e.g. line by line as output arrives.
+
+It should work in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+from collections import deque
+import os
+import tempfile
+import threading
+
+class OutputBuffer(object):
+    """Collects output, e.g. of a subprocess, linear in time and optionally bounded in memory.
+
+    Thread-safe for one thread appending while other threads read."""
+
+    def __init__(self, spillThreshold=None, maxRetained=None, spillDirectory=None):
+        """Create new OutputBuffer.
+
+        spillThreshold
+            if given then number of bytes past which to spill everything into a temporary file,
+            which is removed when closed or garbage collected.
+
+        maxRetained
+            if given then only retain the last maxRetained bytes, in memory,
+            hence then no need to spill.
+
+        spillDirectory
+            where to make the temporary file, if None then the default temporary directory."""
+        self._spillThreshold = spillThreshold
+        self._maxRetained = maxRetained
+        self._spillDirectory = spillDirectory
+        self._chunks = deque()
+        # number of bytes in self._chunks
+        self._inMemory = 0
+        # number of bytes ever appended
+        self._length = 0
+        # number of bytes not retained
+        self._discarded = 0
+        self._spillFile = None
+        self._ended = False
+        self._lock = threading.Lock()
+        # notified when appended to or ended
+        self._changed = threading.Condition(self._lock)
+
+    def append(self, data):
+        """Append data.
+
+        return
+            self, for daisychaining."""
+        if not data:
+            return self
+        with self._lock:
+            self._length += len(data)
+            self._changed.notify_all()
+            if self._spillFile:
+                self._spillFile.seek(0, os.SEEK_END)
+                self._spillFile.write(data)
+                return self
+            self._chunks.append(data)
+            self._inMemory += len(data)
+            if self._maxRetained is not None:
+                # drop whole chunks no longer needed, trim the rest when asked for value
+                while self._chunks and self._inMemory - len(self._chunks[0]) >= self._maxRetained:
+                    dropped = self._chunks.popleft()
+                    self._inMemory -= len(dropped)
+                    self._discarded += len(dropped)
+            elif self._spillThreshold is not None and self._inMemory > self._spillThreshold:
+                self._spill()
+        return self
+
+    def write(self, data):
+        """Same as append, so an OutputBuffer can be used like a file being written to."""
+        self.append(data)
+
+    def end(self):
+        """Mark that nothing more will be appended, e.g. at the end of a stream.
+
+        return
+            self, for daisychaining."""
+        with self._lock:
+            self._ended = True
+            self._changed.notify_all()
+        return self
+
+    @property
+    def ended(self):
+        """Whether marked that nothing more will be appended."""
+        return self._ended
+
+    def _spill(self):
+        """Auxiliary method, called with lock held."""
+        self._spillFile = tempfile.TemporaryFile(prefix="output-", suffix=".tmp", dir=self._spillDirectory)
+        while self._chunks:
+            self._spillFile.write(self._chunks.popleft())
+        self._inMemory = 0
+
+    def _joined(self):
+        """Auxiliary method, called with lock held, return retained chunks joined,
+        and keep them joined so asking again is cheap."""
+        if len(self._chunks) > 1:
+            joined = "".join(self._chunks)
+            self._chunks.clear()
+            self._chunks.append(joined)
+        return self._chunks[0] if self._chunks else ""
+
+    def getvalue(self):
+        """Return everything retained as one string.
+
+        If spilled then read from the temporary file."""
+        with self._lock:
+            if self._spillFile:
+                self._spillFile.seek(0)
+                return self._spillFile.read()
+            value = self._joined()
+            if self._maxRetained is not None and len(value) > self._maxRetained:
+                # trim now
+                trim = len(value) - self._maxRetained
+                value = value[trim:]
+                self._chunks.clear()
+                self._chunks.append(value)
+                self._inMemory = len(value)
+                self._discarded += trim
+            return value
+
+    def tail(self, length):
+        """Return the last length bytes retained, without joining everything."""
+        if length <= 0:
+            return ""
+        with self._lock:
+            if self._spillFile:
+                self._spillFile.seek(0, os.SEEK_END)
+                self._spillFile.seek(max(0, self._spillFile.tell() - length))
+                return self._spillFile.read()
+            if self._maxRetained is not None:
+                length = min(length, self._maxRetained)
+            pieces = []
+            collected = 0
+            for chunk in reversed(self._chunks):
+                pieces.append(chunk)
+                collected += len(chunk)
+                if collected >= length:
+                    break
+            return "".join(reversed(pieces))[-length:]
+
+    def readFrom(self, offset):
+        """Return data retained from offset on, and the offset to read from next time.
+
+        Offsets count all bytes ever appended, hence stay valid while appending.
+        If data at offset is not retained anymore, because of maxRetained, then returns from
+        the first byte retained.
+
+        return
+            (data, nextOffset)."""
+        with self._lock:
+            if offset >= self._length:
+                return "", self._length
+            if self._spillFile:
+                self._spillFile.seek(offset)
+                return self._spillFile.read(self._length - offset), self._length
+            wanted = self._length - max(offset, self._length - self._inMemory)
+            pieces = []
+            collected = 0
+            for chunk in reversed(self._chunks):
+                pieces.append(chunk)
+                collected += len(chunk)
+                if collected >= wanted:
+                    break
+            return "".join(reversed(pieces))[-wanted:], self._length
+
+    def waitForMore(self, offset, timeout=None):
+        """Wait until more than offset bytes have been appended, or ended, or timeout.
+
+        return
+            whether more than offset bytes have been appended, or ended."""
+        with self._lock:
+            if self._length <= offset and not self._ended:
+                self._changed.wait(timeout)
+            return self._length > offset or self._ended
+
+    def __len__(self):
+        """Number of bytes ever appended, including any not retained."""
+        return self._length
+
+    @property
+    def discarded(self):
+        """Number of bytes not retained, because of maxRetained."""
+        with self._lock:
+            if self._maxRetained is not None:
+                return self._length - min(self._length, self._maxRetained)
+            return self._discarded
+
+    @property
+    def spilled(self):
+        """Whether spilled into a temporary file."""
+        return self._spillFile is not None
+
+    def close(self):
+        """Release memory and remove any temporary file."""
+        with self._lock:
+            self._chunks.clear()
+            self._inMemory = 0
+            if self._spillFile:
+                self._spillFile.close()
+                self._spillFile = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+if __name__ == "__main__":
+    # micro-benchmark, concatenating strings versus OutputBuffer, 1024-byte reads as SshCommand does
+    import time
+    _chunk = "x" * 1023 + "\n"
+    for _megabytes in [1, 2, 4]:
+        _count = _megabytes * 1024
+        _results = []
+        for _name in ["+=", "OutputBuffer"]:
+            _begin = time.time()
+            if _name == "+=":
+                _collected = ""
+                for _ in xrange(_count):
+                    # defeat CPython's in-place optimization, as an attribute or a second reference would
+                    _reference = _collected
+                    _collected += _chunk
+                _length = len(_collected)
+            else:
+                _buffer = OutputBuffer()
+                for _ in xrange(_count):
+                    _buffer.append(_chunk)
+                _length = len(_buffer.getvalue())
+            if _length != _count * len(_chunk):
+                raise Exception("wrong length collecting by {0}".format(_name))
+            _results.append("{0} {1:>7.3f} s".format(_name, time.time() - _begin))
+        print "{0:>3} MB  {1}".format(_megabytes, "  ".join(_results))
+    with OutputBuffer(spillThreshold=1000000) as _buffer:
+        for _ in xrange(4096):
+            _buffer.append(_chunk)
+        print "spilled {0}, length {1}, tail {2!r}".format(_buffer.spilled, len(_buffer), _buffer.tail(5))
+    _buffer = OutputBuffer(maxRetained=10000)
+    for _ in xrange(4096):
+        _buffer.append(_chunk)
+    print "retained {0}, discarded {1}".format(len(_buffer.getvalue()), _buffer.discarded)
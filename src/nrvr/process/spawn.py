@@ -0,0 +1,347 @@
+#!/usr/bin/python
+
+"""nrvr.process.spawn - Start subprocesses without copying a large parent process
+
+Class provided by this module is SpawnedProcess.
+
+Starting a subprocess by subprocess.Popen or pty.fork forks first,
+which copies page tables of the whole parent process, noticeable time
+when a script holds large state in memory and starts many subprocesses,
+e.g. vmrun, ssh, ping.
+
+Instead uses posix_spawnp of the C library by ctypes, which in Linux with glibc 2.24 or newer
+does not copy the parent process, as vfork does.
+
+Where not available, e.g. in Windows, or other than Linux, falls back to subprocess.Popen and pty.fork.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import errno
+import os
+import signal
+import subprocess
+import sys
+
+_gotPty = False
+try:
+    import pty
+    _gotPty = True
+except ImportError:
+    pass
+
+_gotSpawn = False
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        import ctypes.util
+        import fcntl
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        _libc.posix_spawnp.argtypes = [ctypes.POINTER(ctypes.c_int), ctypes.c_char_p,
+                                       ctypes.c_void_p, ctypes.c_void_p,
+                                       ctypes.POINTER(ctypes.c_char_p), ctypes.c_void_p]
+        _libc.posix_spawn_file_actions_adddup2.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_int]
+        _libc.posix_spawn_file_actions_addclose.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        _libc.posix_spawn_file_actions_addopen.argtypes = [ctypes.c_void_p, ctypes.c_int, ctypes.c_char_p,
+                                                           ctypes.c_int, ctypes.c_uint]
+        _libc.posix_spawnattr_setflags.argtypes = [ctypes.c_void_p, ctypes.c_short]
+        _libc.posix_spawnattr_setpgroup.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        _libc.posix_spawnattr_setsigdefault.argtypes = [ctypes.c_void_p, ctypes.c_void_p]
+        _libc.sigaddset.argtypes = [ctypes.c_void_p, ctypes.c_int]
+        _environ = ctypes.c_void_p.in_dll(_libc, "environ")
+        _gotSpawn = True
+    except (ImportError, OSError, AttributeError, ValueError):
+        pass
+
+# flags as in glibc spawn.h
+_POSIX_SPAWN_SETPGROUP = 0x02
+_POSIX_SPAWN_SETSIGDEF = 0x04
+_POSIX_SPAWN_SETSID = 0x80
+
+# larger than posix_spawn_file_actions_t, posix_spawnattr_t and sigset_t are in glibc
+_opaqueSize = 1024
+
+class SpawnedProcess(object):
+    """A subprocess started by posix_spawnp, with as much of the interface of subprocess.Popen
+    as used in this package, i.e. pid, returncode, stdin, stdout, stderr, poll(), wait(),
+    terminate() and kill().
+
+    Use method popen, which falls back to subprocess.Popen where posix_spawnp is not available.
+
+    Does not close file descriptors other than those it has been given,
+    as subprocess.Popen with close_fds=False doesn't either."""
+
+    # whether posix_spawnp can be used here
+    supported = _gotSpawn
+
+    # whether method ptySpawn can be used here, i.e. whether module pty is available,
+    # e.g. in Python 2.6 on Linux, but not on Windows
+    ptySupported = _gotPty
+
+    # whether to use posix_spawnp where supported, else always fork
+    enabled = True
+
+    @classmethod
+    def usable(cls):
+        """Whether methods popen and ptySpawn will use posix_spawnp."""
+        return SpawnedProcess.supported and SpawnedProcess.enabled
+
+    @classmethod
+    def popen(cls, args, stdin=None, stdout=None, stderr=None, processGroup=False, defaultSigpipe=False):
+        """Start a subprocess, by posix_spawnp where usable, else by subprocess.Popen.
+
+        processGroup
+            whether to start the subprocess in a process group of its own.
+
+        defaultSigpipe
+            whether to have SIGPIPE default in the subprocess, as in a shell,
+            rather than ignored as inherited from Python.
+
+        For other parameters see documentation of subprocess.Popen.
+
+        return
+            a SpawnedProcess, or a subprocess.Popen."""
+        if SpawnedProcess.usable():
+            return SpawnedProcess(args, stdin=stdin, stdout=stdout, stderr=stderr,
+                                  processGroup=processGroup, defaultSigpipe=defaultSigpipe)
+        popenOptions = {}
+        if os.name == "posix" and (processGroup or defaultSigpipe):
+            def preexec():
+                if defaultSigpipe:
+                    signal.signal(signal.SIGPIPE, signal.SIG_DFL)
+                if processGroup:
+                    os.setpgrp()
+            popenOptions["preexec_fn"] = preexec
+        elif processGroup and sys.platform == "win32":
+            popenOptions["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+        return subprocess.Popen(args, stdin=stdin, stdout=stdout, stderr=stderr, **popenOptions)
+
+    @classmethod
+    def ptySpawn(cls, args):
+        """Start a subprocess connected to a new pseudo-terminal (pty) as its controlling terminal,
+        by posix_spawnp where usable, else by pty.fork, e.g. for ssh to ask for a password.
+
+        Unlike pty.fork returns in the parent process only.
+
+        return
+            (pid, fd), fd of the master end of the pty."""
+        if not SpawnedProcess.usable():
+            pid, fd = pty.fork()
+            if pid == 0:
+                # in child process
+                try:
+                    os.execvp(args[0], args)
+                finally:
+                    os._exit(127)
+            return pid, fd
+        master, slave = pty.openpty()
+        try:
+            for fd in [master, slave]:
+                SpawnedProcess._setCloseOnExec(fd)
+            slaveName = os.ttyname(slave)
+            # in a new session, opening the slave makes it the controlling terminal, as pty.fork does
+            spawnedProcess = SpawnedProcess(args, ptySlaveName=slaveName)
+        except:
+            os.close(master)
+            raise
+        finally:
+            os.close(slave)
+        return spawnedProcess.pid, master
+
+    @classmethod
+    def _setCloseOnExec(cls, fd):
+        """Auxiliary method."""
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+
+    @classmethod
+    def _check(cls, result):
+        """Auxiliary method, raise OSError if a posix_spawn function has returned an error."""
+        if result:
+            raise OSError(result, os.strerror(result))
+
+    def __init__(self, args, stdin=None, stdout=None, stderr=None,
+                 processGroup=False, defaultSigpipe=False, ptySlaveName=None):
+        """Create new SpawnedProcess, started by posix_spawnp.
+
+        Use method popen rather than calling this constructor directly.
+
+        stdin, stdout, stderr
+            None, subprocess.PIPE, a file descriptor, or a file, as for subprocess.Popen.
+
+        ptySlaveName
+            if given then in a new session stdin, stdout and stderr are the pty slave of that name."""
+        if isinstance(args, basestring):
+            args = [args]
+        args = [arg.encode(sys.getfilesystemencoding() or "utf-8") if isinstance(arg, unicode) else arg
+                for arg in args]
+        self.args = args
+        self.returncode = None
+        self.stdin = None
+        self.stdout = None
+        self.stderr = None
+        # ends for the child to be closed in the parent once started, ends to keep in the parent
+        childEnds = []
+        parentEnds = []
+        fileActions = ctypes.create_string_buffer(_opaqueSize)
+        attributes = ctypes.create_string_buffer(_opaqueSize)
+        sigset = ctypes.create_string_buffer(_opaqueSize)
+        SpawnedProcess._check(_libc.posix_spawn_file_actions_init(fileActions))
+        try:
+            SpawnedProcess._check(_libc.posix_spawnattr_init(attributes))
+            try:
+                flags = 0
+                if ptySlaveName:
+                    flags |= _POSIX_SPAWN_SETSID
+                    SpawnedProcess._check(_libc.posix_spawn_file_actions_addopen(fileActions, 0, ptySlaveName,
+                                                                                 os.O_RDWR, 0))
+                    for targetFd in [1, 2]:
+                        SpawnedProcess._check(_libc.posix_spawn_file_actions_adddup2(fileActions, 0, targetFd))
+                else:
+                    for targetFd, given, mode in [(0, stdin, "wb"), (1, stdout, "rb"), (2, stderr, "rb")]:
+                        if given is None:
+                            continue
+                        if given == subprocess.PIPE:
+                            readFd, writeFd = os.pipe()
+                            for fd in [readFd, writeFd]:
+                                # so subprocesses started meanwhile by other threads don't inherit it
+                                SpawnedProcess._setCloseOnExec(fd)
+                            childFd, parentFd = (readFd, writeFd) if targetFd == 0 else (writeFd, readFd)
+                            childEnds.append(childFd)
+                            parentEnds.append(parentFd)
+                            parentFile = os.fdopen(parentFd, mode)
+                            if targetFd == 0:
+                                self.stdin = parentFile
+                            elif targetFd == 1:
+                                self.stdout = parentFile
+                            else:
+                                self.stderr = parentFile
+                        elif isinstance(given, (int, long)):
+                            childFd = given
+                        else:
+                            childFd = given.fileno()
+                        if childFd == targetFd:
+                            # dup2 onto itself would not clear close-on-exec
+                            continue
+                        SpawnedProcess._check(_libc.posix_spawn_file_actions_adddup2(fileActions, childFd, targetFd))
+                if processGroup:
+                    flags |= _POSIX_SPAWN_SETPGROUP
+                    SpawnedProcess._check(_libc.posix_spawnattr_setpgroup(attributes, 0))
+                if defaultSigpipe:
+                    flags |= _POSIX_SPAWN_SETSIGDEF
+                    _libc.sigemptyset(sigset)
+                    _libc.sigaddset(sigset, signal.SIGPIPE)
+                    SpawnedProcess._check(_libc.posix_spawnattr_setsigdefault(attributes, sigset))
+                SpawnedProcess._check(_libc.posix_spawnattr_setflags(attributes, flags))
+                argv = (ctypes.c_char_p * (len(args) + 1))(*(args + [None]))
+                pid = ctypes.c_int(0)
+                SpawnedProcess._check(_libc.posix_spawnp(ctypes.byref(pid), args[0],
+                                                         fileActions, attributes,
+                                                         argv, _environ.value))
+                self.pid = pid.value
+            finally:
+                _libc.posix_spawnattr_destroy(attributes)
+        except:
+            for parentFile in [self.stdin, self.stdout, self.stderr]:
+                if parentFile:
+                    parentFile.close()
+            raise
+        finally:
+            _libc.posix_spawn_file_actions_destroy(fileActions)
+            for fd in childEnds:
+                os.close(fd)
+
+    def _handle_exitstatus(self, status):
+        """Set returncode from a status as returned by os.waitpid, as subprocess.Popen does."""
+        if os.WIFSIGNALED(status):
+            self.returncode = -os.WTERMSIG(status)
+        elif os.WIFEXITED(status):
+            self.returncode = os.WEXITSTATUS(status)
+        else:
+            raise RuntimeError("unknown child exit status")
+
+    def _waitpid(self, options):
+        """Auxiliary method."""
+        while True:
+            try:
+                pid, status = os.waitpid(self.pid, options)
+                break
+            except OSError as ex:
+                if ex.errno == errno.EINTR:
+                    continue
+                if ex.errno != errno.ECHILD:
+                    raise
+                # already reaped elsewhere, as subprocess.Popen assume 0
+                self.returncode = 0
+                return
+        if pid:
+            self._handle_exitstatus(status)
+
+    def poll(self):
+        """Return returncode if exited, else None, without waiting."""
+        if self.returncode is None:
+            self._waitpid(os.WNOHANG)
+        return self.returncode
+
+    def wait(self):
+        """Wait until exited, return returncode."""
+        if self.returncode is None:
+            self._waitpid(0)
+        return self.returncode
+
+    def send_signal(self, posixSignal):
+        """Send a signal to the subprocess."""
+        if self.returncode is None:
+            os.kill(self.pid, posixSignal)
+
+    def terminate(self):
+        """Send SIGTERM to the subprocess."""
+        self.send_signal(signal.SIGTERM)
+
+    def kill(self):
+        """Send SIGKILL to the subprocess."""
+        self.send_signal(signal.SIGKILL)
+
+if __name__ == "__main__":
+    import time
+    _process = SpawnedProcess.popen(["sh", "-c", "echo out ; echo err >&2 ; exit 3"],
+                                    stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    print "{0} stdout={1!r} stderr={2!r} returncode={3}".format(
+        _process.__class__.__name__, _process.stdout.read(), _process.stderr.read(), _process.wait())
+    _pid, _fd = SpawnedProcess.ptySpawn(["sh", "-c", "tty ; echo on a pty"])
+    _output = ""
+    while True:
+        try:
+            _newOutput = os.read(_fd, 1024)
+        except OSError:
+            break
+        if not _newOutput:
+            break
+        _output += _newOutput
+    os.close(_fd)
+    print "pty output={0!r} status={1}".format(_output, os.waitpid(_pid, 0)[1])
+    try:
+        SpawnedProcess.popen(["commandthatdoesntexist"])
+    except OSError as ex:
+        print "OSError ({0})".format(ex.strerror)
+    #
+    if len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        # spawns per second, fork by subprocess.Popen versus posix_spawnp, at several sizes of this process
+        _spawns = 200
+        _ballast = []
+        for _megabytes in [0, 256, 1024, 2048]:
+            # written into, hence actually resident
+            while len(_ballast) < _megabytes:
+                _ballast.append(bytearray(b"x" * (1024 * 1024)))
+            _results = []
+            for _name, _enabled in [("fork", False), ("posix_spawnp", True)]:
+                SpawnedProcess.enabled = _enabled
+                _begin = time.time()
+                for _ in xrange(_spawns):
+                    SpawnedProcess.popen(["true"]).wait()
+                _results.append("{0} {1:>7.0f} spawns/s".format(_name, _spawns / (time.time() - _begin)))
+            print "{0:>5} MB  {1}".format(_megabytes, "  ".join(_results))
+        SpawnedProcess.enabled = True
@@ -15,7 +15,6 @@ Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
 import sys
-from threading import Thread
 
 from nrvr.process.commandcapture import CommandCapture
 
@@ -32,35 +31,46 @@ class Ping(object):
     @classmethod
     def respondingIpAddressesOf(cls, ipaddresses, numberOfTries=3, maxConcurrency=50, ticker=True):
         """Return a new list constructed from those IP addresses that have responded."""
-        threads = [None] * len(ipaddresses)
         results = ['?'] * len(ipaddresses)
         
-        def ping(ipaddress, i):
-            ping = CommandCapture(["ping", "-c", str(numberOfTries), str(ipaddress)],
-                                  copyToStdio=False, exceptionIfNotZero=False)
-            if not ping.returncode: # returncode 0 means success
-                results[i] = ipaddress
-            else:
-                results[i] = "-"
-        
         # ceiling division as shown at http://stackoverflow.com/questions/14822184/is-there-a-ceiling-equivalent-of-operator-in-python
         blocks = -(-len(ipaddresses) // maxConcurrency)
         if ticker:
             sys.stdout.write("[ping")
             sys.stdout.flush()
         for block in range(blocks):
-            for i in range(block * maxConcurrency, min((block + 1) * maxConcurrency, len(ipaddresses))):
-                ipaddress = ipaddresses[i]
-                thread = Thread(target=ping, args=[ipaddress, i])
-                threads[i] = thread
-                thread.start()
-            for i in range(block * maxConcurrency, min((block + 1) * maxConcurrency, len(ipaddresses))):
-                thread = threads[i]
-                thread.join()
-                threads[i] = None
-                if ticker:
-                    sys.stdout.write(".")
-                    sys.stdout.flush()
+            blockRange = range(block * maxConcurrency, min((block + 1) * maxConcurrency, len(ipaddresses)))
+            # start all in block, then wait for each
+            pings = {}
+            try:
+                for i in blockRange:
+                    try:
+                        pings[i] = CommandCapture.start(["ping", "-c", str(numberOfTries), str(ipaddresses[i])],
+                                                        copyToStdio=False,
+                                                        exceptionIfNotZero=False, exceptionIfAnyStderr=False)
+                    except Exception:
+                        # e.g. too many open files, counts as not responding
+                        pings[i] = None
+                for i in blockRange:
+                    ping = pings.pop(i)
+                    try:
+                        # returncode 0 means success
+                        responded = ping is not None and ping.wait() == 0
+                    except Exception:
+                        # one bad IP address should not abort all
+                        responded = False
+                    if responded:
+                        results[i] = ipaddresses[i]
+                    else:
+                        results[i] = "-"
+                    if ticker:
+                        sys.stdout.write(".")
+                        sys.stdout.flush()
+            finally:
+                # if interrupted, don't leave any running
+                for ping in pings.itervalues():
+                    if ping is not None:
+                        ping.kill()
         if ticker:
             sys.stdout.write("]\n")
         return filter(lambda result: result != '-', results)
@@ -5,6 +5,7 @@
 Classes provided by this module include
 * SshCommandException
 * SshParameters
+* SshConnectionPool
 * SshCommand
 
 The main class provided by this module is SshCommand.
@@ -26,22 +27,22 @@ Public repository - https://github.com/srguiwiz/nrvr-commander
 Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
+import atexit
 import os.path
 import re
+import select
 import signal
 import sys
+import tempfile
+import threading
 import time
 
-from nrvr.process.commandcapture import CommandCapture
+from nrvr.process.commandcapture import CommandCapture, CommandCaptureHooks, CommandCaptureStatistics, CommandCaptureUsage
+from nrvr.process.outputbuffer import OutputBuffer
+from nrvr.process.spawn import SpawnedProcess
 from nrvr.util.classproperty import classproperty
 from nrvr.util.ipaddress import IPAddress
-
-_gotPty = False
-try:
-    import pty
-    _gotPty = True
-except ImportError:
-    pass
+from nrvr.util.times import Timestamp
 
 class SshCommandException(Exception):
     def __init__(self, message):
@@ -77,6 +78,343 @@ class SshParameters(object):
         self.user = user
         self.pwd = pwd
 
+class SshConnectionPool(object):
+    """Master connections kept open for reuse by SshCommand and ScpCommand.
+    
+    If enabled, for each SshParameters ipaddress and user one ssh master connection
+    is kept open, with ssh options ControlMaster and ControlPath,
+    and each SshCommand or ScpCommand costs opening a channel over it,
+    rather than a TCP connect, a key exchange, and authenticating again.
+    
+    Transparent once enabled, if a master connection cannot be opened then
+    SshCommand and ScpCommand connect on their own as if not enabled,
+    and if an SshCommand over a master connection fails with returncode 255,
+    e.g. because it has gone away, then the master connection is closed
+    and the SshCommand connects on its own once more.
+    
+    Master connections not in use by any SshCommand or ScpCommand
+    for longer than idleSeconds are closed,
+    all remaining are closed at exit of the script.
+    
+    Example use::
+    
+        SshConnectionPool.enable()
+        ...
+        SshConnectionPool.close(exampleSshParameters)
+    
+    As implemented requires OpenSSH."""
+
+    _lock = threading.RLock()
+    # by (ipaddress, user) a dictionary with keys pid, fd, controlPath, lastUsed, users,
+    # and while opening ready, a threading.Event set once opened or failed to open,
+    # usable, whether opened, and closed, whether closed while opening
+    _masters = {}
+    _enabled = False
+    _idleSeconds = 300.0
+    _socketDirectory = None
+    _sweeper = None
+    _atexitRegistered = False
+    # how long to wait for a master connection to be ready
+    masterTimeoutSeconds = 30.0
+
+    @classmethod
+    def enable(cls, idleSeconds=300.0):
+        """Enable reusing master connections.
+        
+        idleSeconds
+            how long a master connection may remain unused before it is closed."""
+        with SshConnectionPool._lock:
+            SshConnectionPool._idleSeconds = float(idleSeconds)
+            SshConnectionPool._enabled = True
+            if not SshConnectionPool._atexitRegistered:
+                atexit.register(SshConnectionPool.closeAll)
+                SshConnectionPool._atexitRegistered = True
+
+    @classmethod
+    def disable(cls):
+        """Disable reusing master connections, and close all."""
+        with SshConnectionPool._lock:
+            SshConnectionPool._enabled = False
+            cls.closeAll()
+
+    @classproperty
+    def enabled(cls):
+        """Whether enabled."""
+        return SshConnectionPool._enabled
+
+    @classmethod
+    def _key(cls, sshParameters):
+        """Auxiliary method."""
+        return (sshParameters.ipaddress, sshParameters.user)
+
+    @classmethod
+    def _alive(cls, master):
+        """Auxiliary method, called with lock held, for a master connection that has been opened."""
+        try:
+            pid, waitEncodedStatusIndication = os.waitpid(master["pid"], os.WNOHANG)
+        except OSError:
+            # e.g. already reaped
+            return False
+        if pid:
+            master["pid"] = None
+            return False
+        return os.path.exists(master["controlPath"])
+
+    @classmethod
+    def _end(cls, master):
+        """Auxiliary method, called without lock held, because it can take seconds,
+        for a master already removed from the pool, or by the thread opening it."""
+        if master["pid"]:
+            try:
+                os.kill(master["pid"], signal.SIGTERM)
+                startTime = time.time()
+                while not os.waitpid(master["pid"], os.WNOHANG)[0]:
+                    if time.time() - startTime > 3.0:
+                        # don't want to block forever
+                        os.kill(master["pid"], signal.SIGKILL)
+                        os.waitpid(master["pid"], 0)
+                        break
+                    time.sleep(0.02)
+            except OSError:
+                # e.g. already gone
+                pass
+            master["pid"] = None
+        if master["fd"] is not None:
+            try:
+                os.close(master["fd"])
+            except OSError:
+                pass
+            master["fd"] = None
+        try:
+            os.remove(master["controlPath"])
+        except OSError:
+            # e.g. removed by ssh already
+            pass
+
+    @classmethod
+    def _reserve(cls):
+        """Auxiliary method, called with lock held, return a master not opened yet."""
+        if SshConnectionPool._socketDirectory is None:
+            # short because length of paths of sockets is limited
+            SshConnectionPool._socketDirectory = tempfile.mkdtemp(prefix="nrvrssh")
+            os.chmod(SshConnectionPool._socketDirectory, 0700)
+        controlPath = os.path.join(SshConnectionPool._socketDirectory,
+                                   str(len(SshConnectionPool._masters)) + "-" + Timestamp.microsecondTimestamp())
+        return {"pid": None, "fd": None, "controlPath": controlPath, "lastUsed": time.time(), "users": 0,
+                "ready": threading.Event(), "usable": False, "closed": False}
+
+    @classmethod
+    def _start(cls, master, sshParameters, connectTimeoutSeconds):
+        """Auxiliary method, called without lock held, because it can take up to masterTimeoutSeconds,
+        return whether opened."""
+        controlPath = master["controlPath"]
+        sshOptions = ["-l", sshParameters.user,
+                      "-o", "ControlMaster=yes",
+                      "-o", "ControlPath=" + controlPath,
+                      # notice soon if e.g. machine has been rebooted
+                      "-o", "ServerAliveInterval=10",
+                      "-N"]
+        if connectTimeoutSeconds:
+            sshOptions.extend(["-o", "ConnectTimeout=" + str(connectTimeoutSeconds)])
+        sshOptions.append(sshParameters.ipaddress)
+        try:
+            pid, fd = SpawnedProcess.ptySpawn(["ssh"] + sshOptions)
+        except OSError:
+            return False
+        master["pid"], master["fd"] = pid, fd
+        # look for password prompt if given a password, and until ready
+        outputTillReady = OutputBuffer()
+        passwordEntered = not sshParameters.pwd
+        startTime = time.time()
+        while not os.path.exists(controlPath):
+            if time.time() - startTime > cls.masterTimeoutSeconds:
+                cls._end(master)
+                return False
+            readable, ignoreWritable, ignoreExceptional = select.select([fd], [], [], 0.05)
+            if not readable:
+                continue
+            try:
+                newOutput = os.read(fd, 1024)
+            except EnvironmentError:
+                newOutput = ""
+            if not len(newOutput):
+                # end has been reached, e.g. connection refused or permission denied
+                cls._end(master)
+                return False
+            newOutput = SshCommand._crLfRegex.sub("\n", newOutput)
+            outputTillReady.append(newOutput)
+            recentOutput = outputTillReady.tail(len(newOutput) + SshCommand._promptSearchOverlap)
+            if SshCommand._acceptPromptRegex.search(recentOutput):
+                # let SshCommand connect on its own and report it
+                cls._end(master)
+                return False
+            if SshCommand._pwdPromptRegex.search(recentOutput):
+                if passwordEntered:
+                    # e.g. "Permission denied, please try again."
+                    cls._end(master)
+                    return False
+                os.write(fd, sshParameters.pwd + "\n")
+                passwordEntered = True
+                # look for another prompt only in output after this one
+                outputTillReady = OutputBuffer()
+        return True
+
+    @classmethod
+    def controlOptions(cls, sshParameters, connectTimeoutSeconds=None):
+        """Return a list of ssh options to use a master connection, or an empty list.
+        
+        Opens a master connection if none open yet.
+        
+        Returns an empty list if not enabled or if cannot open a master connection.
+        
+        Each call returning options must be matched by a call of release once done,
+        so that a master connection in use is not closed for being idle.
+        
+        Used by SshCommand and ScpCommand, which skip looking for a password prompt
+        if given options."""
+        if not SshConnectionPool._enabled:
+            return []
+        key = cls._key(sshParameters)
+        # lock held only briefly, so a machine slow to connect to or to disconnect from doesn't hold up others
+        with SshConnectionPool._lock:
+            toEnd = cls._evictIdle()
+            master = SshConnectionPool._masters.get(key)
+            if master and master["usable"] and not cls._alive(master):
+                toEnd.append(SshConnectionPool._masters.pop(key))
+                master = None
+            opening = not master
+            if opening:
+                master = cls._reserve()
+                SshConnectionPool._masters[key] = master
+            # in use from now on, hence not evicted while opening
+            master["users"] += 1
+        cls._endAll(toEnd)
+        if opening:
+            opened = False
+            try:
+                opened = cls._start(master, sshParameters, connectTimeoutSeconds)
+            finally:
+                with SshConnectionPool._lock:
+                    if not opened or master["closed"]:
+                        # failed, or closed while opening
+                        opened = False
+                        if SshConnectionPool._masters.get(key) is master:
+                            del SshConnectionPool._masters[key]
+                    else:
+                        master["usable"] = True
+                        cls._startSweeper()
+                    master["ready"].set()
+                if not opened:
+                    cls._end(master)
+        else:
+            # another thread may be opening it
+            master["ready"].wait(cls.masterTimeoutSeconds + 5.0)
+        with SshConnectionPool._lock:
+            if not master["usable"] or master["closed"]:
+                master["users"] -= 1
+                return []
+            master["lastUsed"] = time.time()
+            return ["-o", "ControlMaster=no",
+                    "-o", "ControlPath=" + master["controlPath"],
+                    # if master connection has gone away then fail rather than hang at a password prompt
+                    "-o", "NumberOfPasswordPrompts=0"]
+
+    @classmethod
+    def release(cls, controlOptions):
+        """Done using options returned by controlOptions.
+        
+        Idle time of the master connection counts from when it isn't in use anymore.
+        
+        controlOptions
+            as returned by controlOptions, if an empty list then nothing to do."""
+        if not controlOptions:
+            return
+        with SshConnectionPool._lock:
+            for master in SshConnectionPool._masters.itervalues():
+                if "ControlPath=" + master["controlPath"] in controlOptions:
+                    master["users"] -= 1
+                    master["lastUsed"] = time.time()
+                    break
+
+    @classmethod
+    def close(cls, sshParameters):
+        """Close master connection for sshParameters, if any."""
+        toEnd = []
+        with SshConnectionPool._lock:
+            master = SshConnectionPool._masters.pop(cls._key(sshParameters), None)
+            if master:
+                toEnd = cls._close(master)
+        cls._endAll(toEnd)
+
+    @classmethod
+    def closeAll(cls, ipaddress=None):
+        """Close all master connections, or all to ipaddress if given."""
+        if ipaddress is not None:
+            ipaddress = IPAddress.asString(ipaddress)
+        toEnd = []
+        with SshConnectionPool._lock:
+            for key in SshConnectionPool._masters.keys():
+                if ipaddress is None or key[0] == ipaddress:
+                    toEnd.extend(cls._close(SshConnectionPool._masters.pop(key)))
+        cls._endAll(toEnd)
+        with SshConnectionPool._lock:
+            if not SshConnectionPool._masters and SshConnectionPool._socketDirectory:
+                try:
+                    os.rmdir(SshConnectionPool._socketDirectory)
+                except OSError:
+                    pass
+                SshConnectionPool._socketDirectory = None
+
+    @classmethod
+    def _close(cls, master):
+        """Auxiliary method, called with lock held, for a master already removed from the pool,
+        return a list of masters to _end once lock released."""
+        master["closed"] = True
+        if master["ready"].is_set():
+            return [master]
+        # else ended by the thread opening it once done
+        return []
+
+    @classmethod
+    def _endAll(cls, masters):
+        """Auxiliary method, called without lock held."""
+        for master in masters:
+            cls._end(master)
+
+    @classmethod
+    def _evictIdle(cls):
+        """Auxiliary method, called with lock held, removes idle masters from the pool,
+        return a list of them to _end once lock released."""
+        now = time.time()
+        evicted = []
+        for key, master in SshConnectionPool._masters.items():
+            if not master["users"] and now - master["lastUsed"] > SshConnectionPool._idleSeconds:
+                evicted.append(SshConnectionPool._masters.pop(key))
+        return evicted
+
+    @classmethod
+    def _startSweeper(cls):
+        """Auxiliary method, called with lock held."""
+        if SshConnectionPool._sweeper and SshConnectionPool._sweeper.is_alive():
+            return
+        SshConnectionPool._sweeper = threading.Thread(target=cls._sweep, name="SshConnectionPool")
+        SshConnectionPool._sweeper.daemon = True
+        SshConnectionPool._sweeper.start()
+
+    @classmethod
+    def _sweep(cls):
+        """Auxiliary method, evicting idle master connections while there are any."""
+        while True:
+            time.sleep(min(max(SshConnectionPool._idleSeconds / 4.0, 0.1), 30.0))
+            with SshConnectionPool._lock:
+                toEnd = cls._evictIdle()
+                done = not SshConnectionPool._masters
+                if done:
+                    SshConnectionPool._sweeper = None
+            cls._endAll(toEnd)
+            if done:
+                return
+
 class SshCommand(object):
     """Send a command over ssh."""
 
@@ -85,6 +423,8 @@ class SshCommand(object):
     _acceptPromptRegex = re.compile(r"(?i)\(yes/no\)\?")
     _acceptAnswer="yes\no"
     _permissionDeniedRegex = re.compile(r"(?i)Permission\s+denied")
+    # how far back before new output to look for prompts, longer than any prompt looked for
+    _promptSearchOverlap = 64
 
     @classmethod
     def commandsUsedInImplementation(cls):
@@ -98,7 +438,9 @@ class SshCommand(object):
                  connectTimeoutSeconds=None,
                  maxConnectionRetries=10,
                  tickerForRetry=True,
-                 checkForPermissionDenied=False):
+                 checkForPermissionDenied=False,
+                 outputSpillThreshold=None,
+                 outputMaxRetained=None):
         """Create new SshCommand instance.
         
         Will wait until completed.
@@ -123,8 +465,16 @@ class SshCommand(object):
             That may only work as expected for some commands on some platforms.
             It should work for a command without arguments.
             
-            Hence if you don't want a string split, pass it in wrapped as sole item of a list."""
-        if not _gotPty:
+            Hence if you don't want a string split, pass it in wrapped as sole item of a list.
+        
+        outputSpillThreshold
+            if given then number of bytes of output past which to spill it into a temporary file,
+            see OutputBuffer.
+        
+        outputMaxRetained
+            if given then only retain the last outputMaxRetained bytes of output,
+            see OutputBuffer."""
+        if not SpawnedProcess.ptySupported:
             # cannot use ssh if no pty
             raise Exception("must have module pty available to use ssh command"
                             ", which is known to be available in Python 2.6 on Linux, but not on Windows")
@@ -143,24 +493,29 @@ class SshCommand(object):
         self._output = ""
         self._returncode = None
         #
-        ticked = False
-        while self._connectionRetriesRemaining:
-            self._connectionRetriesRemaining -= 1
-            # fork and connect child to a pseudo-terminal
-            self._pid, self._fd = pty.fork()
-            if self._pid == 0:
-                # in child process
-                sshOptions = ["-l", self._user]
+        controlOptions = []
+        usePool = True
+        startEvent = CommandCaptureHooks.started("ssh", self._argv, self._ipaddress)
+        try:
+            ticked = False
+            while self._connectionRetriesRemaining:
+                self._connectionRetriesRemaining -= 1
+                # if enabled reuse a master connection
+                controlOptions = SshConnectionPool.controlOptions(sshParameters, connectTimeoutSeconds) if usePool else []
+                sshOptions = ["-l", self._user] + controlOptions
                 if connectTimeoutSeconds:
                     sshOptions.extend(["-o", "ConnectTimeout=" + str(connectTimeoutSeconds)])
                 sshOptions.append(self._ipaddress)
-                os.execvp("ssh", ["ssh"] + sshOptions + self._argv)
-            else:
-                # in parent process
-                if self._pwd:
+                # fork, or spawn where faster, and connect child to a pseudo-terminal
+                startTime = time.time()
+                self._pid, self._fd = SpawnedProcess.ptySpawn(["ssh"] + sshOptions + self._argv)
+                if controlOptions:
+                    # already connected, no password prompt, no more retries
+                    self._connectionRetriesRemaining = 0
+                elif self._pwd:
                     # if given a password then apply
                     promptedForPassword = False
-                    outputTillPrompt = ""
+                    outputTillPrompt = OutputBuffer()
                     # look for password prompt
                     while not promptedForPassword:
                         try:
@@ -170,7 +525,7 @@ class SshCommand(object):
                                 if not self._connectionRetriesRemaining:
                                     # was raise Exception("unexpected end of output from ssh")
                                     raise Exception("failing to connect via ssh\n" + 
-                                                    outputTillPrompt)
+                                                    outputTillPrompt.getvalue())
                                 if tickerForRetry:
                                     if not ticked:
                                         # first time only printing
@@ -181,19 +536,21 @@ class SshCommand(object):
                                 break # break out of while not promptedForPassword:
                             # ssh has been observed returning "\r\n" for newline, but we want "\n"
                             newOutput = SshCommand._crLfRegex.sub("\n", newOutput)
-                            outputTillPrompt += newOutput
-                            if SshCommand._acceptPromptRegex.search(outputTillPrompt):
+                            outputTillPrompt.append(newOutput)
+                            # look for prompts near the end only, rather than in all output again and again
+                            recentOutput = outputTillPrompt.tail(len(newOutput) + SshCommand._promptSearchOverlap)
+                            if SshCommand._acceptPromptRegex.search(recentOutput):
                                 # e.g. "Are you sure you want to continue connecting (yes/no)? "
                                 raise Exception("cannot proceed unless having accepted host key\n" +
-                                                outputTillPrompt +
+                                                outputTillPrompt.getvalue() +
                                                 '\nE.g. invoke SshCommand.acceptKnownHostKey(SshParameters("{0}",user,pwd)).'.format(self._ipaddress))
-                            if SshCommand._pwdPromptRegex.search(outputTillPrompt):
+                            if SshCommand._pwdPromptRegex.search(recentOutput):
                                 # e.g. "10.123.45.67's password: "
                                 promptedForPassword = True
                         except EnvironmentError:
                             # e.g. "@    WARNING: REMOTE HOST IDENTIFICATION HAS CHANGED!     @" and closing
                             raise Exception("failing to connect via ssh\n" + 
-                                            outputTillPrompt)
+                                            outputTillPrompt.getvalue())
                     if not promptedForPassword: # i.e. if got here from breaking out of while not promptedForPassword:
                         continue # continue at while self._connectionRetriesRemaining:
                     else: # promptedForPassword is normal
@@ -203,13 +560,14 @@ class SshCommand(object):
                     os.write(self._fd, self._pwd + "\n")
                 # look for output
                 endOfOutput = False
-                outputSincePrompt = ""
+                outputSincePrompt = OutputBuffer(spillThreshold=outputSpillThreshold,
+                                                 maxRetained=outputMaxRetained)
                 try:
                     while not endOfOutput:
                         try:
                             newOutput = os.read(self._fd, 1024)
                             if len(newOutput):
-                                outputSincePrompt += newOutput
+                                outputSincePrompt.append(newOutput)
                             else:
                                 # end has been reached
                                 endOfOutput = True
@@ -217,7 +575,8 @@ class SshCommand(object):
                                 # seen stderr "Permission denied, please try again."
                                 # and a repeat of stdout "10.123.45.67's password: "
                                 if len(outputSincePrompt) <= 128: # limit to early in output
-                                    if SshCommand._permissionDeniedRegex.search(outputSincePrompt) and SshCommand._pwdPromptRegex.search(outputSincePrompt):
+                                    earlyOutput = outputSincePrompt.getvalue()
+                                    if SshCommand._permissionDeniedRegex.search(earlyOutput) and SshCommand._pwdPromptRegex.search(earlyOutput):
                                         os.kill(self._pid, signal.SIGKILL)
                         except EnvironmentError as e:
                             # some ideas maybe at http://bugs.python.org/issue5380
@@ -230,12 +589,13 @@ class SshCommand(object):
                 finally:
                     # remove any leading space (maybe there after "password:" prompt) and
                     # remove first newline (is there after entering password and "\n")
-                    self._output = re.sub(SshCommand._removeLeadingSpaceAndFirstNewlineRegex, r"\1", outputSincePrompt)
+                    self._output = re.sub(SshCommand._removeLeadingSpaceAndFirstNewlineRegex, r"\1", outputSincePrompt.getvalue())
+                    outputSincePrompt.close()
                     #
                     # get returncode
                     signalled = False
                     try:
-                        ignorePidAgain, waitEncodedStatusIndication = os.waitpid(self._pid, 0)
+                        ignorePidAgain, waitEncodedStatusIndication, rusage = os.wait4(self._pid, 0)
                         if os.WIFEXITED(waitEncodedStatusIndication):
                             # normal exit(status) call
                             self._returncode = os.WEXITSTATUS(waitEncodedStatusIndication)
@@ -244,12 +604,25 @@ class SshCommand(object):
                             # less common case
                             signalled = True
                             self._returncode = -1
+                        CommandCaptureStatistics.record(CommandCaptureUsage.fromRusage(
+                            "ssh", time.time() - startTime, rusage,
+                            len(outputSincePrompt), 0, True, self._returncode))
+                        # returncode 255 from ssh itself, e.g. because master connection has gone away
+                        # after machine has been reverted to a snapshot, then once more connecting on its own,
+                        # even though it could be from the command, which then is run again
+                        retryWithoutPool = bool(controlOptions) and self._returncode == 255
+                        if retryWithoutPool:
+                            SshConnectionPool.release(controlOptions)
+                            SshConnectionPool.close(sshParameters)
+                            controlOptions = []
+                            usePool = False
+                            self._connectionRetriesRemaining = 1
                         # raise an exception if asked to and there is a reason
                         exceptionMessage = ""
                         if signalled:
                             # less common case
                             exceptionMessage += "ssh did not exit normally"
-                        elif self._exceptionIfNotZero and self._returncode:
+                        elif self._exceptionIfNotZero and self._returncode and not retryWithoutPool:
                             exceptionMessage += "returncode: " + str(self._returncode)
                         if exceptionMessage:
                             commandDescription = "ipaddress: " + self._ipaddress
@@ -266,10 +639,13 @@ class SshCommand(object):
                         # supposedly can occur
                         self._returncode = -1
                         raise SshCommandException("ssh did not exit normally")
-        if ticked:
-            # final printing
-            sys.stdout.write("]\n")
-            sys.stdout.flush()
+            if ticked:
+                # final printing
+                sys.stdout.write("]\n")
+                sys.stdout.flush()
+        finally:
+            SshConnectionPool.release(controlOptions)
+            CommandCaptureHooks.ended(startEvent, self._returncode)
 
     @property
     def output(self):
@@ -299,6 +675,8 @@ class SshCommand(object):
         """Remove line from ~/.ssh/known_hosts file."""
         knownHostsFile = SshCommand._knownHostFilePath
         ipaddress = IPAddress.asString(ipaddress)
+        # a different host key means a different host, e.g. a new machine with same IP address
+        SshConnectionPool.closeAll(ipaddress)
         if not os.path.exists(knownHostsFile):
             # maybe file hasn't been created yet, nothing to do
             return
@@ -335,7 +713,7 @@ class SshCommand(object):
         
         ipaddress
             IP address or domain name."""
-        if not _gotPty:
+        if not SpawnedProcess.ptySupported:
             # cannot use ssh if no pty
             raise Exception("must have module pty available to use ssh command"
                             ", which is known to be available in Python 2.6 on Linux, but not on Windows")
@@ -352,93 +730,90 @@ class SshCommand(object):
         # remove any pre-existing key, if any
         SshCommand.removeKnownHostKey(ipaddress)
         #
-        # fork and connect child to a pseudo-terminal
-        pid, fd = pty.fork()
-        if pid == 0:
-            # in child process;
-            # user if given, real or dummy, doesn't give away information about this script's user;
-            sshOptions = ["-l", user]
-            if connectTimeoutSeconds:
-                sshOptions.extend(["-o", "ConnectTimeout=" + str(connectTimeoutSeconds)])
-            sshOptions.append(ipaddress)
-            # commands "sleep 1 ; exit" if it executes should be harmless
-            os.execvp("ssh", ["ssh"] + sshOptions + ['"sleep 1 ; exit"'])
-        else:
-            # in parent process
-            promptedForAccept = False # common case
-            promptedForPassword = False # less common case
-            outputTillPrompt = ""
-            # look for accept prompt
-            while not promptedForAccept and not promptedForPassword:
-                try:
-                    newOutput = os.read(fd, 1024)
-                    if not len(newOutput):
-                        # end has been reached
-                        # was raise Exception("unexpected end of output from ssh")
-                        raise Exception("failing to connect via ssh\n" + 
-                                        outputTillPrompt)
-                    # ssh has been observed returning "\r\n" for newline, but we want "\n"
-                    newOutput = SshCommand._crLfRegex.sub("\n", newOutput)
-                    outputTillPrompt += newOutput
-                    if SshCommand._acceptPromptRegex.search(outputTillPrompt):
-                        # e.g. "Are you sure you want to continue connecting (yes/no)? "
-                        # common case
-                        promptedForAccept = True
-                    if SshCommand._pwdPromptRegex.search(outputTillPrompt):
-                        # e.g. "10.123.45.67's password: "
-                        # which has been observed when apparently an alternative way of storing and accepting host keys was in effect,
-                        # if it gets here it works and hence let it pass,
-                        # less common case
-                        promptedForPassword = True
-                except EnvironmentError:
-                    # e.g. "@    WARNING: REMOTE HOST IDENTIFICATION HAS CHANGED!     @" and closing
+        # user if given, real or dummy, doesn't give away information about this script's user;
+        sshOptions = ["-l", user]
+        if connectTimeoutSeconds:
+            sshOptions.extend(["-o", "ConnectTimeout=" + str(connectTimeoutSeconds)])
+        sshOptions.append(ipaddress)
+        # fork, or spawn where faster, and connect child to a pseudo-terminal;
+        # commands "sleep 1 ; exit" if it executes should be harmless
+        pid, fd = SpawnedProcess.ptySpawn(["ssh"] + sshOptions + ['"sleep 1 ; exit"'])
+        promptedForAccept = False # common case
+        promptedForPassword = False # less common case
+        outputTillPrompt = OutputBuffer()
+        # look for accept prompt
+        while not promptedForAccept and not promptedForPassword:
+            try:
+                newOutput = os.read(fd, 1024)
+                if not len(newOutput):
+                    # end has been reached
+                    # was raise Exception("unexpected end of output from ssh")
                     raise Exception("failing to connect via ssh\n" + 
-                                    outputTillPrompt)
-            if promptedForAccept:
-                # do a special dance here to avoid being quicker to next invocation than
-                # this invocation takes to get around to writing known_hosts file,
-                # which would cause only one of the ssh invocations to write known_hosts file,
-                # which has been observed as a problem in bulk processing
+                                    outputTillPrompt.getvalue())
+                # ssh has been observed returning "\r\n" for newline, but we want "\n"
+                newOutput = SshCommand._crLfRegex.sub("\n", newOutput)
+                outputTillPrompt.append(newOutput)
+                # look for prompts near the end only, rather than in all output again and again
+                recentOutput = outputTillPrompt.tail(len(newOutput) + SshCommand._promptSearchOverlap)
+                if SshCommand._acceptPromptRegex.search(recentOutput):
+                    # e.g. "Are you sure you want to continue connecting (yes/no)? "
+                    # common case
+                    promptedForAccept = True
+                if SshCommand._pwdPromptRegex.search(recentOutput):
+                    # e.g. "10.123.45.67's password: "
+                    # which has been observed when apparently an alternative way of storing and accepting host keys was in effect,
+                    # if it gets here it works and hence let it pass,
+                    # less common case
+                    promptedForPassword = True
+            except EnvironmentError:
+                # e.g. "@    WARNING: REMOTE HOST IDENTIFICATION HAS CHANGED!     @" and closing
+                raise Exception("failing to connect via ssh\n" + 
+                                outputTillPrompt.getvalue())
+        if promptedForAccept:
+            # do a special dance here to avoid being quicker to next invocation than
+            # this invocation takes to get around to writing known_hosts file,
+            # which would cause only one of the ssh invocations to write known_hosts file,
+            # which has been observed as a problem in bulk processing
+            startTime = time.time()
+            knownHostsFile = SshCommand._knownHostFilePath
+            if os.path.exists(knownHostsFile):
+                # normal case
+                originalModificationTime = os.path.getctime(knownHostsFile)
+            else:
+                # maybe file hasn't been created yet
+                originalModificationTime = startTime
+            if originalModificationTime > startTime:
+                # fix impossible future time
+                os.utime(knownHostsFile, (startTime, startTime))
+            while originalModificationTime == startTime:
+                # wait to make sure modification will be after originalModificationTime
+                time.sleep(0.1)
                 startTime = time.time()
-                knownHostsFile = SshCommand._knownHostFilePath
+            # actually accept, one line in the middle of the special dance
+            os.write(fd, SshCommand._acceptAnswer)
+            # continue special dance
+            looksDone = False
+            while not looksDone:
                 if os.path.exists(knownHostsFile):
                     # normal case
-                    originalModificationTime = os.path.getctime(knownHostsFile)
+                    currentModificationTime = os.path.getctime(knownHostsFile)
                 else:
                     # maybe file hasn't been created yet
-                    originalModificationTime = startTime
-                if originalModificationTime > startTime:
-                    # fix impossible future time
-                    os.utime(knownHostsFile, (startTime, startTime))
-                while originalModificationTime == startTime:
-                    # wait to make sure modification will be after originalModificationTime
-                    time.sleep(0.1)
-                    startTime = time.time()
-                # actually accept, one line in the middle of the special dance
-                os.write(fd, SshCommand._acceptAnswer)
-                # continue special dance
-                looksDone = False
-                while not looksDone:
-                    if os.path.exists(knownHostsFile):
-                        # normal case
-                        currentModificationTime = os.path.getctime(knownHostsFile)
-                    else:
-                        # maybe file hasn't been created yet
-                        currentModificationTime = originalModificationTime
-                    if currentModificationTime != originalModificationTime:
-                        # has been modified
-                        looksDone = True
-                        break
-                    currentTime = time.time()
-                    if currentTime - startTime > 3.0:
-                        # don't want to block forever, done or not
-                        looksDone = True
-                        break
-                    # sleep
-                    time.sleep(0.1)
-            # NOT os.close(fd) because has been observed to prevent ssh writing known_hosts file,
-            # instead enter a password, real or dummy, to accelerate closing of ssh port
-            os.write(fd, pwd + "\n")
+                    currentModificationTime = originalModificationTime
+                if currentModificationTime != originalModificationTime:
+                    # has been modified
+                    looksDone = True
+                    break
+                currentTime = time.time()
+                if currentTime - startTime > 3.0:
+                    # don't want to block forever, done or not
+                    looksDone = True
+                    break
+                # sleep
+                time.sleep(0.1)
+        # NOT os.close(fd) because has been observed to prevent ssh writing known_hosts file,
+        # instead enter a password, real or dummy, to accelerate closing of ssh port
+        os.write(fd, pwd + "\n")
 
     @classmethod
     def isAvailable(cls, sshParameters,
@@ -577,7 +952,9 @@ class ScpCommand(object):
                  fromPath, toPath,
                  fromSshParameters=None, toSshParameters=None,
                  recurseDirectories=False,
-                 preserveTimes=True):
+                 preserveTimes=True,
+                 outputSpillThreshold=None,
+                 outputMaxRetained=None):
         """Create new ScpCommand instance.
         
         Will wait until completed.
@@ -607,8 +984,14 @@ class ScpCommand(object):
             an SshParameters instance.
         
         recurseDirectories
-            a hint for when fromSshParameters."""
-        if not _gotPty:
+            a hint for when fromSshParameters.
+        
+        outputSpillThreshold
+            see documentation of class SshCommand.
+        
+        outputMaxRetained
+            see documentation of class SshCommand."""
+        if not SpawnedProcess.ptySupported:
             # cannot use scp if no pty
             raise Exception("must have module pty available to use scp command"
                             ", which is known to be available in Python 2.6 on Linux, but not on Windows")
@@ -633,6 +1016,7 @@ class ScpCommand(object):
             self._toSpecification = toPath
             self._ipaddress = fromSshParameters.ipaddress
             self._pwd = fromSshParameters.pwd
+            sshParameters = fromSshParameters
         else: # put files to remote
             anyFromDirectory = False
             for path in fromPaths:
@@ -646,7 +1030,10 @@ class ScpCommand(object):
                 toSshParameters.user + "@" + IPAddress.asString(toSshParameters.ipaddress) + ":" + toPath
             self._ipaddress = toSshParameters.ipaddress
             self._pwd = toSshParameters.pwd
-        self._args = ["scp"]
+            sshParameters = toSshParameters
+        # if enabled reuse a master connection
+        controlOptions = SshConnectionPool.controlOptions(sshParameters)
+        self._args = ["scp"] + controlOptions
         if preserveTimes:
             self._args.append("-p")
         if recurseDirectories:
@@ -657,17 +1044,15 @@ class ScpCommand(object):
         self._output = ""
         self._returncode = None
         #
-        # fork and connect child to a pseudo-terminal
-        self._pid, self._fd = pty.fork()
-        if self._pid == 0:
-            # in child process
-            os.execvp("scp", self._args)
-        else:
-            # in parent process
-            if self._pwd:
+        startEvent = CommandCaptureHooks.started("scp", self._args, self._ipaddress)
+        try:
+            # fork, or spawn where faster, and connect child to a pseudo-terminal
+            startTime = time.time()
+            self._pid, self._fd = SpawnedProcess.ptySpawn(self._args)
+            if self._pwd and not controlOptions:
                 # if given a password then apply
                 promptedForPassword = False
-                outputTillPrompt = ""
+                outputTillPrompt = OutputBuffer()
                 # look for password prompt
                 while not promptedForPassword:
                     try:
@@ -676,32 +1061,35 @@ class ScpCommand(object):
                             # end has been reached
                             # was raise Exception("unexpected end of output from scp")
                             raise Exception("failing to connect for scp\n" + 
-                                            outputTillPrompt)
+                                            outputTillPrompt.getvalue())
                         # ssh has been observed returning "\r\n" for newline, but we want "\n"
                         newOutput = SshCommand._crLfRegex.sub("\n", newOutput)
-                        outputTillPrompt += newOutput
-                        if SshCommand._acceptPromptRegex.search(outputTillPrompt):
+                        outputTillPrompt.append(newOutput)
+                        # look for prompts near the end only, rather than in all output again and again
+                        recentOutput = outputTillPrompt.tail(len(newOutput) + SshCommand._promptSearchOverlap)
+                        if SshCommand._acceptPromptRegex.search(recentOutput):
                             # e.g. "Are you sure you want to continue connecting (yes/no)? "
                             raise Exception("cannot proceed unless having accepted host key\n" +
-                                            outputTillPrompt +
+                                            outputTillPrompt.getvalue() +
                                             '\nE.g. invoke SshCommand.acceptKnownHostKey(SshParameters("{0}",user,pwd)).'.format(self._ipaddress))
-                        if SshCommand._pwdPromptRegex.search(outputTillPrompt):
+                        if SshCommand._pwdPromptRegex.search(recentOutput):
                             # e.g. "10.123.45.67's password: "
                             promptedForPassword = True
                     except EnvironmentError:
                         # e.g. "@    WARNING: REMOTE HOST IDENTIFICATION HAS CHANGED!     @" and closing
                         raise Exception("failing to connect for scp\n" + 
-                                        outputTillPrompt)
+                                        outputTillPrompt.getvalue())
                 os.write(self._fd, self._pwd + "\n")
             # look for output
             endOfOutput = False
-            outputSincePrompt = ""
+            outputSincePrompt = OutputBuffer(spillThreshold=outputSpillThreshold,
+                                             maxRetained=outputMaxRetained)
             try:
                 while not endOfOutput:
                     try:
                         newOutput = os.read(self._fd, 1024)
                         if len(newOutput):
-                            outputSincePrompt += newOutput
+                            outputSincePrompt.append(newOutput)
                         else:
                             # end has been reached
                             endOfOutput = True
@@ -716,11 +1104,16 @@ class ScpCommand(object):
             finally:
                 # remove any leading space (maybe there after "password:" prompt) and
                 # remove first newline (is there after entering password and "\n")
-                self._output = re.sub(r"^\s*?\n(.*)$", r"\1", outputSincePrompt)
+                self._output = re.sub(r"^\s*?\n(.*)$", r"\1", outputSincePrompt.getvalue())
+                outputSincePrompt.close()
                 #
                 # get returncode
                 try:
-                    ignorePidAgain, waitEncodedStatusIndication = os.waitpid(self._pid, 0)
+                    ignorePidAgain, waitEncodedStatusIndication, rusage = os.wait4(self._pid, 0)
+                    CommandCaptureStatistics.record(CommandCaptureUsage.fromRusage(
+                        "scp", time.time() - startTime, rusage,
+                        len(outputSincePrompt), 0, True,
+                        os.WEXITSTATUS(waitEncodedStatusIndication) if os.WIFEXITED(waitEncodedStatusIndication) else -1))
                     if os.WIFEXITED(waitEncodedStatusIndication):
                         # normal exit(status) call
                         self._returncode = os.WEXITSTATUS(waitEncodedStatusIndication)
@@ -743,6 +1136,9 @@ class ScpCommand(object):
                     # supposedly can occur
                     self._returncode = -1
                     raise ScpCommandException("scp did not exit normally")
+        finally:
+            SshConnectionPool.release(controlOptions)
+            CommandCaptureHooks.ended(startEvent, self._returncode)
 
     @property
     def output(self):
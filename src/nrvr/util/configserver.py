@@ -0,0 +1,289 @@
+#!/usr/bin/python
+
+"""nrvr.util.configserver - Serve configuration files to virtual machines by HTTP
+
+The main class provided by this module is ConfigServer.
+
+Serves kickstart, preseed, or autounattend content per virtual machine,
+keyed by MAC address or by IP address,
+for example for a boot line ks=http://10.123.45.1:8019/ks.cfg shared by all virtual machines.
+
+Meant to run on the host-only network, at VMwareHypervisor.localHostOnlyIPAddress.
+A loopback address is enough for testing.
+
+Works in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import BaseHTTPServer
+from collections import deque
+import re
+import SocketServer
+import threading
+import urllib
+
+from nrvr.util.ipaddress import IPAddress
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Auxiliary class, each request in a thread of its own."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _ConfigRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Auxiliary class, answers GET and HEAD requests from the ConfigServer it belongs to."""
+
+    # set per server
+    configServer = None
+
+    def _respond(self, withBody):
+        """Auxiliary method."""
+        content = self.configServer._contentForRequest(self.path, self.headers, self.client_address[0])
+        if content is None:
+            self.send_error(404, "no configuration for {0} from {1}".format(self.path, self.client_address[0]))
+            return
+        if isinstance(content, unicode):
+            content = content.encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if withBody:
+            self.wfile.write(content)
+
+    def do_GET(self):
+        self._respond(True)
+
+    def do_HEAD(self):
+        self._respond(False)
+
+    def log_message(self, format, *args):
+        self.configServer._log.append("{0} {1}".format(self.client_address[0], format % args))
+
+class ConfigServer(object):
+    """A lightweight HTTP server serving configuration files to virtual machines.
+
+    A request for /name, e.g. /ks.cfg, is answered with content put for the requesting virtual machine,
+    looked up by MAC address as sent by Anaconda if booted with kssendmac,
+    else by IP address of the requesting virtual machine,
+    else content put for any virtual machine.
+    A request for /key/name, e.g. /00:0c:29:aa:bb:cc/ks.cfg or /10.123.45.67/ks.cfg,
+    is answered with content put for that key only.
+
+    Content is rendered when requested, hence changes to a DistroKickstartFileContent
+    or UbPreseedFileContent after putting it are served without rebuilding any .iso image."""
+
+    _macAddressRegex = re.compile(r"^([0-9a-f]{2})[:-]?([0-9a-f]{2})[:-]?([0-9a-f]{2})[:-]?"
+                                  r"([0-9a-f]{2})[:-]?([0-9a-f]{2})[:-]?([0-9a-f]{2})$")
+
+    # as sent by Anaconda if kssendmac, e.g. "eth0 00:0c:29:aa:bb:cc"
+    _macAddressHeaderRegex = re.compile(r"^X-RHN-Provisioning-MAC-\d+$", re.IGNORECASE)
+
+    # how many log lines of requests to keep
+    maxLogLines = 1000
+
+    def __init__(self, ipaddress=None, port=0):
+        """Create new ConfigServer.
+
+        Call start() to start serving, stop() to stop serving, or use in a with statement.
+
+        ipaddress
+            to listen on, if None then VMwareHypervisor.localHostOnlyIPAddress,
+            e.g. "127.0.0.1" for testing.
+
+        port
+            to listen on, if 0 then any free port, see property port."""
+        if ipaddress is None:
+            # import here rather than at top to not make this module depend on nrvr.vm
+            from nrvr.vm.vmware import VMwareHypervisor
+            ipaddress = VMwareHypervisor.localHostOnlyIPAddress
+            if ipaddress is None:
+                raise Exception("cannot determine IP address of hostonly network of VMware hypervisor")
+        self._ipaddress = IPAddress.asString(ipaddress)
+        self._requestedPort = port
+        self._httpServer = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # dictionary key -> dictionary name -> content, key None for any virtual machine
+        self._contents = {}
+        # only the most recent, so a long running server doesn't grow without bound
+        self._log = deque(maxlen=ConfigServer.maxLogLines)
+        self._served = 0
+        self._notFound = 0
+
+    @classmethod
+    def normalizedKey(cls, key):
+        """Return key normalized, a MAC address as "00:0c:29:aa:bb:cc", an IP address as "10.123.45.67",
+        None as None."""
+        if key is None:
+            return None
+        key = key.strip().lower()
+        macAddressMatch = ConfigServer._macAddressRegex.match(key)
+        if macAddressMatch:
+            return ":".join(macAddressMatch.groups())
+        return IPAddress.asString(key)
+
+    @classmethod
+    def _normalizedName(cls, name):
+        """Auxiliary method, without leading slashes."""
+        return name.lstrip("/")
+
+    def put(self, name, content, key=None):
+        """Serve content as name for a virtual machine.
+
+        name
+            e.g. "ks.cfg".
+
+        content
+            a string, or an object with a property string,
+            e.g. a DistroKickstartFileContent, UbPreseedFileContent,
+            or InstallerAutounattendFileContent,
+            in which case its property string is read whenever requested.
+
+        key
+            MAC address or IP address of the virtual machine,
+            if None then for any virtual machine without content of its own.
+
+        return
+            URL for the virtual machine to request, see method url."""
+        with self._lock:
+            self._contents.setdefault(self.normalizedKey(key), {})[self._normalizedName(name)] = content
+        return self.url(name, key=key)
+
+    def remove(self, key=None, name=None):
+        """Stop serving content for a virtual machine.
+
+        name
+            if None then all content for key."""
+        key = self.normalizedKey(key)
+        with self._lock:
+            if name is None:
+                self._contents.pop(key, None)
+            else:
+                self._contents.get(key, {}).pop(self._normalizedName(name), None)
+
+    def _contentForRequest(self, path, headers, clientIpaddress):
+        """Auxiliary method, called by request handler threads.
+
+        return
+            a string, or None if not found."""
+        path = urllib.unquote(path.split("?", 1)[0]).lstrip("/")
+        candidates = []
+        if "/" in path:
+            # explicitly keyed
+            key, name = path.split("/", 1)
+            candidates.append(self.normalizedKey(key))
+        else:
+            name = path
+            for header in headers.keys():
+                if ConfigServer._macAddressHeaderRegex.match(header):
+                    for value in headers.getheaders(header):
+                        if value.split():
+                            candidates.append(self.normalizedKey(value.split()[-1]))
+            candidates.append(self.normalizedKey(clientIpaddress))
+            candidates.append(None)
+        with self._lock:
+            for key in candidates:
+                content = self._contents.get(key, {}).get(name)
+                if content is not None:
+                    self._served += 1
+                    break
+            else:
+                self._notFound += 1
+                return None
+        # rendered when requested
+        return getattr(content, "string", content)
+
+    def start(self):
+        """Start serving, in a daemon thread.
+
+        return
+            self, for daisychaining."""
+        if self._httpServer:
+            return self
+        class _BoundConfigRequestHandler(_ConfigRequestHandler):
+            pass
+        _BoundConfigRequestHandler.configServer = self
+        self._httpServer = _ThreadingHTTPServer((self._ipaddress, self._requestedPort), _BoundConfigRequestHandler)
+        self._thread = threading.Thread(target=self._httpServer.serve_forever, name="ConfigServer")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        if not self._httpServer:
+            return
+        self._httpServer.shutdown()
+        self._httpServer.server_close()
+        self._thread.join()
+        self._httpServer = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @property
+    def ipaddress(self):
+        """IP address listening on."""
+        return self._ipaddress
+
+    @property
+    def port(self):
+        """Port listening on, known once started."""
+        if self._httpServer:
+            return self._httpServer.server_address[1]
+        return self._requestedPort
+
+    def url(self, name, key=None):
+        """Return URL of content.
+
+        key
+            if None then URL without key, the same for all virtual machines,
+            answered per virtual machine by MAC address or IP address of the request."""
+        if key is None:
+            return "http://{0}:{1}/{2}".format(self._ipaddress, self.port, self._normalizedName(name))
+        return "http://{0}:{1}/{2}/{3}".format(self._ipaddress, self.port, self.normalizedKey(key),
+                                               self._normalizedName(name))
+
+    @property
+    def served(self):
+        """Number of requests answered with content."""
+        return self._served
+
+    @property
+    def notFound(self):
+        """Number of requests for which no content was found."""
+        return self._notFound
+
+    @property
+    def log(self):
+        """List of log lines of most recent requests, at most maxLogLines."""
+        return list(self._log)
+
+if __name__ == "__main__":
+    import urllib2
+    class _Content(object):
+        string = u"# kickstart\n"
+    _content = _Content()
+    with ConfigServer("127.0.0.1") as _configServer:
+        _configServer.put("ks.cfg", u"# any\n")
+        _configServer.put("ks.cfg", _content, key="00-0C-29-AA-BB-CC")
+        print urllib2.urlopen(_configServer.url("ks.cfg")).read()
+        _content.string = u"# kickstart changed\n"
+        print urllib2.urlopen(_configServer.url("ks.cfg", key="00:0c:29:aa:bb:cc")).read()
+        print urllib2.urlopen(urllib2.Request(_configServer.url("ks.cfg"),
+                                              headers={"X-RHN-Provisioning-MAC-0": "eth0 00:0c:29:aa:bb:cc"})).read()
+        try:
+            urllib2.urlopen(_configServer.url("nonexistent.cfg"))
+        except urllib2.HTTPError as ex:
+            print ex.code
+        print _configServer.served, _configServer.notFound
+        print "\n".join(_configServer.log)
@@ -21,6 +21,7 @@ import sys
 import urllib2
 import urlparse
 
+from nrvr.process.commandcapture import CommandCaptureHooks
 from nrvr.util.user import ScriptUser
 
 class Download(object):
@@ -98,6 +99,7 @@ class Download(object):
             #
             # try downloading
             pid = os.getpid()
+            startEvent = CommandCaptureHooks.started("download", [url])
             try:
                 with open(semaphorePath, "w") as semaphoreFile:
                     # create semaphore file
@@ -132,9 +134,11 @@ class Download(object):
                     except:
                         pass
                 print "problem downloading " + url
+                CommandCaptureHooks.ended(startEvent, -1)
                 raise
             else:
                 print "done downloading " + url
+                CommandCaptureHooks.ended(startEvent, 0)
             finally:
                 try:
                     # close connection to server
@@ -0,0 +1,302 @@
+#!/usr/bin/python
+
+"""nrvr.util.filecopy - Utilities regarding copying files fast
+
+Class provided by this module is FileCopy.
+
+Copies kernel-side where possible, without passing the content through Python,
+by FICLONE reflink for whole files on filesystems that support it, e.g. btrfs or xfs,
+else by copy_file_range, else by sendfile,
+else falls back to reading and writing large buffers.
+
+Kernel-side copying works in Linux.
+It should work in Linux and Windows, in Windows by falling back.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import errno
+import os
+import os.path
+import shutil
+import sys
+
+_gotFcntl = False
+try:
+    import fcntl
+    _gotFcntl = True
+except ImportError:
+    pass
+
+_gotLibc = False
+if sys.platform.startswith("linux"):
+    try:
+        import ctypes
+        _libc = ctypes.CDLL(None, use_errno=True)
+        _gotLibc = True
+    except (ImportError, OSError):
+        pass
+
+class FileCopy(object):
+    """Utilities regarding copying files fast."""
+
+    # size of buffers when falling back to reading and writing
+    bufferSize = 4194304
+
+    # see linux/fs.h
+    _ficloneIoctl = 0x40049409
+
+    # at most per system call, as limited by Linux
+    _maxPerCall = 0x7ffff000
+
+    # errors that mean to fall back to another way of copying
+    _fallBackErrnos = set([errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+                           errno.EBADF, errno.ENOTSUP, errno.EPERM, errno.ESPIPE])
+
+    # which ways of copying are worth trying, set to False once found not to be supported at all
+    _tryCopyFileRange = _gotLibc and hasattr(_libc, "copy_file_range")
+    _trySendfile = _gotLibc and hasattr(_libc, "sendfile")
+
+    if _tryCopyFileRange:
+        _libc.copy_file_range.restype = ctypes.c_ssize_t
+        _libc.copy_file_range.argtypes = [ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                          ctypes.c_int, ctypes.POINTER(ctypes.c_int64),
+                                          ctypes.c_size_t, ctypes.c_uint]
+    if _trySendfile:
+        _libc.sendfile.restype = ctypes.c_ssize_t
+        _libc.sendfile.argtypes = [ctypes.c_int, ctypes.c_int,
+                                   ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+
+    @classmethod
+    def _copyFileRangeCalls(cls, inFd, inOffset, outFd, outOffset, length):
+        """Auxiliary method, return number of bytes copied by copy_file_range, which may be less than length
+        if an error has happened which means to fall back."""
+        inOffsetPointer = ctypes.c_int64(inOffset)
+        outOffsetPointer = ctypes.c_int64(outOffset)
+        copied = 0
+        while copied < length:
+            result = _libc.copy_file_range(inFd, ctypes.byref(inOffsetPointer),
+                                           outFd, ctypes.byref(outOffsetPointer),
+                                           min(length - copied, FileCopy._maxPerCall), 0)
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error == errno.ENOSYS:
+                    FileCopy._tryCopyFileRange = False
+                if error in FileCopy._fallBackErrnos:
+                    return copied
+                raise OSError(error, os.strerror(error))
+            if result == 0:
+                # unexpected end of input file
+                return copied
+            copied += result
+        return copied
+
+    @classmethod
+    def _sendfileCalls(cls, inFd, inOffset, outFd, outOffset, length):
+        """Auxiliary method, return number of bytes copied by sendfile, which may be less than length
+        if an error has happened which means to fall back.
+
+        sendfile writes at the file position of outFd, hence it is set first."""
+        os.lseek(outFd, outOffset, os.SEEK_SET)
+        inOffsetPointer = ctypes.c_int64(inOffset)
+        copied = 0
+        while copied < length:
+            result = _libc.sendfile(outFd, inFd, ctypes.byref(inOffsetPointer),
+                                    min(length - copied, FileCopy._maxPerCall))
+            if result < 0:
+                error = ctypes.get_errno()
+                if error == errno.EINTR:
+                    continue
+                if error == errno.ENOSYS:
+                    FileCopy._trySendfile = False
+                if error in FileCopy._fallBackErrnos:
+                    return copied
+                raise OSError(error, os.strerror(error))
+            if result == 0:
+                return copied
+            copied += result
+        return copied
+
+    @classmethod
+    def _bufferedCalls(cls, inFd, inOffset, outFd, outOffset, length):
+        """Auxiliary method, return number of bytes copied by reading and writing large buffers."""
+        os.lseek(inFd, inOffset, os.SEEK_SET)
+        os.lseek(outFd, outOffset, os.SEEK_SET)
+        copied = 0
+        while copied < length:
+            data = os.read(inFd, min(length - copied, FileCopy.bufferSize))
+            if not data:
+                return copied
+            written = 0
+            while written < len(data):
+                written += os.write(outFd, data[written:])
+            copied += len(data)
+        return copied
+
+    @classmethod
+    def copyFileDescriptorRange(cls, inFd, inOffset, outFd, outOffset, length):
+        """Copy length bytes from inFd at inOffset to outFd at outOffset.
+
+        Kernel-side if possible, else by large buffers.
+
+        Leaves the file position of outFd undefined.
+
+        return
+            number of bytes copied, less than length only if the input file is shorter."""
+        copied = 0
+        if FileCopy._tryCopyFileRange:
+            copied += cls._copyFileRangeCalls(inFd, inOffset, outFd, outOffset, length)
+        if copied < length and FileCopy._trySendfile:
+            copied += cls._sendfileCalls(inFd, inOffset + copied, outFd, outOffset + copied, length - copied)
+        if copied < length:
+            copied += cls._bufferedCalls(inFd, inOffset + copied, outFd, outOffset + copied, length - copied)
+        return copied
+
+    @classmethod
+    def copyFileObjectRange(cls, inputFile, inOffset, length, outputFile):
+        """Copy length bytes from an open file object at inOffset to the current position
+        of another open file object, and advance the latter's position.
+
+        Flushes outputFile first, so it may be mixed with calls of outputFile.write.
+
+        return
+            number of bytes copied, less than length only if the input file is shorter."""
+        outputFile.flush()
+        outOffset = outputFile.tell()
+        copied = cls.copyFileDescriptorRange(inputFile.fileno(), inOffset, outputFile.fileno(), outOffset, length)
+        # also brings position known to the file object in sync
+        outputFile.seek(outOffset + copied)
+        return copied
+
+    @classmethod
+    def reflink(cls, fromPath, toPath):
+        """Make toPath a copy-on-write clone of fromPath, if the filesystem supports it.
+
+        toPath
+            must not exist yet, if it does then not done and left as is.
+
+        return
+            whether done, if not then toPath is as it was before."""
+        if not _gotFcntl:
+            return False
+        try:
+            toFd = os.open(toPath, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0666)
+        except OSError:
+            # e.g. already exists
+            return False
+        try:
+            with open(fromPath, "rb") as fromFile:
+                fcntl.ioctl(toFd, FileCopy._ficloneIoctl, fromFile.fileno())
+            return True
+        except (IOError, OSError):
+            # not supported, e.g. not btrfs or xfs,
+            # remove only what this call has created
+            os.close(toFd)
+            toFd = None
+            os.remove(toPath)
+            return False
+        finally:
+            if toFd is not None:
+                os.close(toFd)
+
+    @classmethod
+    def copyRange(cls, fromPath, toPath, start=0, stop=None):
+        """Copy bytes from start to stop of file fromPath into a file toPath by itself.
+
+        start
+            if None then 0.
+
+        stop
+            if None then end of file."""
+        if not start:
+            start = 0
+        if stop is None:
+            stop = os.path.getsize(fromPath)
+        with open(fromPath, "rb") as inputFile:
+            with open(toPath, "wb") as outputFile:
+                cls.copyFileDescriptorRange(inputFile.fileno(), start, outputFile.fileno(), 0, max(0, stop - start))
+
+    @classmethod
+    def copyFile(cls, fromPath, toPath):
+        """Copy file fromPath to toPath, with permission bits and times, like shutil.copy2.
+
+        toPath
+            may be a directory to copy into."""
+        if os.path.isdir(toPath):
+            toPath = os.path.join(toPath, os.path.basename(fromPath))
+        if not cls.reflink(fromPath, toPath):
+            cls.copyRange(fromPath, toPath)
+        shutil.copystat(fromPath, toPath)
+
+    @classmethod
+    def copyTree(cls, fromDirectory, toDirectory, symlinks=False):
+        """Copy a directory with all its content, like shutil.copytree.
+
+        toDirectory
+            must not exist yet.
+
+        symlinks
+            whether to copy symbolic links as symbolic links rather than what they point to."""
+        os.makedirs(toDirectory)
+        for name in os.listdir(fromDirectory):
+            fromPath = os.path.join(fromDirectory, name)
+            toPath = os.path.join(toDirectory, name)
+            if symlinks and os.path.islink(fromPath):
+                os.symlink(os.readlink(fromPath), toPath)
+            elif os.path.isdir(fromPath):
+                cls.copyTree(fromPath, toPath, symlinks=symlinks)
+            else:
+                cls.copyFile(fromPath, toPath)
+        shutil.copystat(fromDirectory, toDirectory)
+
+if __name__ == "__main__":
+    # micro-benchmark, optionally give largest size in MB as argument, default 1024
+    import tempfile
+    import time
+    from nrvr.util.times import Timestamp
+    def _copyRangeByChunks(fromPath, toPath, start, stop, chunkSize):
+        # as IsoImageModificationFromByteRange used to do it
+        with open(fromPath, "rb") as inputFile:
+            inputFile.seek(start)
+            with open(toPath, "wb") as outputFile:
+                current = start
+                while current < stop:
+                    chunk = min(stop - current, chunkSize)
+                    outputFile.write(inputFile.read(chunk))
+                    current += chunk
+    _maxMegabytes = int(sys.argv[1]) if len(sys.argv) > 1 else 1024
+    _testDir = os.path.join(tempfile.gettempdir(), Timestamp.microsecondTimestamp())
+    os.mkdir(_testDir, 0755)
+    try:
+        _fromPath = os.path.join(_testDir, "from.bin")
+        _toPath = os.path.join(_testDir, "to.bin")
+        with open(_fromPath, "wb") as outputFile:
+            for _ in range(_maxMegabytes + 1):
+                outputFile.write(os.urandom(1048576))
+        print "copy_file_range {0}, sendfile {1}".format(FileCopy._tryCopyFileRange, FileCopy._trySendfile)
+        _megabytes = 1
+        while _megabytes <= _maxMegabytes:
+            _length = _megabytes * 1048576
+            # odd start, as a byte range would be
+            _start = 12345
+            _results = []
+            for _name, _copy in [("10 KB chunks", lambda: _copyRangeByChunks(_fromPath, _toPath, _start, _start + _length, 10240)),
+                                 ("FileCopy", lambda: FileCopy.copyRange(_fromPath, _toPath, _start, _start + _length))]:
+                if os.path.exists(_toPath):
+                    os.remove(_toPath)
+                _begin = time.time()
+                _copy()
+                _seconds = max(time.time() - _begin, 1e-6)
+                if os.path.getsize(_toPath) != _length:
+                    raise Exception("wrong size copying by {0}".format(_name))
+                _results.append("{0} {1:>8.1f} MB/s".format(_name, _megabytes / _seconds))
+            print "{0:>5} MB  {1}".format(_megabytes, "  ".join(_results))
+            _megabytes *= 4
+    finally:
+        shutil.rmtree(_testDir)
@@ -0,0 +1,470 @@
+#!/usr/bin/python
+
+"""nrvr.util.packageproxy - A caching HTTP proxy for package downloads
+
+Classes provided by this module include
+* PackageProxyStats
+* PackageProxy
+
+The main class provided by this module is PackageProxy.
+
+When provisioning many virtual machines each one downloads the same packages.
+Run on the host-only network, and set as proxy in kickstart or preseed files,
+e.g. by ElKickstartFileContent.elSetProxy, UbKickstartFileContent.ubSetProxy,
+or UbPreseedFileContent.setProxy,
+then each package is downloaded from upstream once, and served from the host disk to every
+virtual machine after that.
+
+Only package files, which don't change once published, are cached,
+e.g. .rpm and .deb files.
+Anything else, e.g. repository metadata, is passed through.
+HTTPS is tunneled, not cached.
+
+Works in Linux and Windows.
+
+Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
+
+Public repository - https://github.com/srguiwiz/nrvr-commander
+
+Copyright (c) Nirvana Research 2006-2015.
+Simplified BSD License"""
+
+import BaseHTTPServer
+from collections import namedtuple
+from contextlib import contextmanager
+import errno
+import hashlib
+import os
+import os.path
+import select
+import shutil
+import socket
+import SocketServer
+import threading
+import urllib2
+import urlparse
+
+from nrvr.util.ipaddress import IPAddress
+from nrvr.util.times import Timestamp
+
+class PackageProxyStats(namedtuple("PackageProxyStats",
+                                   ["hits", "misses", "passThrough", "evictions",
+                                    "bytesFromCache", "bytesFromUpstream",
+                                    "entries", "bytes", "maxBytes"])):
+    """Statistics of a PackageProxy.
+
+    hits, misses, passThrough, evictions, bytesFromCache, bytesFromUpstream
+    are counted since the PackageProxy instance has been made.
+
+    entries, bytes are of the cache directory on the host disk at the time of asking."""
+
+    __slots__ = ()
+
+class _ThreadingHTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """Auxiliary class, each request in a thread of its own."""
+    daemon_threads = True
+    allow_reuse_address = True
+
+class _PackageProxyRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Auxiliary class, answers proxy requests for the PackageProxy it belongs to."""
+
+    # set per server
+    packageProxy = None
+
+    # HTTP/1.0 to close connection after each response, simplest for a proxy
+    protocol_version = "HTTP/1.0"
+
+    def do_GET(self):
+        self.packageProxy._handle(self, withBody=True)
+
+    def do_HEAD(self):
+        self.packageProxy._handle(self, withBody=False)
+
+    def do_CONNECT(self):
+        self.packageProxy._tunnel(self)
+
+    def log_message(self, format, *args):
+        pass
+
+class PackageProxy(object):
+    """A caching HTTP proxy for package downloads, with a size-bounded cache,
+    evicting least recently used packages first."""
+
+    # file name extensions of package files, which don't change once published
+    cacheableExtensions = (".rpm", ".drpm", ".deb", ".udeb")
+
+    # response headers passed on from upstream
+    _passedHeaders = ["Content-Type", "Last-Modified", "ETag"]
+
+    _chunkSize = 1048576
+
+    def __init__(self, cacheDirectory, maxBytes=8 * 1024 * 1024 * 1024, ipaddress=None, port=0):
+        """Create new PackageProxy.
+
+        Call start() to start serving, stop() to stop serving, or use in a with statement.
+
+        cacheDirectory
+            path of directory to keep packages in, made if it doesn't exist yet.
+            Can be kept across runs.
+
+        maxBytes
+            maximum total size of packages kept.
+
+        ipaddress
+            to listen on, if None then VMwareHypervisor.localHostOnlyIPAddress,
+            e.g. "127.0.0.1" for testing.
+
+        port
+            to listen on, if 0 then any free port, see property port."""
+        if ipaddress is None:
+            # import here rather than at top to not make this module depend on nrvr.vm
+            from nrvr.vm.vmware import VMwareHypervisor
+            ipaddress = VMwareHypervisor.localHostOnlyIPAddress
+            if ipaddress is None:
+                raise Exception("cannot determine IP address of hostonly network of VMware hypervisor")
+        self._ipaddress = IPAddress.asString(ipaddress)
+        self._requestedPort = port
+        self._cacheDirectory = cacheDirectory
+        self._maxBytes = maxBytes
+        self._httpServer = None
+        self._thread = None
+        self._lock = threading.Lock()
+        # one [lock, users] per package being requested, for concurrent requests to download it only once,
+        # removed once no request uses it anymore
+        self._downloadLocks = {}
+        self._hits = 0
+        self._misses = 0
+        self._passThrough = 0
+        self._evictions = 0
+        self._bytesFromCache = 0
+        self._bytesFromUpstream = 0
+        if not os.path.isdir(self._cacheDirectory):
+            os.makedirs(self._cacheDirectory, 0755)
+
+    @property
+    def cacheDirectory(self):
+        """Path of directory to keep packages in."""
+        return self._cacheDirectory
+
+    @property
+    def maxBytes(self):
+        """Maximum total size of packages kept."""
+        return self._maxBytes
+
+    @property
+    def ipaddress(self):
+        """IP address listening on."""
+        return self._ipaddress
+
+    @property
+    def port(self):
+        """Port listening on, known once started."""
+        if self._httpServer:
+            return self._httpServer.server_address[1]
+        return self._requestedPort
+
+    @property
+    def url(self):
+        """URL of this proxy, e.g. "http://10.123.45.1:3142/",
+        to be given to kickstart or preseed files."""
+        return "http://{0}:{1}/".format(self._ipaddress, self.port)
+
+    def start(self):
+        """Start serving, in a daemon thread.
+
+        return
+            self, for daisychaining."""
+        if self._httpServer:
+            return self
+        class _BoundPackageProxyRequestHandler(_PackageProxyRequestHandler):
+            pass
+        _BoundPackageProxyRequestHandler.packageProxy = self
+        self._httpServer = _ThreadingHTTPServer((self._ipaddress, self._requestedPort), _BoundPackageProxyRequestHandler)
+        self._thread = threading.Thread(target=self._httpServer.serve_forever, name="PackageProxy")
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stop serving."""
+        if not self._httpServer:
+            return
+        self._httpServer.shutdown()
+        self._httpServer.server_close()
+        self._thread.join()
+        self._httpServer = None
+        self._thread = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    @classmethod
+    def isCacheable(cls, url):
+        """Whether url is of a package file, which doesn't change once published."""
+        return urlparse.urlparse(url).path.lower().endswith(PackageProxy.cacheableExtensions)
+
+    def _cachedPath(self, url):
+        """Auxiliary method."""
+        return os.path.join(self._cacheDirectory, hashlib.sha256(url).hexdigest())
+
+    def _count(self, **increments):
+        """Auxiliary method, thread-safe."""
+        with self._lock:
+            for name, increment in increments.iteritems():
+                setattr(self, "_" + name, getattr(self, "_" + name) + increment)
+
+    @contextmanager
+    def _downloadLock(self, url):
+        """Auxiliary method, hold a lock per url."""
+        with self._lock:
+            downloadLock = self._downloadLocks.setdefault(url, [threading.Lock(), 0])
+            downloadLock[1] += 1
+        try:
+            with downloadLock[0]:
+                yield
+        finally:
+            with self._lock:
+                downloadLock[1] -= 1
+                if not downloadLock[1]:
+                    del self._downloadLocks[url]
+
+    def _handle(self, handler, withBody):
+        """Auxiliary method, called by request handler threads."""
+        url = handler.path
+        if not url.lower().startswith("http://"):
+            handler.send_error(400, "not a proxy request {0}".format(url))
+            return
+        if not withBody or "Range" in handler.headers or not self.isCacheable(url):
+            self._passOn(handler, url, withBody)
+            return
+        cachedPath = self._cachedPath(url)
+        with self._downloadLock(url):
+            if not os.path.exists(cachedPath):
+                self._count(misses=1)
+                self._download(handler, url, cachedPath)
+                return
+        self._count(hits=1)
+        self._serveCached(handler, cachedPath)
+
+    def _openUpstream(self, handler, url, withBody):
+        """Auxiliary method, return response, or None if an error has been sent."""
+        request = urllib2.Request(url)
+        if not withBody:
+            request.get_method = lambda: "HEAD"
+        for header in ["Range", "If-Modified-Since", "If-None-Match", "Accept"]:
+            if header in handler.headers:
+                request.add_header(header, handler.headers[header])
+        try:
+            return urllib2.urlopen(request, timeout=60)
+        except urllib2.HTTPError as ex:
+            handler.send_error(ex.code, ex.msg)
+        except (urllib2.URLError, socket.error) as ex:
+            handler.send_error(502, "cannot get {0} because {1}".format(url, ex))
+        return None
+
+    def _sendHeaders(self, handler, status, headers, contentLength):
+        """Auxiliary method."""
+        handler.send_response(status)
+        for header in PackageProxy._passedHeaders:
+            if headers and header in headers:
+                handler.send_header(header, headers[header])
+        if contentLength is not None:
+            handler.send_header("Content-Length", str(contentLength))
+        handler.end_headers()
+
+    def _passOn(self, handler, url, withBody):
+        """Auxiliary method, without caching."""
+        self._count(passThrough=1)
+        response = self._openUpstream(handler, url, withBody)
+        if response is None:
+            return
+        try:
+            contentLength = response.info().getheader("Content-Length")
+            self._sendHeaders(handler, response.getcode(), response.info(),
+                              int(contentLength) if contentLength else None)
+            if withBody:
+                while True:
+                    chunk = response.read(PackageProxy._chunkSize)
+                    if not chunk:
+                        break
+                    handler.wfile.write(chunk)
+                    self._count(bytesFromUpstream=len(chunk))
+        finally:
+            response.close()
+
+    def _download(self, handler, url, cachedPath):
+        """Auxiliary method, serve from upstream while writing into the cache."""
+        response = self._openUpstream(handler, url, True)
+        if response is None:
+            return
+        temporaryPath = cachedPath + ".tmp" + Timestamp.microsecondTimestamp()
+        try:
+            contentLength = response.info().getheader("Content-Length")
+            contentLength = int(contentLength) if contentLength else None
+            self._sendHeaders(handler, response.getcode(), response.info(), contentLength)
+            received = 0
+            clientGone = False
+            with open(temporaryPath, "wb") as cacheFile:
+                while True:
+                    chunk = response.read(PackageProxy._chunkSize)
+                    if not chunk:
+                        break
+                    cacheFile.write(chunk)
+                    received += len(chunk)
+                    if not clientGone:
+                        try:
+                            handler.wfile.write(chunk)
+                        except socket.error:
+                            # complete the download for the next request anyway
+                            clientGone = True
+            self._count(bytesFromUpstream=received)
+            if response.getcode() == 200 and (contentLength is None or received == contentLength):
+                os.rename(temporaryPath, cachedPath)
+        finally:
+            response.close()
+            if os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+        self.evict()
+
+    def _serveCached(self, handler, cachedPath):
+        """Auxiliary method."""
+        try:
+            cacheFile = open(cachedPath, "rb")
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                raise
+            # evicted meanwhile
+            handler.send_error(503, "evicted meanwhile, please try again")
+            return
+        with cacheFile:
+            # time of last use
+            os.utime(cachedPath, None)
+            self._sendHeaders(handler, 200, None, os.fstat(cacheFile.fileno()).st_size)
+            while True:
+                chunk = cacheFile.read(PackageProxy._chunkSize)
+                if not chunk:
+                    break
+                handler.wfile.write(chunk)
+                self._count(bytesFromCache=len(chunk))
+
+    def _tunnel(self, handler):
+        """Auxiliary method, for HTTPS, not cached."""
+        self._count(passThrough=1)
+        host, _, port = handler.path.rpartition(":")
+        try:
+            upstream = socket.create_connection((host, int(port)), timeout=60)
+        except (socket.error, ValueError) as ex:
+            handler.send_error(502, "cannot connect to {0} because {1}".format(handler.path, ex))
+            return
+        try:
+            handler.send_response(200, "Connection established")
+            handler.end_headers()
+            client = handler.connection
+            sockets = [client, upstream]
+            while True:
+                readable, _, broken = select.select(sockets, [], sockets, 60)
+                if broken or not readable:
+                    break
+                done = False
+                for readableSocket in readable:
+                    data = readableSocket.recv(65536)
+                    if not data:
+                        done = True
+                        break
+                    (upstream if readableSocket is client else client).sendall(data)
+                if done:
+                    break
+        except socket.error:
+            pass
+        finally:
+            upstream.close()
+
+    def _entries(self):
+        """Auxiliary method, return a list of (lastUsed, name, size), least recently used first."""
+        entries = []
+        for name in os.listdir(self._cacheDirectory):
+            if ".tmp" in name:
+                continue
+            path = os.path.join(self._cacheDirectory, name)
+            try:
+                entries.append((os.path.getmtime(path), name, os.path.getsize(path)))
+            except OSError:
+                # removed meanwhile
+                continue
+        entries.sort()
+        return entries
+
+    def evict(self, maxBytes=None):
+        """Remove least recently used packages until total size is not more than maxBytes.
+
+        maxBytes
+            if None then as given when making this PackageProxy."""
+        if maxBytes is None:
+            maxBytes = self._maxBytes
+        with self._lock:
+            entries = self._entries()
+            totalBytes = sum(size for lastUsed, name, size in entries)
+            for lastUsed, name, size in entries:
+                if totalBytes <= maxBytes:
+                    break
+                try:
+                    os.remove(os.path.join(self._cacheDirectory, name))
+                except OSError as ex:
+                    if ex.errno != errno.ENOENT:
+                        raise
+                totalBytes -= size
+                self._evictions += 1
+
+    def clear(self):
+        """Remove all cached packages."""
+        self.evict(maxBytes=0)
+
+    def stats(self):
+        """Return a PackageProxyStats."""
+        entries = self._entries()
+        return PackageProxyStats(hits=self._hits,
+                                 misses=self._misses,
+                                 passThrough=self._passThrough,
+                                 evictions=self._evictions,
+                                 bytesFromCache=self._bytesFromCache,
+                                 bytesFromUpstream=self._bytesFromUpstream,
+                                 entries=len(entries),
+                                 bytes=sum(size for lastUsed, name, size in entries),
+                                 maxBytes=self._maxBytes)
+
+if __name__ == "__main__":
+    import tempfile
+    import SimpleHTTPServer
+    _testDir = os.path.join(tempfile.gettempdir(), Timestamp.microsecondTimestamp())
+    os.mkdir(_testDir, 0755)
+    try:
+        # an upstream to test with
+        _upstreamDir = os.path.join(_testDir, "upstream")
+        os.mkdir(_upstreamDir, 0755)
+        for _name in ["a.rpm", "b.deb", "c.deb", "repomd.xml"]:
+            with open(os.path.join(_upstreamDir, _name), "wb") as outputFile:
+                outputFile.write(os.urandom(100000))
+        class _UpstreamHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+            def translate_path(self, path):
+                return os.path.join(_upstreamDir, os.path.basename(path))
+            def log_message(self, format, *args):
+                pass
+        _upstream = _ThreadingHTTPServer(("127.0.0.1", 0), _UpstreamHandler)
+        _upstreamThread = threading.Thread(target=_upstream.serve_forever)
+        _upstreamThread.daemon = True
+        _upstreamThread.start()
+        _upstreamUrl = "http://127.0.0.1:{0}/".format(_upstream.server_address[1])
+        with PackageProxy(os.path.join(_testDir, "cache"), maxBytes=250000, ipaddress="127.0.0.1") as _proxy:
+            _opener = urllib2.build_opener(urllib2.ProxyHandler({"http": _proxy.url}))
+            for _name in ["a.rpm", "a.rpm", "b.deb", "repomd.xml", "c.deb", "a.rpm"]:
+                _content = _opener.open(_upstreamUrl + _name).read()
+                with open(os.path.join(_upstreamDir, _name), "rb") as inputFile:
+                    if _content != inputFile.read():
+                        raise Exception("wrong content of {0}".format(_name))
+            print _proxy.stats()
+        _upstream.shutdown()
+    finally:
+        shutil.rmtree(_testDir)
@@ -5,7 +5,6 @@
 Class provided by this module is SystemRequirements.
 
 As implemented works in Linux.
-As implemented requires which command.
 
 Idea and first implementation - Leo Baschy <srguiwiz12 AT nrvr DOT com>
 
@@ -16,25 +15,260 @@ Public repository - https://github.com/srguiwiz/nrvr-commander
 Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
+from distutils.version import LooseVersion
+import json
+import os
+import os.path
+import re
+import threading
+
 from nrvr.process.commandcapture import CommandCapture
+from nrvr.util.times import Timestamp
+from nrvr.util.user import ScriptUser
 
 class SystemRequirements(object):
     """Utilities regarding requirements on machine for running the script.
     
-    As implemented requires which command."""
+    As implemented looks for commands in directories in PATH, as the which command would,
+    but without running it, hence checking many commands takes milliseconds only.
+    
+    Commands can be required with a minimum version, e.g. "genisoimage>=1.1.11".
+    Versions are probed by running commands, concurrently if several,
+    once only for each executable, remembered in a file across runs."""
     
+    _foundLock = threading.Lock()
+    # by value of PATH a 2-tuple (modification times of its directories, dictionary of commands found)
+    _foundByPath = {}
+
+    @classmethod
+    def _found(cls):
+        """Auxiliary method, return a 2-tuple (directories in PATH, dictionary of commands found so far).
+        
+        Found commands are kept per value of PATH, until a modification time of one of its directories
+        changes, e.g. when a command is installed or removed."""
+        path = os.environ.get("PATH", os.defpath)
+        # an empty entry means the current directory
+        directories = [directory or os.curdir for directory in path.split(os.pathsep)]
+        modificationTimes = []
+        for directory in directories:
+            try:
+                modificationTimes.append(os.stat(directory).st_mtime)
+            except OSError:
+                modificationTimes.append(None)
+        with SystemRequirements._foundLock:
+            modificationTimesAndFound = SystemRequirements._foundByPath.get(path)
+            if not modificationTimesAndFound or modificationTimesAndFound[0] != modificationTimes:
+                modificationTimesAndFound = (modificationTimes, {})
+                SystemRequirements._foundByPath[path] = modificationTimesAndFound
+        return directories, modificationTimesAndFound[1]
+
+    @classmethod
+    def _which(cls, command, directories, found):
+        """Auxiliary method, return path to command, or None if none found."""
+        if command in found:
+            return found[command]
+        whichCommand = None
+        if os.path.dirname(command):
+            # given with a directory, as which would
+            candidates = [command]
+        else:
+            candidates = [os.path.join(directory, command) for directory in directories]
+        for candidate in candidates:
+            if os.path.isfile(candidate) and os.access(candidate, os.X_OK):
+                whichCommand = candidate
+                break
+        found[command] = whichCommand
+        return whichCommand
+
     @classmethod
     def which(cls, command):
         """Return path to command, or None if none found."""
-        which = CommandCapture(["which", command],
-                               copyToStdio=False,
-                               exceptionIfNotZero=False, exceptionIfAnyStderr=False)
-        if which.returncode == 0 and not which.stderr:
-            return which.stdout.strip()
-        else:
-            return None
+        directories, found = cls._found()
+        return cls._which(command, directories, found)
+
+    # by command, a 2-tuple (args to probe its version with, regular expression to find the version
+    # in stdout and stderr), for other commands defaultVersionProbe
+    versionProbes = {
+        "genisoimage": (["--version"], r"genisoimage\s+([0-9][0-9.]*)"),
+        "ssh": (["-V"], r"OpenSSH_([0-9][0-9.]*(?:p[0-9]+)?)"),
+        "scp": None, # no option to show its version, see ssh
+        "vmrun": ([], r"vmrun version\s+([0-9][0-9.]*)"),
+        "qemu-img": (["--version"], r"qemu-img version\s+([0-9][0-9.]*)"),
+        "openssl": (["version"], r"OpenSSL\s+([0-9][0-9.]*[a-z]?)"),
+    }
+    defaultVersionProbe = (["--version"], r"([0-9]+(?:\.[0-9]+)+)")
+
+    # seconds to wait for probing a version
+    versionProbeTimeout = 10.0
+
+    # path of file to remember versions in, if None then ~/.nrvr/toolversions.json
+    versionCachePath = None
+
+    _versionCacheLock = threading.Lock()
+    # by path of executable a 3-tuple (size, modification time, version), None until loaded
+    _versionCache = None
+
+    # e.g. "genisoimage>=1.1.11"
+    _constraintRegex = re.compile(r"^\s*([^<>=!\s]+)\s*(>=|<=|==|!=|>|<)\s*(\S+)\s*$")
+
+    @classmethod
+    def _versionCacheFilePath(cls):
+        """Auxiliary method."""
+        if SystemRequirements.versionCachePath:
+            return SystemRequirements.versionCachePath
+        return ScriptUser.loggedIn.userHomeRelative(".nrvr/toolversions.json")
+
+    @classmethod
+    def _loadVersionCache(cls):
+        """Auxiliary method, called with lock held."""
+        if SystemRequirements._versionCache is not None:
+            return
+        SystemRequirements._versionCache = {}
+        try:
+            with open(cls._versionCacheFilePath(), "r") as versionCacheFile:
+                for path, (size, modificationTime, version) in json.load(versionCacheFile).iteritems():
+                    SystemRequirements._versionCache[str(path)] = (size, modificationTime,
+                                                                   str(version) if version is not None else None)
+        except (IOError, OSError, ValueError, TypeError):
+            # not there yet, or damaged, probe again
+            pass
+
+    @classmethod
+    def _saveVersionCache(cls):
+        """Auxiliary method, called with lock held."""
+        temporaryPath = None
+        try:
+            # e.g. without a controlling terminal os.getlogin() raises OSError
+            versionCacheFilePath = cls._versionCacheFilePath()
+            versionCacheDirectory = os.path.dirname(versionCacheFilePath)
+            temporaryPath = versionCacheFilePath + ".tmp" + Timestamp.microsecondTimestamp()
+            if not os.path.isdir(versionCacheDirectory):
+                os.makedirs(versionCacheDirectory, 0755)
+            with open(temporaryPath, "w") as versionCacheFile:
+                json.dump(SystemRequirements._versionCache, versionCacheFile, indent=1, sort_keys=True)
+            # atomic, in case another process is reading
+            os.rename(temporaryPath, versionCacheFilePath)
+        except (IOError, OSError):
+            # not being able to remember only means probing again next time
+            pass
+        finally:
+            if temporaryPath and os.path.exists(temporaryPath):
+                os.remove(temporaryPath)
+
+    @classmethod
+    def versions(cls, commands):
+        """Return a dictionary of version strings by command, a version None if none found.
+        
+        Probes versions of commands not probed before concurrently.
+        Remembers versions found by path, size and modification time of executables,
+        across runs, hence after first time costs nothing, until a command is updated.
+        Does not remember failing to find a version, e.g. if a probe timed out.
+        
+        commands
+            a list of strings, one for each command, which need not be available."""
+        directories, found = cls._found()
+        identities = {}
+        for command in commands:
+            whichCommand = cls._which(command, directories, found)
+            if not whichCommand:
+                continue
+            realPath = os.path.realpath(whichCommand)
+            try:
+                commandStat = os.stat(realPath)
+            except OSError:
+                continue
+            identities[command] = (realPath, commandStat.st_size, commandStat.st_mtime)
+        versions = dict((command, None) for command in commands)
+        toProbe = []
+        with SystemRequirements._versionCacheLock:
+            cls._loadVersionCache()
+            for command, (realPath, size, modificationTime) in identities.iteritems():
+                cached = SystemRequirements._versionCache.get(realPath)
+                if cached and cached[0] == size and cached[1] == modificationTime:
+                    versions[command] = cached[2]
+                else:
+                    toProbe.append(command)
+        if not toProbe:
+            return versions
+        # start all, then wait for all
+        probes = []
+        with open(os.devnull, "r") as devnull:
+            for command in toProbe:
+                versionProbe = cls.versionProbes.get(command, cls.defaultVersionProbe)
+                if not versionProbe:
+                    probes.append((command, None, None))
+                    continue
+                probeArgs, versionRegex = versionProbe
+                try:
+                    handle = CommandCapture.start([command] + probeArgs,
+                                                  copyToStdio=False,
+                                                  exceptionIfNotZero=False, exceptionIfAnyStderr=False,
+                                                  processGroup=False,
+                                                  stdin=devnull)
+                except OSError:
+                    handle = None
+                probes.append((command, handle, versionRegex))
+        for command, handle, versionRegex in probes:
+            version = None
+            if handle:
+                if handle.wait(timeout=cls.versionProbeTimeout) is None:
+                    handle.kill().wait()
+                versionMatch = re.search(versionRegex, handle.stdout + "\n" + handle.stderr)
+                if versionMatch:
+                    version = versionMatch.group(1)
+            versions[command] = version
+        # remember only versions found, because e.g. a probe timed out under load should be tried again
+        foundCommands = [command for command, handle, versionRegex in probes if versions[command] is not None]
+        if foundCommands:
+            with SystemRequirements._versionCacheLock:
+                for command in foundCommands:
+                    realPath, size, modificationTime = identities[command]
+                    SystemRequirements._versionCache[realPath] = (size, modificationTime, versions[command])
+                cls._saveVersionCache()
+        return versions
+
+    @classmethod
+    def version(cls, command):
+        """Return version string of command, or None if none found."""
+        return cls.versions([command])[command]
+
+    @classmethod
+    def _constraint(cls, command):
+        """Auxiliary method, return a 3-tuple (command, operator, version), operator and version None
+        if no constraint."""
+        constraintMatch = cls._constraintRegex.match(command)
+        if not constraintMatch:
+            return command, None, None
+        return constraintMatch.group(1), constraintMatch.group(2), constraintMatch.group(3)
+
+    @classmethod
+    def _satisfies(cls, version, operator, requiredVersion):
+        """Auxiliary method."""
+        if version is None:
+            return False
+        version = LooseVersion(version)
+        requiredVersion = LooseVersion(requiredVersion)
+        return {">=": version >= requiredVersion,
+                "<=": version <= requiredVersion,
+                "==": version == requiredVersion,
+                "!=": version != requiredVersion,
+                ">": version > requiredVersion,
+                "<": version < requiredVersion}[operator]
+
+    @classmethod
+    def _constrainedCommands(cls, commands):
+        """Auxiliary method, return a list of commands with a version constraint, including in alternatives."""
+        constrainedCommands = []
+        for command in commands:
+            if isinstance(command, basestring):
+                command, operator, requiredVersion = cls._constraint(command)
+                if operator:
+                    constrainedCommands.append(command)
+            elif isinstance(command, (tuple)):
+                for alternative in command:
+                    constrainedCommands.extend(cls._constrainedCommands(alternative))
+        return constrainedCommands
 
-    # TODO consider allowing requiring minimum versions, maybe use distutils.version to compare
     @classmethod
     def commandsAvailable(cls, commands, listWhich=False):
         """Return allRequiredFound or a 2-tuple (allRequiredFound, whichCommandsFound).
@@ -46,6 +280,8 @@ class SystemRequirements(object):
         
         commands
             a list of strings, one for each command to be found.
+            A string can have a version constraint, e.g. "genisoimage>=1.1.11" or "ssh>=5",
+            with operator >=, >, ==, !=, <= or <, compared as distutils.version.LooseVersion.
             To allow alternatives, if instead of a string there is a tuple of sublists then
             whether for at least one sublist of the tuple all commands can be found.
         
@@ -54,6 +290,19 @@ class SystemRequirements(object):
             Default only to return a boolean value allRequiredFound."""
         if not isinstance(commands, (list)):
             raise TypeError("class SystemRequirements method commandsAvailable expects commands parameter to be a list, not {0}".format(commands))
+        # looking at PATH once for all commands including all alternatives
+        directories, found = cls._found()
+        # probing versions once for all commands including all alternatives, concurrently
+        versions = cls.versions(cls._constrainedCommands(commands))
+        allRequiredFound, whichCommandsFound = cls._commandsAvailable(commands, directories, found, versions)
+        if not listWhich:
+            return allRequiredFound
+        else:
+            return allRequiredFound, whichCommandsFound
+
+    @classmethod
+    def _commandsAvailable(cls, commands, directories, found, versions):
+        """Auxiliary method, return a 2-tuple (allRequiredFound, whichCommandsFound)."""
         anyRequiredNotFound = False
         whichCommandsFound = []
         for command in commands:
@@ -62,11 +311,12 @@ class SystemRequirements(object):
                 continue
             if isinstance(command, basestring):
                 # require one command
-                which = CommandCapture(["which", command],
-                                       copyToStdio=False,
-                                       exceptionIfNotZero=False, exceptionIfAnyStderr=False)
-                whichCommand = which.stdout.strip()
-                if which.returncode == 0 and not which.stderr:
+                command, operator, requiredVersion = cls._constraint(command)
+                whichCommand = cls._which(command, directories, found)
+                if whichCommand and operator and not cls._satisfies(versions.get(command), operator, requiredVersion):
+                    # found but not a version as required
+                    whichCommand = None
+                if whichCommand:
                     # found this one
                     if not whichCommand in whichCommandsFound:
                         # keep a list
@@ -80,8 +330,8 @@ class SystemRequirements(object):
                 # require at least one of several lists of commands
                 oneAlternativeComplete = False
                 for alternative in alternatives:
-                    alternativeComplete, alternativeCommands = SystemRequirements.commandsAvailable(alternative,
-                                                                                                    listWhich=listWhich)
+                    alternativeComplete, alternativeCommands = cls._commandsAvailable(alternative,
+                                                                                      directories, found, versions)
                     if alternativeComplete:
                         # this one at least
                         oneAlternativeComplete = True
@@ -92,10 +342,7 @@ class SystemRequirements(object):
                     anyRequiredNotFound = True
             else:
                 raise TypeError("class SystemRequirements method commandsAvailable expects commands parameter to be a list of strings or tuples, not to contain {0}".format(command))
-        if not listWhich:
-            return not anyRequiredNotFound
-        else:
-            return not anyRequiredNotFound, whichCommandsFound
+        return not anyRequiredNotFound, whichCommandsFound
 
     @classmethod
     def commandsRequired(cls, commands, verbose=False):
@@ -155,3 +402,14 @@ if __name__ == "__main__":
                                         verbose=True)
     SystemRequirements.commandsRequiredByImplementations([SystemRequirements],
                                                          verbose=True)
+    import time
+    _begin = time.time()
+    for _ in range(100):
+        SystemRequirements.commandsAvailable(["which", "hostname", "ssh", "scp", "genisoimage", "openssl",
+                                              (["ifconfig"], ["ip"]), (["iso-read"], ["7z"])])
+    print "100 times checking 8 commands in {0:.3f} seconds".format(time.time() - _begin)
+    _begin = time.time()
+    print SystemRequirements.versions(["ssh", "openssl", "python", "hostname", "commandthatdoesntexist"])
+    print "probing versions in {0:.3f} seconds".format(time.time() - _begin)
+    print SystemRequirements.commandsAvailable(["ssh>=5", (["genisoimage>=1.1.11"], ["openssl>=1.0"])],
+                                               listWhich=True)
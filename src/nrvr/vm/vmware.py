@@ -50,6 +50,7 @@ import time
 from nrvr.diskimage.isoimage import IsoImage
 from nrvr.machine.ports import PortsFile
 from nrvr.process.commandcapture import CommandCapture
+from nrvr.process.commandmemo import CommandMemo
 from nrvr.remote.ssh import SshParameters, SshCommand, ScpCommand
 from nrvr.util.classproperty import classproperty
 from nrvr.util.networkinterface import NetworkInterface
@@ -842,18 +843,26 @@ class VMwareHypervisor(object):
     SNAPSHOTS = "snapshots"
     CLONING = "cloning"
 
+    # how long to memoize probing for localHostType if CommandMemo is enabled
+    localHostTypeMemoSeconds = 60 * 60
+
     @classmethod
     def localHostType(cls):
         """Determine and return host type of VMware hypervisor available locally."""
         # as implemented does NOT require vmrun command, absence means not any
-        vmrun = CommandCapture(["vmrun", "-T", VMwareHypervisor.WORKSTATION, "list"],
-                               copyToStdio=False,
-                               exceptionIfNotZero=False, exceptionIfAnyStderr=False)
+        #
+        # only returncode and stderr matter here, not which virtual machines are running,
+        # hence memoized if CommandMemo is enabled, for a while only, in case VMware gets installed
+        vmrun = CommandMemo.capture(["vmrun", "-T", VMwareHypervisor.WORKSTATION, "list"],
+                                    ttlSeconds=VMwareHypervisor.localHostTypeMemoSeconds,
+                                    copyToStdio=False,
+                                    exceptionIfNotZero=False, exceptionIfAnyStderr=False)
         if vmrun.returncode == 0 and not vmrun.stderr:
             return VMwareHypervisor.WORKSTATION
-        vmrun = CommandCapture(["vmrun", "-T", VMwareHypervisor.PLAYER, "list"],
-                               copyToStdio=False,
-                               exceptionIfNotZero=False, exceptionIfAnyStderr=False)
+        vmrun = CommandMemo.capture(["vmrun", "-T", VMwareHypervisor.PLAYER, "list"],
+                                    ttlSeconds=VMwareHypervisor.localHostTypeMemoSeconds,
+                                    copyToStdio=False,
+                                    exceptionIfNotZero=False, exceptionIfAnyStderr=False)
         if vmrun.returncode == 0 and not vmrun.stderr:
             return VMwareHypervisor.PLAYER
         # not any
@@ -967,8 +976,11 @@ class VMwareHypervisor(object):
         """Return whether .vmx file listed as running."""
         # really want abspath and expanduser
         os.path.abspath(os.path.expanduser(vmxFilePath))
-        running = self.listRunning()
-        return vmxFilePath in running
+        # as in listRunning, but done as soon as seeing vmxFilePath listed
+        vmrun = CommandCapture(["vmrun", "-T", self._hostType, "list"],
+                               copyToStdio=False,
+                               until=r"^\s*" + re.escape(vmxFilePath) + r"\s*$", killWhenMatched=True)
+        return vmrun.untilMatch is not None
 
     def sleepUntilNotRunning(self, vmxFilePath, checkIntervalSeconds=5.0, ticker=False):
         """If not running return, else loop sleeping for checkIntervalSeconds."""
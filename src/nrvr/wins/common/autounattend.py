@@ -16,13 +16,15 @@ Copyright (c) Nirvana Research 2006-2015.
 Simplified BSD License"""
 
 from collections import namedtuple
+import os.path
 import re
 from xml.sax.saxutils import escape
 
 import nrvr.diskimage.isoimage
-from nrvr.process.commandcapture import CommandCapture
+from nrvr.diskimage.udf import UdfReader
 from nrvr.util.ipaddress import IPAddress
 from nrvr.util.networkinterface import NetworkConfigurationStaticParameters
+from nrvr.util.times import Timestamp
 
 class WinUdfImage(nrvr.diskimage.isoimage.IsoImage):
     """A Windows installer UDF DVD-ROM disk image."""
@@ -32,7 +34,7 @@ class WinUdfImage(nrvr.diskimage.isoimage.IsoImage):
         """Return a list to be passed to SystemRequirements.commandsRequired().
         
         This class can be passed to SystemRequirements.commandsRequiredByImplementations()."""
-        return nrvr.diskimage.isoimage.IsoImage.commandsUsedInImplementation() + ["isoinfo"]
+        return nrvr.diskimage.isoimage.IsoImage.commandsUsedInImplementation()
 
     def __init__(self, isoImagePath):
         """Create new Windows installer WinUdfImage descriptor.
@@ -82,7 +84,8 @@ class WinUdfImage(nrvr.diskimage.isoimage.IsoImage):
         return genisoimageOptions
 
     def cloneWithModifications(self, modifications=[], cloneIsoImagePath=None, udf=True, ignoreJoliet=False,
-                               pause=False):
+                               pause=False, persistentExtraction=False, engine="genisoimage",
+                               cloneCache=None):
         """Clone with any number of instances of IsoImageModification applied.
         
         A temporary assembly directory in the same directory as cloneIsoImagePath needs disk space,
@@ -94,13 +97,25 @@ class WinUdfImage(nrvr.diskimage.isoimage.IsoImage):
         cloneIsoImagePath
             if not given then in same directory with a timestamp in the filename.
         
+        persistentExtraction
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        engine
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        cloneCache
+            see documentation of class IsoImage method cloneWithModifications.
+        
         return
             WinUdfImage(cloneIsoImagePath)."""
         clone = super(WinUdfImage, self).cloneWithModifications(modifications=modifications,
                                                                 cloneIsoImagePath=cloneIsoImagePath,
                                                                 udf=udf,
                                                                 ignoreJoliet=ignoreJoliet,
-                                                                pause=pause)
+                                                                pause=pause,
+                                                                persistentExtraction=persistentExtraction,
+                                                                engine=engine,
+                                                                cloneCache=cloneCache)
         return WinUdfImage(clone.isoImagePath)
 
     def modificationsIncludingAutounattendFile(self, _autounattendFileContent):
@@ -134,7 +149,9 @@ class WinUdfImage(nrvr.diskimage.isoimage.IsoImage):
                 ])
         return modifications
 
-    def cloneWithAutounattend(self, _autounattendFileContent, modifications=[], cloneIsoImagePath=None):
+    def cloneWithAutounattend(self, _autounattendFileContent, modifications=[], cloneIsoImagePath=None,
+                              persistentExtraction=False, engine="genisoimage",
+                              cloneCache=None):
         """Clone with autounattend.xml file added and modified to automatically boot with it.
         
         For more on behavior see documentation of class IsoImage method cloneWithModifications.
@@ -153,39 +170,117 @@ class WinUdfImage(nrvr.diskimage.isoimage.IsoImage):
         cloneIsoImagePath
             if not given then in same directory with a timestamp in the filename.
         
+        persistentExtraction
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        engine
+            see documentation of class IsoImage method cloneWithModifications.
+        
+        cloneCache
+            see documentation of class IsoImage method cloneWithModifications.
+        
         return
             IsoImage(cloneIsoImagePath)."""
         # modifications, possibly different per Windows version specific subclass
         modifications.extend(self.modificationsIncludingAutounattendFile(_autounattendFileContent))
         # clone with modifications
         clone = self.cloneWithModifications(modifications=modifications,
-                                            cloneIsoImagePath=cloneIsoImagePath)
+                                            cloneIsoImagePath=cloneIsoImagePath,
+                                            persistentExtraction=persistentExtraction,
+                                            engine=engine,
+                                            cloneCache=cloneCache)
         return clone
 
-    def modificationForElToritoBootImage(self):
+    def configIsoImageWithAutounattend(self, _autounattendFileContent, configIsoImagePath=None):
+        """Make a small config .iso image with only an autounattend.xml file, per virtual machine.
+        
+        Windows Setup looks for an autounattend.xml file in the root directory of all drives,
+        hence this .iso image can stay unmodified and boot as it is,
+        see method isoImagesForAutounattend.
+        
+        Takes well under a second, see class IsoImage method createWithModifications.
+        
+        _autounattendFileContent
+            An InstallerAutounattendFileContent object.
+        
+        configIsoImagePath
+            if not given then in same directory as this .iso image with a timestamp in the filename.
+        
+        return
+            IsoImage(configIsoImagePath)."""
+        # timestamp to the microsecond should be good enough
+        timestamp = Timestamp.microsecondTimestamp()
+        if not configIsoImagePath:
+            isoImagePathSplitext = os.path.splitext(self._isoImagePath)
+            configIsoImagePath = isoImagePathSplitext[0] + ".config." + timestamp + isoImagePathSplitext[1]
+        return nrvr.diskimage.isoimage.IsoImage.createWithModifications \
+            (configIsoImagePath,
+             [nrvr.diskimage.isoimage.IsoImageModificationFromString
+              ("autounattend.xml",
+               _autounattendFileContent.string)],
+             label="au-" + timestamp)
+
+    def isoImagesForAutounattend(self, _autounattendFileContent, configIsoImagePath=None):
+        """Alternative to method cloneWithAutounattend without cloning all of this .iso image.
+        
+        Unlike for Linux kickstart no boot-only .iso image is needed,
+        because the boot line doesn't need to point at the autounattend.xml file.
+        
+        Per virtual machine only the config .iso image is made,
+        taking well under a second rather than minutes.
+        
+        _autounattendFileContent
+            An InstallerAutounattendFileContent object.
+        
+        configIsoImagePath
+            if not given then in same directory as this .iso image with a timestamp in the filename.
+        
+        return
+            a list of two IsoImage, this .iso image unmodified first, to boot from,
+            then the config .iso image,
+            e.g. VMwareMachine.create(ideDrives=[40000] + isoImages)."""
+        configIsoImage = self.configIsoImageWithAutounattend(_autounattendFileContent,
+                                                             configIsoImagePath=configIsoImagePath)
+        return [self, configIsoImage]
+
+    def modificationForElToritoBootImage(self, efi=False, pathOnIso=None):
         """Construct and return an instance of IsoImageModification, to be processed
         by method cloneWithModifications.
         
-        As implemented copies El Torito boot image from sectors into a file."""
-        # as implemented assumes this is the kind of disk with this kind of info
-        isoinfo = CommandCapture([
-            "isoinfo",
-            "-d",
-            # on Mac got stderr "Setting input-charset to 'UTF-8' from locale." hence -j UTF-8
-            # then on Ubuntu got stderr "Unknown charset: UTF-8" hence -j iso8859-1
-            "-j", "iso8859-1",
-            "-i", self._isoImagePath],
-            copyToStdio=False)
-        info = isoinfo.stdout
-        numberOfSectors = re.search(r"(?mi)^[ \t]*Nsect[ \t]+([0-9]+).*$", info).group(1)
-        numberOfSectors = int(numberOfSectors, base=16)
-        firstSector = re.search(r"(?mi)^[ \t]*Bootoff[ \t]+([0-9a-f]+).*$", info).group(1)
-        firstSector = int(firstSector, base=16)
-        start = firstSector * 2048
-        stop = start + numberOfSectors * 2048
+        As implemented copies El Torito boot image from sectors into a file.
+        
+        Reads the boot catalog in-process, see nrvr.diskimage.eltorito.
+        
+        efi
+            whether to copy the boot image of the first EFI entry
+            rather than of the initial/default entry.
+        
+        pathOnIso
+            if not given then "boot.bin", or for efi "efisys.bin"."""
+        bootCatalog = self.elToritoBootCatalog()
+        if not efi:
+            bootEntry = bootCatalog.defaultEntry
+            start = bootEntry.byteOffset
+            # whole 2048-byte sectors per virtual sector count, more than gets loaded, has worked
+            stop = start + bootEntry.sectorCount * 2048
+            if not pathOnIso:
+                pathOnIso = "boot.bin"
+        else:
+            bootEntry = bootCatalog.efiEntry
+            if not bootEntry:
+                raise Exception("no EFI entry in El Torito boot catalog of {0}".format(self._isoImagePath))
+            start = bootEntry.byteOffset
+            # sector count of an EFI entry often is meaningless, better size of file at same place
+            stop = start + bootEntry.byteLength
+            for entry in self.listing(udf=UdfReader.isUdf(self._isoImagePath)):
+                if not entry.isDirectory and entry.size and entry.firstByteOffset == start:
+                    stop = start + entry.size
+                    break
+            if not pathOnIso:
+                pathOnIso = "efisys.bin"
         modification = \
             nrvr.diskimage.isoimage.IsoImageModificationFromByteRange(
-                "boot.bin",
+                pathOnIso,
                 self.isoImagePath,
                 start, stop)
         return modification
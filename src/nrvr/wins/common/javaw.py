@@ -17,7 +17,7 @@ import os
 import os.path
 import sys
 
-from nrvr.process.commandcapture import CommandCapture
+from nrvr.process.commandcapture import CommandCapture, CommandCapturePipeline
 from nrvr.util.user import ScriptUser
 
 class Arch(str): pass # make sure it is a string to avoid string-number unequality
@@ -38,12 +38,11 @@ class JavawDownload(object):
     def _currentOfflineInstallerUrl(cls):
         """Auxiliary method."""
         offlineInstallerPageUrl = r"http://java.com/en/download/windows_offline.jsp"
-        sedToExtractDownloadUrl = r"sed -n -e 's/.*\(http:\/\/.*BundleId=[0-9]*\).*/\1/p'"
-        wget = CommandCapture(
-            ["sh",
-             "-c", "wget -q -O- " + offlineInstallerPageUrl + r" | " + sedToExtractDownloadUrl],
-            copyToStdio=False,
-            forgoPty=True)
+        sedToExtractDownloadUrl = r"s/.*\(http:\/\/.*BundleId=[0-9]*\).*/\1/p"
+        wget = CommandCapturePipeline(
+            [["wget", "-q", "-O-", offlineInstallerPageUrl],
+             ["sed", "-n", "-e", sedToExtractDownloadUrl]],
+            copyToStdio=False)
         if not wget.stdout:
             raise Exception("not able to get offline installer URL from {0}".format(offlineInstallerPageUrl))
         return wget.stdout.strip()
@@ -10,7 +10,12 @@ try:
           long_description="""Tools for automation.
           
           Modules provides by this package are
+          * nrvr.diskimage.clonecache
+          * nrvr.diskimage.eltorito
+          * nrvr.diskimage.iso9660
           * nrvr.diskimage.isoimage
+          * nrvr.diskimage.remaster
+          * nrvr.diskimage.udf
           * nrvr.distros.common.gnome
           * nrvr.distros.common.kickstart
           * nrvr.distros.common.ssh
@@ -28,14 +33,21 @@ try:
           * nrvr.distros.ub.rel1404.preseed
           * nrvr.distros.ub.rel1404.preseedtemplates
           * nrvr.machine.ports
+          * nrvr.process.chrometrace
           * nrvr.process.commandcapture
+          * nrvr.process.commandmemo
+          * nrvr.process.outputbuffer
+          * nrvr.process.spawn
           * nrvr.remote.ping
           * nrvr.remote.ssh
           * nrvr.util.classproperty
+          * nrvr.util.configserver
           * nrvr.util.download
+          * nrvr.util.filecopy
           * nrvr.util.ipaddress
           * nrvr.util.nameserver
           * nrvr.util.networkinterface
+          * nrvr.util.packageproxy
           * nrvr.util.registering
           * nrvr.util.requirements
           * nrvr.util.times